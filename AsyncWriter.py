@@ -0,0 +1,242 @@
+import collections
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+class Async_Writer():
+    '''
+    Runs file writing jobs (image encoding, PLY export, ...) on a pool of
+    worker threads so they do not hold up the capture loop.
+
+    Jobs wait in a queue of at most max_queue entries. When it is full,
+    backpressure decides what submit() does:
+        - 'block'       : wait until a worker takes a job
+        - 'drop_oldest' : discard the oldest waiting job
+        - 'spill'       : pickle the job's arguments to spill_dir, the
+                          job still runs in submission order
+    close() (or leaving the with block) writes everything still queued
+    before it returns.
+    '''
+
+    BACKPRESSURE_MODES = ('block', 'drop_oldest', 'spill')
+
+    def __init__(self, num_workers=2, max_queue=8, backpressure='block',
+                 spill_dir=None):
+        if backpressure not in self.BACKPRESSURE_MODES:
+            raise ValueError(f'backpressure must be one of '
+                             f'{self.BACKPRESSURE_MODES}, not {backpressure}')
+        if max_queue < 1:
+            raise ValueError(f'max_queue must be at least 1, not {max_queue}')
+        self.max_queue = max_queue
+        self.backpressure = backpressure
+        self.spill_dir = spill_dir
+        self._own_spill_dir = False
+
+        self._jobs = collections.deque()
+        self._spilled_jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._active = 0
+        self._closing = False
+        # submission number of every job, the workers take the oldest one
+        # of both queues
+        self._next_sequence = 0
+
+        # statistics
+        self._start_time = None
+        self._submitted = 0
+        self._written = 0
+        self._dropped = 0
+        self._spilled = 0
+        self._failed = 0
+        self._write_time = 0.0
+        self._max_queue_depth = 0
+        self.last_error = None
+
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._work,
+                                      name=f'Async_Writer-{i}',
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        with self._cond:
+            if self._closing:
+                raise RuntimeError('Async_Writer is closed')
+            if self._start_time is None:
+                self._start_time = time.perf_counter()
+            self._submitted += 1
+            job = (self._next_sequence, func, args, kwargs)
+            self._next_sequence += 1
+
+            while len(self._jobs) >= self.max_queue:
+                if self.backpressure == 'block':
+                    self._cond.wait()
+                elif self.backpressure == 'drop_oldest':
+                    self._jobs.popleft()
+                    self._dropped += 1
+                else:
+                    break
+            else:
+                self._jobs.append(job)
+                self._update_max_queue_depth()
+                self._cond.notify_all()
+                return
+            # the place of the job is taken now, the workers do not run
+            # newer jobs before its spill file is written
+            spilled_job = [job[0], func, None]
+            self._spilled_jobs.append(spilled_job)
+            self._update_max_queue_depth()
+
+        # spill outside of the lock, the workers keep going meanwhile
+        try:
+            path = self._spill(job)
+        except BaseException:
+            with self._cond:
+                self._spilled_jobs.remove(spilled_job)
+                self._failed += 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            spilled_job[2] = path
+            self._spilled += 1
+            self._cond.notify_all()
+
+    def write_image(self, path, image):
+        # cv2 is only needed by callers that write images
+        import cv2
+        self.submit(cv2.imwrite, path, image)
+
+    def flush(self):
+        # wait until every submitted job is written
+        with self._cond:
+            while self._jobs or self._spilled_jobs or self._active:
+                self._cond.wait()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        if self._own_spill_dir:
+            os.rmdir(self.spill_dir)
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._jobs) + len(self._spilled_jobs)
+
+    def stats(self):
+        with self._cond:
+            if self._start_time is None:
+                elapsed = 0.0
+            else:
+                elapsed = time.perf_counter() - self._start_time
+            return {
+                'queue_depth': len(self._jobs) + len(self._spilled_jobs),
+                'max_queue_depth': self._max_queue_depth,
+                'submitted': self._submitted,
+                'written': self._written,
+                'dropped': self._dropped,
+                'spilled': self._spilled,
+                'failed': self._failed,
+                'elapsed_sec': elapsed,
+                'writes_per_sec': self._written / elapsed if elapsed else 0.0,
+                'mean_write_ms': (1000 * self._write_time / self._written
+                                  if self._written else 0.0),
+            }
+
+    def format_stats(self):
+        stats = self.stats()
+        return (f'writer: queue {stats["queue_depth"]} '
+                f'(max {stats["max_queue_depth"]}), '
+                f'{stats["written"]}/{stats["submitted"]} written, '
+                f'{stats["writes_per_sec"]:.1f} writes/s, '
+                f'{stats["mean_write_ms"]:.1f} ms/write, '
+                f'{stats["dropped"]} dropped, {stats["spilled"]} spilled, '
+                f'{stats["failed"]} failed')
+
+    def _update_max_queue_depth(self):
+        depth = len(self._jobs) + len(self._spilled_jobs)
+        self._max_queue_depth = max(self._max_queue_depth, depth)
+
+    def _spill(self, job):
+        _, _, args, kwargs = job
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='async_writer_spill_')
+            self._own_spill_dir = True
+        os.makedirs(self.spill_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix='.pkl', dir=self.spill_dir)
+        with os.fdopen(fd, 'wb') as spill_file:
+            pickle.dump((args, kwargs), spill_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def _unspill(self, spilled_job):
+        sequence, func, path = spilled_job
+        with open(path, 'rb') as spill_file:
+            args, kwargs = pickle.load(spill_file)
+        os.remove(path)
+        return (sequence, func, args, kwargs)
+
+    def _take_job(self):
+        # (job, spilled job) of the oldest job of both queues, a spilled
+        # one waited longer than the jobs queued after it. Nothing while
+        # the oldest job is still being spilled.
+        if self._spilled_jobs and (
+                not self._jobs
+                or self._spilled_jobs[0][0] < self._jobs[0][0]):
+            if self._spilled_jobs[0][2] is None:
+                return None, None
+            return None, self._spilled_jobs.popleft()
+        if self._jobs:
+            return self._jobs.popleft(), None
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    job, spilled_job = self._take_job()
+                    if job is not None or spilled_job is not None:
+                        break
+                    if (self._closing and not self._jobs
+                            and not self._spilled_jobs):
+                        return
+                    self._cond.wait()
+                self._active += 1
+                # a blocked submit() can queue its job now
+                self._cond.notify_all()
+
+            start = time.perf_counter()
+            failed = False
+            try:
+                if spilled_job is not None:
+                    job = self._unspill(spilled_job)
+                _, func, args, kwargs = job
+                func(*args, **kwargs)
+            except Exception as error:
+                failed = True
+                self.last_error = error
+                print(f'Async_Writer: job failed: {error!r}')
+            write_time = time.perf_counter() - start
+
+            with self._cond:
+                self._active -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._written += 1
+                    self._write_time += write_time
+                self._cond.notify_all()
@@ -1,46 +1,409 @@
-import cv2
+import collections
 import ctypes
+import functools
+import re
 import sys
+import threading
+import time
 
 import numpy as np
 
-from arena_api.system import system
-from arena_api.__future__.save import Writer
-from arena_api.enums import PixelFormat
-from arena_api.buffer import BufferFactory
+import DepthStats
+import PlyWriter
+from LazyImport import Lazy_Module
+from DeviceProfiles import Profile_Engine, get_profile
+from DeviceRegistry import get_device_registry
+
+# OpenCV and the arena_api SDK are imported when a camera first needs
+# them, not with this module (LazyImport.py, IRTOF_IMPORT_TIMING=1 shows
+# how long they take)
+cv2 = Lazy_Module('cv2')
+arena_system = Lazy_Module('arena_api.system')
+arena_save = Lazy_Module('arena_api.__future__.save')
+arena_enums = Lazy_Module('arena_api.enums')
+arena_buffer = Lazy_Module('arena_api.buffer')
+
+# Distance in mm the heatmap colors span for each Scan3dOperatingMode.
+# Red is at 0 mm and blue at this distance, anything further is black.
+# Modes not listed here use the distance in their name.
+COLOR_MAX_DISTANCE_BY_OPERATING_MODE = {
+    'Distance1500mm': 1500,
+    'Distance6000mm': 6000,
+    'Distance1250mmSingleFreq': 1250,
+    'Distance3000mmSingleFreq': 3000,
+    'Distance4000mmSingleFreq': 4000,
+    'Distance5000mmMultiFreq': 5000,
+    'Distance6000mmSingleFreq': 6000,
+    'Distance8300mmMultiFreq': 8300,
+}
+COLOR_MAX_DISTANCE_DEFAULT = 1500
+
+
+def get_color_borders(max_distance=COLOR_MAX_DISTANCE_DEFAULT):
+    # red, yellow, green, cyan and blue borders evenly over 0..max_distance
+    band = max_distance / 4
+    return (0, band, 2 * band, 3 * band, max_distance)
+
+
+def get_color_borders_for_operating_mode(operating_mode):
+    max_distance = COLOR_MAX_DISTANCE_BY_OPERATING_MODE.get(operating_mode)
+    if max_distance is None:
+        match = re.search(r'(\d+)mm', str(operating_mode))
+        if match:
+            max_distance = int(match.group(1))
+        else:
+            max_distance = COLOR_MAX_DISTANCE_DEFAULT
+    return get_color_borders(max_distance)
+
+
+def get_rgb_colors_of_distances(z, color_borders=None):
+
+    # Same color bands as Tof_Camera.get_rgb_colors_of_point_at_distance()
+    # but for a whole array of z values (mm) at once.
+    # Returns uint8 [..., 3] RGB.
+    if color_borders is None:
+        color_borders = get_color_borders()
+    RGB_MIN = 0
+    RGB_MAX = 255
+    (COLOR_BORDER_RED, COLOR_BORDER_YELLOW, COLOR_BORDER_GREEN,
+     COLOR_BORDER_CYAN, COLOR_BORDER_BLUE) = color_borders
+
+    z = np.asarray(z, dtype=np.float64)
+
+    in_red_yellow = (COLOR_BORDER_RED <= z) & (z < COLOR_BORDER_YELLOW)
+    in_yellow_green = (COLOR_BORDER_YELLOW <= z) & (z < COLOR_BORDER_GREEN)
+    in_green_cyan = (COLOR_BORDER_GREEN <= z) & (z < COLOR_BORDER_CYAN)
+    in_cyan_blue = (COLOR_BORDER_CYAN <= z) & (z <= COLOR_BORDER_BLUE)
+    bands = [in_red_yellow, in_yellow_green, in_green_cyan, in_cyan_blue]
+
+    # percentage of the way through the band the point is in, the
+    # expressions match the scalar version so the rounding does too
+    yellow_percentage = ((z - COLOR_BORDER_RED)
+                         / (COLOR_BORDER_YELLOW - COLOR_BORDER_RED))
+    green_percentage = ((z - COLOR_BORDER_YELLOW)
+                        / (COLOR_BORDER_GREEN - COLOR_BORDER_YELLOW))
+    cyan_percentage = ((z - COLOR_BORDER_GREEN)
+                       / (COLOR_BORDER_CYAN - COLOR_BORDER_GREEN))
+    blue_percentage = ((z - COLOR_BORDER_CYAN)
+                       / (COLOR_BORDER_BLUE - COLOR_BORDER_CYAN))
+
+    red = np.select(bands, [RGB_MAX,
+                            RGB_MAX - (RGB_MAX * green_percentage),
+                            RGB_MIN,
+                            RGB_MIN], default=RGB_MIN)
+    green = np.select(bands, [RGB_MAX * yellow_percentage,
+                              RGB_MAX,
+                              RGB_MAX,
+                              RGB_MAX - (RGB_MAX * blue_percentage)],
+                      default=RGB_MIN)
+    blue = np.select(bands, [RGB_MIN,
+                             RGB_MIN,
+                             RGB_MAX * cyan_percentage,
+                             RGB_MAX], default=RGB_MIN)
+
+    # int() in the scalar version truncates, so does the uint8 cast
+    # for values in [0, 255]
+    rgb = np.empty(z.shape + (3,), dtype=np.uint8)
+    rgb[..., 0] = red
+    rgb[..., 1] = green
+    rgb[..., 2] = blue
+    return rgb
+
+
+@functools.lru_cache(maxsize=16)
+def get_distance_color_lut(scale_z, color_borders, bgr=False, is_signed=True,
+                           offset_z=0.0):
+
+    # Color of every possible raw 16 bit z value. Indexed with the raw
+    # channel viewed as uint16 so colorizing a frame is one np.take().
+    # Built once per (scale_z, color_borders, channel order, signedness,
+    # offset_z) and shared, so it is read only.
+    raw_values = np.arange(65536, dtype=np.uint16)
+    if is_signed:
+        raw_values = raw_values.view(np.int16)
+
+    # whole mm like int(z * scale_z + offset_z)
+    z = (raw_values * scale_z + offset_z).astype(np.int64)
+    lut = get_rgb_colors_of_distances(z, color_borders)
+    if bgr:
+        lut = np.ascontiguousarray(lut[:, ::-1])
+    lut.flags.writeable = False
+    return lut
+
+
+class Hardware_Backend():
+    # Where the camera classes get their devices from: arena_api for the
+    # Lucid cameras and OpenCV capture devices for the IR cameras.
+    # SimBackend.Sim_Backend has the same interface.
+
+    @property
+    def system(self):
+        return arena_system.system
+
+    def VideoCapture(self, index):
+        return cv2.VideoCapture(index)
+
+
+default_backend = Hardware_Backend()
+
+
+def set_default_backend(backend):
+    # backend used by cameras created without a backend argument
+    global default_backend
+    default_backend = backend
+
+
+class IR_View_Engine():
+    '''
+    Y16 IR frame -> [0, 1] float32 or 0..255 uint8 view image, in reused
+    buffers.
+
+    The display range is from the low_percentile to the high_percentile of
+    the frame, so a few hot or dead pixels do not squeeze the rest of the
+    image. The percentiles are read from a histogram of every subsample-th
+    pixel in each direction, and the range follows the scene smoothly:
+    each frame moves it (1 - smoothing) of the way to the measured one.
+    The range is never narrower than min_range raw values, so a flat frame
+    shows as flat gray instead of amplified noise (or a division by zero).
+    '''
+
+    HIST_SHIFT = 4  # histogram bins of 16 raw values
+
+    def __init__(self, low_percentile=0.5, high_percentile=99.5,
+                 subsample=4, smoothing=0.8, min_range=256):
+        self.low_percentile = low_percentile
+        self.high_percentile = high_percentile
+        self.subsample = subsample
+        self.smoothing = smoothing
+        self.min_range = min_range
+        self.view = None
+        self.view_u8 = None
+        self.shifted = None
+        self.reset()
+
+    def reset(self):
+        # forget the range, the next frame sets it without smoothing
+        self.low = None
+        self.high = None
+        self.display_low = None
+        self.display_high = None
+
+    def measure_range(self, ir):
+        sample = ir[::self.subsample, ::self.subsample].ravel()
+        histogram = np.bincount(sample >> self.HIST_SHIFT,
+                                minlength=65536 >> self.HIST_SHIFT)
+        cumulative = np.cumsum(histogram)
+        count = cumulative[-1]
+        low_bin = np.searchsorted(cumulative,
+                                  count * self.low_percentile / 100)
+        high_bin = np.searchsorted(cumulative,
+                                   count * self.high_percentile / 100)
+        low = float(low_bin << self.HIST_SHIFT)
+        high = float(((high_bin + 1) << self.HIST_SHIFT) - 1)
+        return low, high
+
+    def update_range(self, ir):
+        low, high = self.measure_range(ir)
+        if self.low is not None:
+            low = self.smoothing * self.low + (1 - self.smoothing) * low
+            high = self.smoothing * self.high + (1 - self.smoothing) * high
+        self.low = low
+        self.high = high
+
+        if high - low < self.min_range:
+            center = (low + high) / 2
+            low = min(max(center - self.min_range / 2, 0.0),
+                      65535.0 - self.min_range)
+            high = low + self.min_range
+        # shown as 0 and 1
+        self.display_low = round(low)
+        self.display_high = round(high)
+
+    def get_buffer(self, name, shape, dtype):
+        buffer = getattr(self, name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=dtype)
+            setattr(self, name, buffer)
+        return buffer
+
+    def make_view_image(self, ir, out=None):
+        # [0, 1] float32, in out or the engine's buffer (overwritten by the
+        # next call)
+        ir = np.asarray(ir).view(np.uint16)
+        self.update_range(ir)
+        if out is None:
+            out = self.get_buffer('view', ir.shape, np.float32)
+        np.copyto(out, ir, casting='unsafe')
+        out -= self.display_low
+        out *= 1.0 / (self.display_high - self.display_low)
+        np.clip(out, 0.0, 1.0, out=out)
+        return out
+
+    def make_view_image_u8(self, ir, out=None):
+        # 0..255 uint8, ready for cv2.imshow / cv2.imwrite
+        ir = np.asarray(ir).view(np.uint16)
+        self.update_range(ir)
+        if out is None:
+            out = self.get_buffer('view_u8', ir.shape, np.uint8)
+        # both saturate: below the range to 0, above it to 255
+        shifted = self.get_buffer('shifted', ir.shape, np.uint16)
+        cv2.subtract(ir, self.display_low, dst=shifted)
+        cv2.convertScaleAbs(
+            shifted, dst=out,
+            alpha=255.0 / (self.display_high - self.display_low))
+        return out
 
 
 class IR_Camera():
-    def __init__(self, id=1):
-        self.ir_cap = cv2.VideoCapture(id+cv2.CAP_DSHOW)
+    def __init__(self, id=1, backend=None, background=False):
+        self.backend = backend if backend is not None else default_backend
+        self.ir_cap = self.backend.VideoCapture(id+cv2.CAP_DSHOW)
         self.ir_cap.set(cv2.CAP_PROP_FOURCC,
                         cv2.VideoWriter.fourcc('Y', '1', '6', ' '))
         self.ir_cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.view_engine = IR_View_Engine()
+
+        self.grab_thread = None
+        if background:
+            self.start_grabbing()
+
+    def start_grabbing(self):
+        # A background thread keeps reading the device so the driver never
+        # queues up stale frames, and keeps the newest one in a double
+        # buffer. shoot_ir() then returns right away with that frame.
+        if self.grab_thread is not None:
+            return
+        self.grab_lock = threading.Lock()
+        # notified with every new frame
+        self.grab_condition = threading.Condition(self.grab_lock)
+        self.grab_stop = threading.Event()
+        self.grab_buffers = [None, None]
+        self.grab_front = 0
+        self.grab_timestamp = None
+        self.grab_count = 0
+        # grab_count of the frame shoot_ir_with_timestamp() returned last
+        self.shot_count = 0
+        self.grab_error = None
+        self.grab_thread = threading.Thread(target=self.grab_loop,
+                                            name='IR_Camera-grab',
+                                            daemon=True)
+        self.grab_thread.start()
+
+    def stop_grabbing(self):
+        if self.grab_thread is None:
+            return
+        self.grab_stop.set()
+        self.grab_thread.join()
+        self.grab_thread = None
+
+    def grab_loop(self):
+        while not self.grab_stop.is_set():
+            # read into the back buffer, the front one may be being copied
+            back = 1 - self.grab_front
+            try:
+                if self.grab_buffers[back] is None:
+                    code, ir_frame = self.ir_cap.read()
+                else:
+                    code, ir_frame = self.ir_cap.read(
+                        self.grab_buffers[back])
+            except Exception as error:
+                code = False
+                self.grab_error = error
+            timestamp = time.perf_counter()
+            if not code:
+                # device gone or not ready, do not spin
+                time.sleep(0.01)
+                continue
+
+            with self.grab_condition:
+                self.grab_buffers[back] = ir_frame
+                self.grab_front = back
+                self.grab_timestamp = timestamp
+                self.grab_count += 1
+                self.grab_condition.notify_all()
 
     def shoot_ir(self):
+        if self.grab_thread is not None:
+            return self.shoot_ir_with_timestamp()[0]
         code, ir_frame = self.ir_cap.read()
         return ir_frame
 
+    def shoot_ir_with_timestamp(self, timeout=1.0, newer=False):
+        # timestamp is time.perf_counter() when the frame arrived, the same
+        # clock as TofFrame.timestamp. The grab thread's newest frame is
+        # returned right away, with newer only once a frame arrived after
+        # the one the last call returned.
+        if self.grab_thread is not None:
+            with self.grab_condition:
+                last_count = self.shot_count if newer else 0
+                if not self.grab_condition.wait_for(
+                        lambda: self.grab_count > last_count, timeout):
+                    raise TimeoutError(f'No IR frame within {timeout} s '
+                                       f'({self.grab_error!r})')
+                ir_frame = self.grab_buffers[self.grab_front].copy()
+                timestamp = self.grab_timestamp
+                self.shot_count = self.grab_count
+            return ir_frame, timestamp
+        code, ir_frame = self.ir_cap.read()
+        return ir_frame, time.perf_counter()
+
     def make_view_image(self, ir):
-        ir = ir / 65535
-        max = ir.max()
-        min = ir.min()
-        return (ir - min) / (max - min)
+        # [0, 1] float32 in a buffer reused by the next call, with the
+        # display range following the scene from frame to frame
+        return self.view_engine.make_view_image(ir)
 
     def dispose(self):
+        self.stop_grabbing()
         self.ir_cap.release()
 
 
+# Bayer pixel format -> (row, column) of the red and the blue pixel in the
+# 2x2 pattern, and the OpenCV demosaic code. OpenCV names its Bayer codes
+# after the second row of the pattern, so R G / G B (BayerRG) is
+# COLOR_BayerBG2BGR.
+BAYER_PATTERNS = {
+    'BayerRG16': ((0, 0), (1, 1), 'COLOR_BayerBG2BGR'),
+    'BayerBG16': ((1, 1), (0, 0), 'COLOR_BayerRG2BGR'),
+    'BayerGR16': ((0, 1), (1, 0), 'COLOR_BayerGB2BGR'),
+    'BayerGB16': ((1, 0), (0, 1), 'COLOR_BayerGR2BGR'),
+}
+
+# 'full': demosaic at full resolution
+# 'half': every 2x2 Bayer cell becomes one BGR pixel, no interpolation
+# 'binned': 2x2 binning of same color pixels, then demosaic at half size
+VIS_DEMOSAIC_MODES = ('full', 'half', 'binned')
+
+
 class Vis_Camera():
-    def __init__(self, id=1):
-        vis_devices = self.create_devices_with_tries()
-        self.vis_device = vis_devices[id-1]
-        nodes = self.vis_device.nodemap.get_node(
-            ['Width', 'Height', 'PixelFormat'])
-        nodes['Width'].value = nodes['Width'].max
-        nodes['Height'].value = nodes['Height'].max
-        pixel_format_name = 'BayerRG16'
-        nodes['PixelFormat'].value = pixel_format_name
+    def __init__(self, id=1, backend=None, demosaic_mode='full',
+                 pool_size=4, profile='vis', serial=None, model=None):
+        if demosaic_mode not in VIS_DEMOSAIC_MODES:
+            raise ValueError(f'demosaic_mode must be one of '
+                             f'{VIS_DEMOSAIC_MODES}, not {demosaic_mode}')
+        self.backend = backend if backend is not None else default_backend
+        # the id-th device on the bus, or the id-th with the serial number
+        # and model name, shared with the other cameras of the process
+        self.device_registry = get_device_registry(self.backend.system)
+        self.vis_device = self.device_registry.acquire(
+            id-1, serial=serial, model=model)
+        # full sensor size, BayerRG16 (DeviceProfiles.PROFILES['vis'])
+        profile = get_profile(profile)
+        self.profile_engine = Profile_Engine(self.vis_device)
+        self.profile_engine.apply(profile)
+        self.pixel_format = profile['nodemap']['PixelFormat']
+        self.demosaic_mode = demosaic_mode
+
+        # shoot_vis() copies every frame into raw_frame before the buffer
+        # goes back to the SDK, and demosaics into the next of pool_size
+        # reused output images. An image returned by shoot_vis() stays
+        # valid until pool_size more frames are shot; copy it to keep it.
+        self.pool_size = pool_size
+        self.raw_frame = None
+        self.binned_frame = None
+        self.bin_rows = None
+        self.bin_sums = None
+        self.image_pool = []
+        self.pool_index = 0
 
     def prepare_vis(self):
         vis_frame_buffer = self.vis_device.get_buffer()
@@ -49,33 +412,18 @@ class Vis_Camera():
     def shoot_vis(self):
         vis_frame_buffer = self.vis_device.get_buffer()
         vis_array = self.make_vis_array(vis_frame_buffer)
+        if self.raw_frame is None or self.raw_frame.shape != vis_array.shape:
+            self.raw_frame = np.empty(vis_array.shape, dtype=np.uint16)
+        # the view points into the SDK buffer, it is reused after requeue
+        np.copyto(self.raw_frame, vis_array)
         self.vis_device.requeue_buffer(vis_frame_buffer)
-        return self.demosaic(vis_array)
-
-    def create_devices_with_tries():
-        tries = 0
-        tries_max = 6
-        sleep_time_secs = 10
-        while tries < tries_max:  # Wait for device for 60 seconds
-            devices = system.create_device()
-            if not devices:
-                print(
-                    f'Try {tries+1} of {tries_max}: waiting for {sleep_time_secs} '
-                    f'secs for a device to be connected!')
-                for sec_count in range(sleep_time_secs):
-                    time.sleep(1)
-                    print(f'{sec_count + 1 } seconds passed ',
-                          '.' * sec_count, end='\r')
-                tries += 1
-            else:
-                print(f'Created {len(devices)} device(s)')
-                return devices
-        else:
-            raise Exception(f'No device found! Please connect a device and run '
-                            f'the example again.')
+        return self.demosaic(self.raw_frame, dst=self.next_pooled_image(
+            self.output_shape(self.raw_frame.shape)))
 
     def dispose(self):
-        system.destroy_device()
+        # only this camera's device, the others keep running
+        self.profile_engine.restore()
+        self.device_registry.release(self.vis_device)
 
     def make_vis_array(self, vis_frame_buffer):
         pdata16 = ctypes.cast(vis_frame_buffer.pdata,
@@ -87,54 +435,167 @@ class Vis_Camera():
         vis_array = vis_nparray_reshaped
         return vis_array
 
-    def demosaic(self, frame):
-        frame = cv2.cvtColor(frame, cv2.COLOR_BayerBG2BGR)
-        return frame
+    def output_shape(self, raw_shape):
+        height, width = raw_shape
+        if self.demosaic_mode == 'full':
+            return (height, width, 3)
+        if self.demosaic_mode == 'binned':
+            return (height // 4 * 2, width // 4 * 2, 3)
+        return (height // 2, width // 2, 3)
+
+    def next_pooled_image(self, shape):
+        if not self.image_pool or self.image_pool[0].shape != shape:
+            self.image_pool = [np.empty(shape, dtype=np.uint16)
+                               for _ in range(self.pool_size)]
+        image = self.image_pool[self.pool_index % self.pool_size]
+        self.pool_index += 1
+        return image
+
+    def demosaic(self, frame, dst=None):
+        # BayerRG16 frame -> BGR uint16 image, written to dst if given
+        red, blue, code_name = BAYER_PATTERNS[self.pixel_format]
+        code = getattr(cv2, code_name)
+        if self.demosaic_mode == 'full':
+            if dst is None:
+                return cv2.cvtColor(frame, code)
+            return cv2.cvtColor(frame, code, dst=dst)
+
+        if dst is None:
+            dst = np.empty(self.output_shape(frame.shape), dtype=np.uint16)
+        if self.demosaic_mode == 'half':
+            self.demosaic_half(frame, red, blue, dst)
+        else:
+            return cv2.cvtColor(self.bin_2x2(frame), code, dst=dst)
+        return dst
+
+    def demosaic_half(self, frame, red, blue, dst):
+        height, width = dst.shape[:2]
+        cells = frame[:height * 2, :width * 2].reshape(height, 2, width, 2)
+        greens = [(row, column) for row in (0, 1) for column in (0, 1)
+                  if (row, column) not in (red, blue)]
+        dst[:, :, 2] = cells[:, red[0], :, red[1]]
+        dst[:, :, 0] = cells[:, blue[0], :, blue[1]]
+        # mean of the two greens without overflowing 16 bits
+        green_1 = cells[:, greens[0][0], :, greens[0][1]]
+        green_2 = cells[:, greens[1][0], :, greens[1][1]]
+        np.right_shift(green_1, 1, out=dst[:, :, 1])
+        dst[:, :, 1] += green_2 >> 1
+        dst[:, :, 1] += green_1 & green_2 & 1
+
+    def bin_2x2(self, frame):
+        # Mean of each 2x2 group of same color pixels, a Bayer frame with
+        # the same pattern at half the width and height
+        height, width = frame.shape
+        height -= height % 4
+        width -= width % 4
+        if self.binned_frame is None or self.binned_frame.shape != (
+                height // 2, width // 2):
+            self.binned_frame = np.empty((height // 2, width // 2),
+                                         dtype=np.uint16)
+            self.bin_rows = np.empty((height // 4, 2, width), dtype=np.uint32)
+            self.bin_sums = np.empty((height // 4, 2, width // 4, 2),
+                                     dtype=np.uint32)
+        # rows 4 * i + 2 * a + p: add the two a of each row pair first
+        rows = frame[:height, :width].reshape(height // 4, 2, 2, width)
+        np.add(rows[:, 0], rows[:, 1], out=self.bin_rows, dtype=np.uint32)
+        # then columns 4 * j + 2 * b + q, the two b
+        columns = self.bin_rows.reshape(height // 4, 2, width // 4, 2, 2)
+        sums = self.bin_sums
+        np.add(columns[:, :, :, 0], columns[:, :, :, 1], out=sums)
+        sums >>= 2
+        np.copyto(self.binned_frame.reshape(sums.shape), sums,
+                  casting='unsafe')
+        return self.binned_frame
+
+
+class Device_Clock():
+    # Maps the device timestamps of the buffers (buffer.timestamp_ns, taken
+    # at capture) to the host time.perf_counter() clock the IR frames use.
+    # A frame arrives some transfer time after it was taken, so the
+    # smallest arrival - capture difference of the last `window` frames is
+    # taken as the offset of the clocks; the window follows their drift.
+    # Buffers without a device timestamp get their arrival time.
+
+    def __init__(self, window=256):
+        self.offsets = collections.deque(maxlen=window)
+        self.last_capture = None
+
+    def to_host(self, buffer):
+        arrival = time.perf_counter()
+        timestamp_ns = getattr(buffer, 'timestamp_ns', 0)
+        if not timestamp_ns:
+            return arrival
+        capture = timestamp_ns * 1e-9
+        if self.last_capture is not None and capture < self.last_capture:
+            # the device clock was reset
+            self.offsets.clear()
+        self.last_capture = capture
+        self.offsets.append(arrival - capture)
+        return capture + min(self.offsets)
 
 
 class Tof_Camera():
-    def __init__(self, id=1):
-        tof_devices = self.create_devices_with_tries()
-        self.tof_device = tof_devices[id-1]
+    def __init__(self, id=1, backend=None, profile='tof', serial=None,
+                 model=None):
+        self.backend = backend if backend is not None else default_backend
+        # the id-th device on the bus, or the id-th with the serial number
+        # and model name, shared with the other cameras of the process
+        self.device_registry = get_device_registry(self.backend.system)
+        self.tof_device = self.device_registry.acquire(
+            id-1, serial=serial, model=model, tries_max=1)
+        # operating mode -> (scales, offsets) of the A, B and C coordinates
+        self.coordinate_calibrations = {}
         self.isHelios2 = True
         self.validate_device(self.tof_device)
-
-        # Get device stream nodemap
-        tl_stream_nodemap = self.tof_device.tl_stream_nodemap
-
-        # Enable stream auto negotiate packet size
-        tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
-
-        # Enable stream packet resend
-        tl_stream_nodemap['StreamPacketResendEnable'].value = True
-
-        # Store nodes' initial values ---------------------------------------------
-        nodemap = self.tof_device.nodemap
-
-        # get node values that will be changed in order to return their values at
-        # the end of the example
-        pixelFormat_initial = nodemap['PixelFormat'].value
-        operating_mode_initial = nodemap['Scan3dOperatingMode'].value
+        # frame timestamps are capture times, not arrival times
+        self.device_clock = Device_Clock()
 
         # Set nodes --------------------------------------------------------------
-        # - pixelformat to Coord3D_ABCY16
-        # - 3D operating mode to Distance1500mm
+        # stream packet size negotiation and resend, pixelformat
+        # Coord3D_ABCY16 and the 3D operating mode (DeviceProfiles.PROFILES).
+        # Only nodes with other values are written, dispose() restores them.
         print('\nSettings nodes:')
-        pixel_format = PixelFormat.Coord3D_ABCY16  # unsigned data
-        print(f'\tSetting pixelformat to { pixel_format.name}')
-        nodemap.get_node('PixelFormat').value = pixel_format
-
-        print('\tSetting 3D operating mode')
-        if self.isHelios2 is True:
-            nodemap['Scan3dOperatingMode'].value = 'Distance3000mmSingleFreq'
-        else:
-            nodemap['Scan3dOperatingMode'].value = 'Distance1500mm'
-
-        # Get node values ---------------------------------------------------------
-        # get z coordinate scale in order to convert z values to mm
-        print('Get z coordinate scale from nodemap')
-        nodemap["Scan3dCoordinateSelector"].value = "CoordinateC"
-        self.scale_z = nodemap["Scan3dCoordinateScale"].value
+        profile = get_profile(profile)
+        if self.isHelios2 is not True:
+            profile['nodemap']['Scan3dOperatingMode'] = 'Distance1500mm'
+        self.profile_engine = Profile_Engine(self.tof_device)
+        self.profile_engine.apply(profile)
+        self.set_operating_mode(profile['nodemap']['Scan3dOperatingMode'])
+
+    def set_operating_mode(self, operating_mode, color_borders=None):
+        self.profile_engine.set('Scan3dOperatingMode', operating_mode)
+        self.operating_mode = operating_mode
+
+        # the coordinate scales and offsets convert x, y and z values to mm,
+        # they depend on the operating mode and are only read once for each
+        if operating_mode not in self.coordinate_calibrations:
+            self.coordinate_calibrations[operating_mode] = \
+                self.read_coordinate_calibration()
+        self.scales, self.offsets = \
+            self.coordinate_calibrations[operating_mode]
+        self.scale_x, self.scale_y, self.scale_z = self.scales
+        self.offset_x, self.offset_y, self.offset_z = self.offsets
+
+        # heatmap colors span the range of the operating mode unless other
+        # borders are given. The color tables are cached per scale and
+        # borders so they are only rebuilt when one of them changes.
+        if color_borders is None:
+            color_borders = get_color_borders_for_operating_mode(
+                operating_mode)
+        self.color_borders = tuple(color_borders)
+
+    def read_coordinate_calibration(self):
+        # ((scale_x, scale_y, scale_z), (offset_x, offset_y, offset_z)) of
+        # the current operating mode
+        print('Get xyz coordinate scales and offsets from nodemap')
+        nodemap = self.tof_device.nodemap
+        scales = []
+        offsets = []
+        for coordinate in ('CoordinateA', 'CoordinateB', 'CoordinateC'):
+            nodemap['Scan3dCoordinateSelector'].value = coordinate
+            scales.append(nodemap['Scan3dCoordinateScale'].value)
+            offsets.append(nodemap['Scan3dCoordinateOffset'].value)
+        return tuple(scales), tuple(offsets)
 
     def validate_device(self, device):
 
@@ -163,10 +624,166 @@ class Tof_Camera():
         if 'HLT' in device_model_name_node:
             device.isHelios2 = True
 
+    def get_frame(self, buffer_3d):
+        # The frame reads the buffer memory directly, it is only valid
+        # until the buffer is requeued
+        return TofFrame.from_buffer(
+            buffer_3d, scales=self.scales, offsets=self.offsets,
+            color_borders=self.color_borders,
+            timestamp=self.device_clock.to_host(buffer_3d))
+
     def generate_buffer(self):
+        # a copy of the next buffer, the device buffer goes straight back.
+        # Destroy it with BufferFactory.destroy() when done.
         buffer_3d = self.tof_device.get_buffer()
+        buffer_copy = arena_buffer.BufferFactory.copy(buffer_3d)
         self.tof_device.requeue_buffer(buffer_3d)
-        return buffer_3d
+        return buffer_copy
+
+    def stream(self, n_buffers=4, frame_period=None, late_factor=1.5,
+               hold_timeout=0.0):
+        # Keeps n_buffers device buffers in flight and yields a TofFrame
+        # for each one. A frame stays valid until frame.release() (or the
+        # end of a "with frame:" block) gives its buffer back, so release
+        # frames as soon as they are processed or copied. The device needs
+        # one buffer to fill: when n_buffers - 1 frames are held, the next
+        # frame waits up to hold_timeout seconds for one to be released
+        # (from another thread), then the oldest held frame is copied out
+        # of its buffer (frame.detach()) so the buffer can go back. A
+        # frame is never given back to the device while the caller
+        # still reads it, the same happens to held frames when the stream
+        # ends.
+        #
+        # self.stream_stats counts the frames, the frames the device
+        # dropped (gaps in frame_id), incomplete buffers, late frames
+        # (arriving more than late_factor frame periods after the one
+        # before) and the held frames copied out of their buffers. Without
+        # a frame_period it is estimated from the arrival times.
+        if n_buffers < 2:
+            raise ValueError(f'n_buffers must be at least 2, not '
+                             f'{n_buffers}')
+        stats = self.stream_stats = {
+            'frames': 0,
+            'dropped': 0,
+            'incomplete': 0,
+            'late': 0,
+            'held': 0,
+            'detached': 0,
+        }
+        # id(buffer) -> (buffer, frame) in the order the frames were
+        # yielded, frames may be released from other threads
+        held_frames = collections.OrderedDict()
+        held_condition = threading.Condition()
+        last_frame_id = None
+        last_timestamp = None
+        period_estimate = frame_period
+
+        def make_release(buffer_3d):
+            def release():
+                with held_condition:
+                    if held_frames.pop(id(buffer_3d), None) is None:
+                        return
+                    self.tof_device.requeue_buffer(buffer_3d)
+                    stats['held'] = len(held_frames)
+                    held_condition.notify_all()
+            return release
+
+        def detach_oldest():
+            # called with held_condition held
+            buffer_3d, frame = held_frames.popitem(last=False)[1]
+            frame.detach()
+            self.tof_device.requeue_buffer(buffer_3d)
+            stats['held'] = len(held_frames)
+            stats['detached'] += 1
+
+        with self.tof_device.start_stream(n_buffers):
+            try:
+                while True:
+                    with held_condition:
+                        if not held_condition.wait_for(
+                                lambda: len(held_frames) < n_buffers - 1,
+                                hold_timeout):
+                            detach_oldest()
+
+                    buffer_3d = self.tof_device.get_buffer()
+                    frame = self.get_frame(buffer_3d)
+                    frame._release_callback = make_release(buffer_3d)
+                    with held_condition:
+                        held_frames[id(buffer_3d)] = (buffer_3d, frame)
+                        stats['held'] = len(held_frames)
+
+                    stats['frames'] += 1
+                    if getattr(buffer_3d, 'is_incomplete', False):
+                        stats['incomplete'] += 1
+                    if frame.frame_id is not None:
+                        if last_frame_id is not None:
+                            stats['dropped'] += max(
+                                0, frame.frame_id - last_frame_id - 1)
+                        last_frame_id = frame.frame_id
+                    if last_timestamp is not None:
+                        interval = frame.timestamp - last_timestamp
+                        if period_estimate is None:
+                            period_estimate = interval
+                        elif interval > late_factor * period_estimate:
+                            stats['late'] += 1
+                        if frame_period is None:
+                            # slow moving average so one late frame does
+                            # not hide the next
+                            period_estimate += 0.1 * (interval
+                                                      - period_estimate)
+                    last_timestamp = frame.timestamp
+
+                    yield frame
+            finally:
+                # frames still held by the caller keep a copy of their
+                # data, their buffers go back before the stream stops
+                with held_condition:
+                    while held_frames:
+                        detach_oldest()
+
+    def shoot(self):
+        # get_buffer would timeout or return 1 buffers
+        buffer_3d = self.tof_device.get_buffer()
+
+        # copy the data out so the buffer can go straight back to the
+        # device, the frame can then be saved later or on another thread
+        frame = self.get_frame(buffer_3d).copy()
+
+        # Requeue the chunk data buffers
+        self.tof_device.requeue_buffer(buffer_3d)
+        return frame
+
+    def shoot_points(self, filter_points=True):
+        # (N, 3) float32 points in mm and their (N,) intensities, read from
+        # the buffer before it is requeued without copying the whole frame
+        buffer_3d = self.tof_device.get_buffer()
+        points, intensity = self.get_frame(buffer_3d).points(filter_points)
+        self.tof_device.requeue_buffer(buffer_3d)
+        return points, intensity
+
+    def shoot_raw(self, archive, sensor='tof1', frame_number=None,
+                  writer=None):
+        # Raw dump capture: one copy of the ABCY16 data out of the device
+        # buffer and one append to a SessionArchive.Session_Archive, with
+        # the scales, offsets and operating mode needed to render it later
+        # (Session_Archive_Reader.export() or convert_session.py). With an
+        # Async_Writer the append happens on its threads.
+        buffer_3d = self.tof_device.get_buffer()
+        frame = self.get_frame(buffer_3d)
+        raw_array = frame.array.copy()
+        self.tof_device.requeue_buffer(buffer_3d)
+
+        args = (sensor, raw_array, frame_number, frame.timestamp,
+                self.get_metadata(frame))
+        if writer is None:
+            return archive.append(*args)
+        writer.submit(archive.append, *args)
+        return frame_number
+
+    def get_metadata(self, frame):
+        metadata = frame.get_metadata()
+        metadata['operating_mode'] = self.operating_mode
+        return metadata
 
     def shoot_save(self, filename):
         print(f'\nStream started with 1 buffer')
@@ -176,82 +793,37 @@ class Tof_Camera():
         buffer_3d = self.tof_device.get_buffer()
         print('\tbuffer received')
 
-        # JPG FILE (2D heat map) -------------------------------------
-
-        print('\t\tCreating BGR8 array from buffer')
-        array_BGR8_for_jpg = self.get_a_BGR8_distance_heatmap_ctype_array(buffer_3d,
-                                                                          self.scale_z)
-        uint8_ptr = ctypes.POINTER(ctypes.c_ubyte)
-        ptr_array_BGR8_for_jpg = uint8_ptr(array_BGR8_for_jpg)
-        array_BGR8_for_jpg_size_in_bytes = len(array_BGR8_for_jpg) * 8
-        heat_buffer = BufferFactory.create(ptr_array_BGR8_for_jpg,
-                                           array_BGR8_for_jpg_size_in_bytes,
-                                           buffer_3d.width,
-                                           buffer_3d.height,
-                                           PixelFormat.BGR8)
-
-        # create an image writer
-        # The writer, optionally, can take width, height, and bits per pixel
-        # of the image(s) it would save. if these arguments are not passed
-        # at run time, the first buffer passed to the Writer.save()
-        # function will configure the writer to the arguments buffer's width,
-        # height, and bits per pixel
+        # both files are made from the same frame, so the z channel is only
+        # converted once
+        self.save_frame(self.get_frame(buffer_3d), filename)
 
-        # takes the setting of writer from buffer
-        writer_jpg = Writer.from_buffer(heat_buffer)
-        # save function takes a buffer made with BufferFactory that's why
-        # heat_buffer was created though BufferFactory in the previous
-        # steps
-        writer_jpg.save(heat_buffer, filename + ".jpg")
+        # Requeue the chunk data buffers
+        self.tof_device.requeue_buffer(buffer_3d)
 
-        # buffers created with BufferFactory must be destroyed
-        BufferFactory.destroy(heat_buffer)
+    def save_frame(self, frame, filename):
+        # JPG FILE (2D heat map) -------------------------------------
+        print('\t\tCreating BGR8 array from buffer')
+        self.save_heatmap(frame, filename + ".jpg")
 
         # PLY FILE (3D heat map)--------------------------------------
-
         print('\t\tCreating RGB8 array from buffer')
-        array_RGB_colors = self.get_a_RGB_colring_ctype_array(
-            buffer_3d, self.scale_z)
-
-        uint8_ptr = ctypes.POINTER(ctypes.c_ubyte)
-        ptr_array_RGB_colors = uint8_ptr(array_RGB_colors)
-
-        writer_ply = Writer()
-        # save function
-        # buffer :
-        #   buffer to save.
-        # pattern :
-        #   default name for the image is 'image_<count>.jpg' where count
-        #   is a pre-defined tag that gets updated every time a buffer image
-        #   is saved. More custom tags can be added using
-        #   Writer.register_tag() function
-        # kwargs (optional args) ignored if not an .ply image:
-        #   - 'filter_points' default is True.
-        #       Filters NaN points (A = B = C = -32,678)
-        #   - 'is_signed' default is False.
-        #       If pixel format is signed for example PixelFormat.Coord3D_A16s
-        #       then this arg must be passed to the save function else
-        #       the results would not be correct
-        #   - 'scale' default is 0.25.
-        #   - 'offset_a', 'offset_b' and 'offset_c' default to 0.0
-        writer_ply.save(buffer_3d, filename + ".ply",
-                        color=ptr_array_RGB_colors,
-                        filter_points=True)
-
-        # Requeue the chunk data buffers
-        self.tof_device.requeue_buffer(buffer_3d)
+        self.save_ply(frame, filename + ".ply")
 
     def save_image(self, buffer_3d, filename):
-        array_BGR8_for_jpg = self.get_a_BGR8_distance_heatmap_ctype_array(buffer_3d,
-                                                                          self.scale_z)
+        self.save_heatmap(self.get_frame(buffer_3d), filename)
+
+    def save_heatmap(self, frame, filename):
+        array_BGR8_for_jpg = frame.bgr_heatmap
         uint8_ptr = ctypes.POINTER(ctypes.c_ubyte)
-        ptr_array_BGR8_for_jpg = uint8_ptr(array_BGR8_for_jpg)
-        array_BGR8_for_jpg_size_in_bytes = len(array_BGR8_for_jpg) * 8
-        heat_buffer = BufferFactory.create(ptr_array_BGR8_for_jpg,
-                                           array_BGR8_for_jpg_size_in_bytes,
-                                           buffer_3d.width,
-                                           buffer_3d.height,
-                                           PixelFormat.BGR8)
+        ptr_array_BGR8_for_jpg = array_BGR8_for_jpg.ctypes.data_as(uint8_ptr)
+        array_BGR8_for_jpg_size_in_bytes = array_BGR8_for_jpg.nbytes
+        heat_buffer = arena_buffer.BufferFactory.create(
+            ptr_array_BGR8_for_jpg,
+            array_BGR8_for_jpg_size_in_bytes,
+            frame.width,
+            frame.height,
+            arena_enums.PixelFormat.BGR8)
+
         # create an image writer
         # The writer, optionally, can take width, height, and bits per pixel
         # of the image(s) it would save. if these arguments are not passed
@@ -260,43 +832,50 @@ class Tof_Camera():
         # height, and bits per pixel
 
         # takes the setting of writer from buffer
-        writer_jpg = Writer.from_buffer(heat_buffer)
+        writer_jpg = arena_save.Writer.from_buffer(heat_buffer)
         # save function takes a buffer made with BufferFactory that's why
         # heat_buffer was created though BufferFactory in the previous
         # steps
         writer_jpg.save(heat_buffer, filename)
 
         # buffers created with BufferFactory must be destroyed
-        BufferFactory.destroy(heat_buffer)
-
-    def create_devices_with_tries(self):
-        tries = 0
-        tries_max = 1
-        sleep_time_secs = 10
-        while tries < tries_max:  # Wait for device for 60 seconds
-            devices = system.create_device()
-            if not devices:
-                print(
-                    f'Try {tries+1} of {tries_max}: waiting for {sleep_time_secs} '
-                    f'secs for a device to be connected!')
-                for sec_count in range(sleep_time_secs):
-                    time.sleep(1)
-                    print(f'{sec_count + 1 } seconds passed ',
-                          '.' * sec_count, end='\r')
-                tries += 1
-            else:
-                print(f'Created {len(devices)} device(s)')
-                return devices
-        else:
-            raise Exception(f'No device found! Please connect a device and run '
-                            f'the example again.')
+        arena_buffer.BufferFactory.destroy(heat_buffer)
+
+    def save_ply(self, frame, filename, **kwargs):
+        # Points in mm with the frame's coordinate scales and offsets,
+        # colored by distance. Takes 'filter_points' (default True),
+        # 'vertex_type' ('float32' or 'int16') and 'intensity'.
+        #
+        # With any of arena_api Writer.save's own conversion arguments
+        # ('is_signed', 'scale', 'offset_a', 'offset_b', 'offset_c') the
+        # raw values are converted like Writer.save does instead: raw *
+        # scale + offset with scale 0.25 and offsets 0.0 by default.
+        if {'is_signed', 'scale', 'offset_a', 'offset_b',
+                'offset_c'} & kwargs.keys():
+            kwargs.setdefault('filter_points', True)
+            kwargs.setdefault('is_signed', frame.is_signed)
+            return PlyWriter.save_ply(filename, frame.array,
+                                      color=frame.rgb_colors, **kwargs)
+        return frame.save_ply(filename, **kwargs)
 
     def dispose(self):
-        system.destroy_device()
+        # only this camera's device, the others keep running
+        self.profile_engine.restore()
+        self.device_registry.release(self.tof_device)
 
     def get_a_BGR8_distance_heatmap_ctype_array(self, buffer_3d, scale_z):
+        # Kept for callers that need a ctypes array, the pixels come from
+        # the vectorized get_a_BGR8_distance_heatmap_array()
+        array_BGR8 = self.get_a_BGR8_distance_heatmap_array(buffer_3d, scale_z)
+        CustomArrayType = (ctypes.c_byte * array_BGR8.nbytes)
+        return CustomArrayType.from_buffer_copy(array_BGR8)
+
+    def get_a_BGR8_distance_heatmap_array(self, buffer_3d, scale_z):
+        # (height, width, 3) uint8 in BGR order not RGB, this is what the
+        # JPG writers expect
+        return self.get_colors_array(buffer_3d, scale_z, bgr=True)
 
-        # 3D buffer info -------------------------------------------------
+    def get_z_array(self, buffer_3d):
 
         # "Coord3D_ABCY16s" and "Coord3D_ABCY16" pixelformats have 4
         # channels pre pixel. Each channel is 16 bits and they represent:
@@ -304,106 +883,58 @@ class Tof_Camera():
         #   - y postion
         #   - z postion
         #   - intensity
-        # the value can be dynamically calculated this way:
-        #   int(buffer_3d.bits_per_pixel/16) # 16 is the size of each channel
-        Coord3D_ABCY16_channels_per_pixel = buffer_3d_step_size = 4
-
-        # Buffer.pdata is a (uint8, ctypes.c_ubyte) pointer. "Coord3D_ABCY16"
-        # pixelformat has 4 channels, and each channel is 16 bits.
-        # It is easier to deal with Buffer.pdata if it is casted to 16bits
-        # so each channel value is read/accessed easily.
-        # "Coord3D_ABCY16" might be suffixed with "s" to indicate that the data
-        # should be interpereted as signed.
+        Coord3D_ABCY16_channels_per_pixel = 4
+
+        # View Buffer.pdata as a (height, width, 4) array of 16 bit channels
+        # without copying, same cast as the per-pixel loop used
         pdata_16bit = ctypes.cast(
             buffer_3d.pdata, ctypes.POINTER(ctypes.c_int16))
+        abcy_array = np.ctypeslib.as_array(
+            pdata_16bit,
+            (buffer_3d.height, buffer_3d.width,
+             Coord3D_ABCY16_channels_per_pixel))
 
-        number_of_pixels = buffer_3d.width * buffer_3d.height
-
-        # out array info -------------------------------------------------
-
-        BGR8_channels_per_pixel = array_bgr8_step_size = 3  # Blue, Green, Red
-        BGR8_channel_size_bits = 8
-        BGR8_pixel_size_bytes = BGR8_channel_size_bits * BGR8_channels_per_pixel
-        array_BGR8_size_in_bytes = BGR8_pixel_size_bytes * number_of_pixels
+        # The third channel is the z coordinate. This is a strided view,
+        # nothing is read until it is used.
+        return abcy_array[:, :, 2]
 
-        # array to return
-        # c_byte and not c_ubyte because it is signed data
-        CustomArrayType = (ctypes.c_byte * array_BGR8_size_in_bytes)
-        array_BGR8_for_jpg = CustomArrayType()
-
-        # iterate --------------------------------------------------------
-
-        # iterate over two arrays with different internals
-        # buffer_3d  : [x][y][z][a] | [x][y][z][a] | ... (each [] is 16 bit)
-        # buffer_rgp : [b][g][r]    | [b][g][r]    | ... (each [] is 8 bit)
-        buffer_3d_pixel_index = 0
-        array_bgr8_pixel_index = 0
-        for _ in range(number_of_pixels):
-
-            # Isolate the z channel.
-            # In one pixel:
-            #   The first channel is the x coordinate,
-            #   the second channel is the y coordinate,
-            #   the third channel is the z coordinate, and
-            #   the fourth channel is intensity.
-            # The z coordinate is what used to determine the coloring
-            z = pdata_16bit[buffer_3d_pixel_index + 2]
-
-            # Convert z to millimeters
-            #   The z data converts at a specified ratio to mm, so by
-            #   multiplying it by the Scan3dCoordinateScale for CoordinateC,  we
-            #   are able to convert it to mm and can then compare it to the
-            #   maximum distance of 1500mm.
-            z = int(z * scale_z)
-
-            # color respons to the z distance
-            red, green, blue = self.get_rgb_colors_of_point_at_distance(z)
-
-            # fill into the current pixel in BGR order not RGB
-            array_BGR8_for_jpg[array_bgr8_pixel_index] = blue
-            array_BGR8_for_jpg[array_bgr8_pixel_index + 1] = green
-            array_BGR8_for_jpg[array_bgr8_pixel_index + 2] = red
-
-            # next pixel index corresping index
-            buffer_3d_pixel_index += buffer_3d_step_size
-            array_bgr8_pixel_index += array_bgr8_step_size
-
-        return array_BGR8_for_jpg
-
-    def get_rgb_colors_of_point_at_distance(self, z):
+    def get_rgb_colors_of_point_at_distance(self, z, color_borders=None):
 
+        if color_borders is None:
+            color_borders = self.color_borders
         RGB_MIN = 0
         RGB_MAX = 255
-        COLOR_BORDER_RED = 0
-        COLOR_BORDER_YELLOW = 375
-        COLOR_BORDER_GREEN = 750
-        COLOR_BORDER_CYAN = 1125
-        COLOR_BORDER_BLUE = 1500
+        (COLOR_BORDER_RED, COLOR_BORDER_YELLOW, COLOR_BORDER_GREEN,
+         COLOR_BORDER_CYAN, COLOR_BORDER_BLUE) = color_borders
 
         # distance between red and yellow
         if COLOR_BORDER_RED <= z < COLOR_BORDER_YELLOW:
-            yellow_percentage = z / COLOR_BORDER_YELLOW
+            yellow_percentage = ((z - COLOR_BORDER_RED)
+                                 / (COLOR_BORDER_YELLOW - COLOR_BORDER_RED))
             red = RGB_MAX
             green = RGB_MAX * yellow_percentage
             blue = RGB_MIN
 
         # distance between yellow and green
         elif COLOR_BORDER_YELLOW <= z < COLOR_BORDER_GREEN:
-            green_percentage = (z - COLOR_BORDER_YELLOW) / COLOR_BORDER_YELLOW
+            green_percentage = ((z - COLOR_BORDER_YELLOW)
+                                / (COLOR_BORDER_GREEN - COLOR_BORDER_YELLOW))
             red = RGB_MAX - (RGB_MAX * green_percentage)
             green = RGB_MAX
             blue = RGB_MIN
 
         # distance between green and cyan
         elif COLOR_BORDER_GREEN <= z < COLOR_BORDER_CYAN:
-            cyan_percentage = (z - COLOR_BORDER_GREEN) / COLOR_BORDER_YELLOW
+            cyan_percentage = ((z - COLOR_BORDER_GREEN)
+                               / (COLOR_BORDER_CYAN - COLOR_BORDER_GREEN))
             red = RGB_MIN
             green = RGB_MAX
             blue = RGB_MAX * cyan_percentage
 
         # distance between cyan and blue
         elif COLOR_BORDER_CYAN <= z <= COLOR_BORDER_BLUE:
-            blue_percentage = (z - COLOR_BORDER_CYAN) / COLOR_BORDER_YELLOW
+            blue_percentage = ((z - COLOR_BORDER_CYAN)
+                               / (COLOR_BORDER_BLUE - COLOR_BORDER_CYAN))
             red = RGB_MIN
             green = RGB_MAX - (RGB_MAX * blue_percentage)
             blue = RGB_MAX
@@ -415,77 +946,212 @@ class Tof_Camera():
         return int(red), int(green), int(blue)
 
     def get_a_RGB_colring_ctype_array(self, buffer_3d, scale_z):
-
-        # 3D buffer info -------------------------------------------------
-
-        # "Coord3D_ABCY16s" and "Coord3D_ABCY16" pixelformats have 4
-        # channels pre pixel. Each channel is 16 bits and they represent:
-        #   - x position
-        #   - y postion
-        #   - z postion
-        #   - intensity
-        # the value can be dinamically calculated this way:
-        #   int(buffer_3d.bits_per_pixel/16) # 16 is the size of each channel
-        Coord3D_ABCY16_channels_per_pixel = buffer_3d_step_size = 4
-
-        # Buffer.pdata is a (uint8, ctypes.c_ubyte) pointer. "Coord3D_ABCY16"
-        # pixelformat has 4 channels, and each channel is 16 bits.
-        # It is easier to deal with Buffer.pdata if it is casted to 16bits
-        # so each channel value is read/accessed easily.
-        # "Coord3D_ABCY16" might be suffixed with "s" to indicate that the data
-        # should be interpereted as signed.
-        pdata_16bit = ctypes.cast(
-            buffer_3d.pdata, ctypes.POINTER(ctypes.c_int16))
-
-        number_of_pixels = buffer_3d.width * buffer_3d.height
-
-        # out array info -------------------------------------------------
-
-        RGB8_channels_per_pixel = array_rgb8_step_size = 3  # RED, Green, Blue
-        RGB8_channel_size_bits = 8
-        RGB8_pixel_size_bytes = RGB8_channel_size_bits * RGB8_channels_per_pixel
-        array_RGB8_size_in_bytes = RGB8_pixel_size_bytes * number_of_pixels
-
-        # array to return
-        # c_byte and not c_ubyte because it is signed data
-        CustomArrayType = (ctypes.c_byte * array_RGB8_size_in_bytes)
-        array_RGB8_for_ply_coloring = CustomArrayType()
-
-        # iterate --------------------------------------------------------
-
-        # iterate over two arrays with different internals
-        # buffer_3d  : [x][y][z][a] | [x][y][z][a] | ... (each [] is 16 bit)
-        # buffer_rgp : [r][g][b]    | [r][g][b]    | ... (each [] is 8 bit)
-        buffer_3d_pixel_index = 0
-        array_rgb8_pixel_index = 0
-        for _ in range(number_of_pixels):
-
-            # Isolate the z channel.
-            # In one pixel:
-            #   The first channel is the x coordinate,
-            #   the second channel is the y coordinate,
-            #   the third channel is the z coordinate, and
-            #   the fourth channel is intensity.
-            # The z coordinate is what used to determine the coloring
-            z = pdata_16bit[buffer_3d_pixel_index + 2]
-
-            # Convert z to millimeters
-            #   The z data converts at a specified ratio to mm, so by
-            #   multiplying it by the Scan3dCoordinateScale for CoordinateC,  we
-            #   are able to convert it to mm and can then compare it to the
-            #   maximum distance of 1500mm.
-            z = int(z * scale_z)
-
-            # color respons to the z distance
-            red, green, blue = self.get_rgb_colors_of_point_at_distance(z)
-
-            # fill into the current pixel in RGB order not BGR
-            array_RGB8_for_ply_coloring[array_rgb8_pixel_index] = red
-            array_RGB8_for_ply_coloring[array_rgb8_pixel_index + 1] = green
-            array_RGB8_for_ply_coloring[array_rgb8_pixel_index + 2] = blue
-
-            # next pixel index corresping index
-            buffer_3d_pixel_index += buffer_3d_step_size
-            array_rgb8_pixel_index += array_rgb8_step_size
-
-        return array_RGB8_for_ply_coloring
+        # Kept for callers that need a ctypes array, the pixels come from
+        # the vectorized get_a_RGB_colring_array()
+        array_RGB8 = self.get_a_RGB_colring_array(buffer_3d, scale_z)
+        CustomArrayType = (ctypes.c_byte * array_RGB8.nbytes)
+        return CustomArrayType.from_buffer_copy(array_RGB8)
+
+    def get_a_RGB_colring_array(self, buffer_3d, scale_z):
+        # (height, width, 3) uint8 in RGB order
+        return self.get_colors_array(buffer_3d, scale_z, bgr=False)
+
+    def get_colors_array(self, buffer_3d, scale_z, bgr=False):
+
+        # Every raw z value has its color precomputed for this scale and
+        # these color borders, so coloring the frame is a single gather.
+        # The z channel is read as c_int16 like the rest of the class.
+        lut = get_distance_color_lut(scale_z, tuple(self.color_borders),
+                                     bgr=bgr, is_signed=True)
+        z_raw = self.get_z_array(buffer_3d).view(np.uint16)
+        return np.take(lut, z_raw, axis=0)
+
+
+def is_signed_pixel_format(pixel_format):
+    # "Coord3D_ABCY16" might be suffixed with "s" to indicate that the data
+    # should be interpereted as signed
+    name = getattr(pixel_format, 'name', str(pixel_format))
+    return name.endswith('s')
+
+
+class TofFrame():
+    # Coord3D_ABCY16(s) data seen as a (height, width, 4) array of
+    # [x][y][z][intensity]. Derived products are computed on first access
+    # and kept, so a frame is only converted once however many consumers
+    # use it. A frame made with from_buffer() points into the buffer
+    # memory and must not be used after the buffer is requeued, copy()
+    # it to keep it.
+
+    # raw z value of points without a measurement
+    INVALID_Z_UNSIGNED = 65535
+    INVALID_Z_SIGNED = -32768
+
+    def __init__(self, array, pixel_format, scales, offsets=(0.0, 0.0, 0.0),
+                 color_borders=None, buffer_3d=None, frame_id=None,
+                 timestamp=None):
+        self.array = array
+        self.height, self.width = array.shape[:2]
+        self.pixel_format = pixel_format
+        self.is_signed = is_signed_pixel_format(pixel_format)
+        self.scales = tuple(scales)
+        self.offsets = tuple(offsets)
+        if color_borders is None:
+            color_borders = get_color_borders()
+        self.color_borders = tuple(color_borders)
+        self.buffer_3d = buffer_3d
+        self.frame_id = frame_id
+        # host time.perf_counter() when the frame was taken (arrived,
+        # without a device timestamp)
+        self.timestamp = timestamp
+        self._release_callback = None
+
+    @classmethod
+    def from_buffer(cls, buffer_3d, scales, offsets=(0.0, 0.0, 0.0),
+                    color_borders=None, timestamp=None):
+        # view buffer_3d.pdata without copying, timestamped now unless a
+        # timestamp is given
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if is_signed_pixel_format(buffer_3d.pixel_format):
+            ctype = ctypes.c_int16
+        else:
+            ctype = ctypes.c_uint16
+        pdata_16bit = ctypes.cast(buffer_3d.pdata, ctypes.POINTER(ctype))
+        array = np.ctypeslib.as_array(
+            pdata_16bit, (buffer_3d.height, buffer_3d.width, 4))
+        return cls(array, buffer_3d.pixel_format, scales, offsets,
+                   color_borders, buffer_3d=buffer_3d,
+                   frame_id=getattr(buffer_3d, 'frame_id', None),
+                   timestamp=timestamp)
+
+    def copy(self):
+        # frame owning its data, independent of the device buffer
+        return TofFrame(self.array.copy(), self.pixel_format, self.scales,
+                        self.offsets, self.color_borders,
+                        frame_id=self.frame_id, timestamp=self.timestamp)
+
+    def get_metadata(self):
+        # what is needed to make a TofFrame of the raw array again
+        return {
+            'kind': 'tof',
+            'pixel_format': getattr(self.pixel_format, 'name',
+                                    str(self.pixel_format)),
+            'scales': list(self.scales),
+            'offsets': list(self.offsets),
+            'color_borders': list(self.color_borders),
+        }
+
+    def detach(self):
+        # copy the data out of the device buffer, the frame stays valid
+        # after the buffer is requeued and release() does nothing
+        if self.buffer_3d is None:
+            return
+        self.array = self.array.copy()
+        self.buffer_3d = None
+        self._release_callback = None
+
+    def release(self):
+        # give the device buffer back (frames from Tof_Camera.stream()),
+        # the frame must not be used afterwards
+        callback = self._release_callback
+        self._release_callback = None
+        if callback is not None:
+            callback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def z_raw(self):
+        return self.array[:, :, 2]
+
+    @property
+    def intensity(self):
+        return self.array[:, :, 3]
+
+    @functools.cached_property
+    def valid(self):
+        # (height, width) bool, False where the camera had no measurement
+        if self.is_signed:
+            return self.z_raw != self.INVALID_Z_SIGNED
+        return self.z_raw != self.INVALID_Z_UNSIGNED
+
+    @functools.cached_property
+    def z_mm(self):
+        # (height, width) float32
+        z_mm = self.z_raw.astype(np.float32)
+        z_mm *= self.scales[2]
+        z_mm += self.offsets[2]
+        return z_mm
+
+    @functools.cached_property
+    def xyz_mm(self):
+        # (height, width, 3) float32, x and y need their offsets in the
+        # unsigned pixel format to get negative coordinates
+        xyz_mm = self.array[:, :, :3].astype(np.float32)
+        xyz_mm *= np.asarray(self.scales, dtype=np.float32)
+        xyz_mm += np.asarray(self.offsets, dtype=np.float32)
+        return xyz_mm
+
+    @functools.cached_property
+    def rgb_colors(self):
+        # (height, width, 3) uint8 heatmap colors in RGB order (PLY)
+        lut = get_distance_color_lut(self.scales[2], self.color_borders,
+                                     bgr=False, is_signed=self.is_signed,
+                                     offset_z=self.offsets[2])
+        return np.take(lut, self.z_raw.view(np.uint16), axis=0)
+
+    @functools.cached_property
+    def bgr_heatmap(self):
+        # (height, width, 3) uint8 heatmap colors in BGR order (JPG)
+        lut = get_distance_color_lut(self.scales[2], self.color_borders,
+                                     bgr=True, is_signed=self.is_signed,
+                                     offset_z=self.offsets[2])
+        return np.take(lut, self.z_raw.view(np.uint16), axis=0)
+
+    def points(self, filter_points=True):
+        # (N, 3) float32 points in mm (a view of an (N, 4) array) and their
+        # (N,) intensities. With filter_points the points without a
+        # measurement are left out, only the valid raw values are
+        # converted.
+        abcy = np.ascontiguousarray(self.array).reshape(-1, 4)
+        if filter_points:
+            # whole pixels are picked as one 64 bit value each
+            pixels = abcy.view(np.uint64).reshape(-1)
+            abcy = pixels[self.valid.reshape(-1)].view(abcy.dtype).reshape(
+                -1, 4)
+        # converted with the intensity column, contiguous rows are much
+        # faster to scale than the three coordinate columns on their own
+        points = abcy.astype(np.float32)
+        if self.scales[0] == self.scales[1] == self.scales[2]:
+            points *= np.float32(self.scales[0])
+        else:
+            for axis in range(3):
+                points[:, axis] *= np.float32(self.scales[axis])
+        for axis in range(3):
+            if self.offsets[axis]:
+                points[:, axis] += np.float32(self.offsets[axis])
+        return points[:, :3], abcy[:, 3]
+
+    def point_colors(self, filter_points=True):
+        # (N, 3) uint8 RGB colors of the points from points()
+        rgb_colors = self.rgb_colors.reshape(-1, 3)
+        if filter_points:
+            return rgb_colors[self.valid.reshape(-1)]
+        return rgb_colors
+
+    def save_ply(self, filename, filter_points=True, vertex_type='float32',
+                 intensity=False):
+        points, point_intensity = self.points(filter_points)
+        return PlyWriter.save_points_ply(
+            filename, points, color=self.point_colors(filter_points),
+            intensity=point_intensity if intensity else None,
+            vertex_type=vertex_type)
+
+    def depth_stats(self, roi=None, **kwargs):
+        # count, min/max points, mean, percentiles and histogram of the
+        # measured z, see DepthStats.get_depth_stats()
+        return DepthStats.get_depth_stats(self, roi, **kwargs)
@@ -0,0 +1,346 @@
+import concurrent.futures
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from Camera import TofFrame, cv2
+
+'''
+Host-side depth filters for ToF frames
+    Temporal_Filter averages the last `window` frames per pixel instead of
+    the device (Scan3dImageAccumulation, which divides the frame rate the
+    sensor delivers), so the camera can run at full rate:
+
+        temporal_filter = Temporal_Filter(window=4, min_intensity=20)
+        for frame in tof.stream():
+            with frame:
+                smooth_frame = temporal_filter.update(frame)
+
+    Pixels without a measurement or with an intensity below min_intensity
+    are left out of the average of that pixel. The raw frames are kept in
+    a ring with the pixels that were left out set to 0, and the per pixel
+    sums of x, y, z, intensity and z * z are kept as exact integers. Every
+    frame adds its pixels and takes away the ones of the frame leaving the
+    ring, so an update costs the same whatever the window.
+
+    Spatial_Filter smoothes the z plane of single frames while keeping
+    edges, instead of the device (Scan3dSpatialFilterEnable, which cannot
+    be tuned and costs frame time):
+
+        spatial_filter = Spatial_Filter('median', kernel_size=5)
+        spatial_filter = Spatial_Filter('bilateral', sigma_depth=20.0)
+        smooth_frame = spatial_filter.filter(frame)
+
+    The median is taken over the pixels of the window that take part, the
+    lower one of the two middle values for an even count, so it is always a
+    measured depth and never one between two surfaces. Pixels with half of
+    the window or less taking part are kept as they are. Where the whole
+    window takes part this is the OpenCV 16 bit median, the other windows
+    (along the edges of the pixels left out) are sorted with numpy. The
+    bilateral filter runs on the raw z values with the pixels left out set
+    far away in depth, so they get no weight. The frame is filtered in
+    tiles of tile_rows rows (with the rows the kernel needs around them) in
+    a thread pool, OpenCV releases the GIL. x and y of every point are
+    moved along its ray to the filtered z.
+'''
+
+
+class Temporal_Filter():
+    def __init__(self, window=4, min_intensity=0, min_count=1):
+        if window < 1:
+            raise ValueError(f'window must be at least 1, not {window}')
+        self.window = window
+        self.min_intensity = min_intensity
+        # pixels accepted in fewer frames of the window are invalid
+        self.min_count = min_count
+        self.reset()
+
+    def reset(self):
+        self.ring = None
+        self.ring_accepted = None
+        self.start = 0
+        self.length = 0
+        self.frame_format = None
+        self.sums = None
+        self.square_sums = None
+        self.counts = None
+        self.square = None
+        # what the filtered frame takes from the newest frame, stream
+        # frames are not kept as their buffers are given back
+        self.last_frame_info = None
+
+    def set_window(self, window):
+        # keeps the newest frames that fit in the new window
+        if window < 1:
+            raise ValueError(f'window must be at least 1, not {window}')
+        if self.ring is not None:
+            while self.length > window:
+                self.remove_oldest()
+            order = [(self.start + i) % self.window
+                     for i in range(self.length)]
+            ring = np.empty((window,) + self.ring.shape[1:], self.ring.dtype)
+            ring_accepted = np.zeros((window,) + self.ring_accepted.shape[1:],
+                                     dtype=bool)
+            ring[:self.length] = self.ring[order]
+            ring_accepted[:self.length] = self.ring_accepted[order]
+            self.ring = ring
+            self.ring_accepted = ring_accepted
+            self.start = 0
+        self.window = window
+
+    def get_frame_format(self, frame):
+        return (frame.array.shape, frame.array.dtype, frame.is_signed,
+                frame.scales, frame.offsets)
+
+    def allocate(self, frame):
+        height, width = frame.array.shape[:2]
+        self.ring = np.empty((self.window, height, width, 4),
+                             dtype=frame.array.dtype)
+        self.ring_accepted = np.zeros((self.window, height, width),
+                                      dtype=bool)
+        self.start = 0
+        self.length = 0
+        self.frame_format = self.get_frame_format(frame)
+        # x, y, z and intensity, exact for windows of up to 32767 frames
+        self.sums = np.zeros((height, width, 4), dtype=np.int32)
+        self.square_sums = np.zeros((height, width), dtype=np.int64)
+        self.counts = np.zeros((height, width), dtype=np.int32)
+        # z * z of one frame, 16 bit squares fit in 32 bits
+        self.square = np.empty((height, width), dtype=np.int32
+                               if frame.is_signed else np.uint32)
+
+    def accumulate(self, index, sign):
+        # adds (sign 1) or takes away (sign -1) the frame in the ring at
+        # index from the sums, its pixels that were left out are 0
+        operation = np.add if sign > 0 else np.subtract
+        abcy = self.ring[index]
+        operation(self.sums, abcy, out=self.sums)
+        np.square(abcy[:, :, 2], out=self.square,
+                  dtype=self.square.dtype)
+        operation(self.square_sums, self.square, out=self.square_sums)
+        operation(self.counts, self.ring_accepted[index], out=self.counts)
+
+    def remove_oldest(self):
+        self.accumulate(self.start, -1)
+        self.start = (self.start + 1) % self.window
+        self.length -= 1
+
+    def add(self, frame):
+        # adds a frame to the window without making the filtered frame
+        if self.frame_format != self.get_frame_format(frame):
+            # other size, pixel format or operating mode: start again
+            self.allocate(frame)
+        if self.length == self.window:
+            self.remove_oldest()
+        index = (self.start + self.length) % self.window
+        accepted = self.ring_accepted[index]
+        np.copyto(accepted, frame.valid)
+        if self.min_intensity > 0:
+            accepted &= frame.intensity >= self.min_intensity
+        np.copyto(self.ring[index], frame.array)
+        # whole pixels set to 0 as one 64 bit value each
+        pixels = self.ring[index].view(np.uint64)[:, :, 0]
+        np.copyto(pixels, 0, where=~accepted)
+        self.accumulate(index, 1)
+        self.length += 1
+        self.last_frame_info = (frame.pixel_format, frame.color_borders,
+                                frame.frame_id, frame.timestamp)
+
+    def update(self, frame):
+        # adds a frame and returns the filtered frame of the window
+        self.add(frame)
+        return self.get_frame()
+
+    def get_valid(self):
+        return self.counts >= max(self.min_count, 1)
+
+    def get_mean_raw(self, invalid=np.nan):
+        # (height, width, 4) float32 mean raw x, y, z and intensity, invalid
+        # where no frame was accepted (sums of up to 256 16 bit values are
+        # exact in float32)
+        valid = self.get_valid()
+        # 1 / count per pixel, one multiplication of the four sums is
+        # faster than dividing them
+        inverse_counts = np.zeros(self.counts.shape, dtype=np.float32)
+        np.divide(1.0, self.counts, out=inverse_counts, where=valid)
+        mean = self.sums.astype(np.float32)
+        mean *= inverse_counts[:, :, np.newaxis]
+        if invalid != 0:
+            mean[~valid] = invalid
+        return mean
+
+    def get_z_mm(self):
+        # (height, width) float32 mean z in mm, nan where invalid
+        scale_z, offset_z = self.frame_format[3][2], self.frame_format[4][2]
+        return self.get_mean_raw()[:, :, 2] * np.float32(scale_z) + \
+            np.float32(offset_z)
+
+    def get_variance_mm2(self):
+        # (height, width) float32 variance of z in mm^2 over the frames of
+        # the window, nan where invalid
+        counts = self.counts.astype(np.float64)
+        counts[~self.get_valid()] = np.nan
+        mean = self.sums[:, :, 2] / counts
+        variance = self.square_sums / counts - mean * mean
+        np.maximum(variance, 0.0, out=variance)
+        variance *= self.frame_format[3][2] ** 2
+        return variance.astype(np.float32)
+
+    def get_frame(self):
+        # TofFrame of the mean x, y, z and intensity, invalid where no
+        # frame of the window was accepted
+        if self.length == 0:
+            return None
+        pixel_format, color_borders, frame_id, timestamp = \
+            self.last_frame_info
+        _, _, is_signed, scales, offsets = self.frame_format
+        valid = self.get_valid()
+        mean = self.get_mean_raw(invalid=0.0)
+        np.rint(mean, out=mean)
+        array = mean.astype(self.ring.dtype)
+        array[:, :, 2][~valid] = (TofFrame.INVALID_Z_SIGNED if is_signed
+                                  else TofFrame.INVALID_Z_UNSIGNED)
+        return TofFrame(array, pixel_format, scales, offsets, color_borders,
+                        frame_id=frame_id, timestamp=timestamp)
+
+
+SPATIAL_FILTER_METHODS = ('median', 'bilateral')
+
+
+class Spatial_Filter():
+    def __init__(self, method='median', kernel_size=5, sigma_depth=20.0,
+                 sigma_space=2.0, min_intensity=0, tile_rows=64, workers=4):
+        if method not in SPATIAL_FILTER_METHODS:
+            raise ValueError(f'method must be one of '
+                             f'{list(SPATIAL_FILTER_METHODS)}, not {method}')
+        if method == 'median' and kernel_size not in (3, 5):
+            # OpenCV medians of 16 bit images
+            raise ValueError(f'median kernel_size must be 3 or 5, not '
+                             f'{kernel_size}')
+        self.method = method
+        self.kernel_size = kernel_size
+        # bilateral: standard deviations of the depth difference in mm
+        # and of the distance in pixels
+        self.sigma_depth = sigma_depth
+        self.sigma_space = sigma_space
+        self.min_intensity = min_intensity
+        self.tile_rows = tile_rows
+        self.executor = None
+        if workers and workers > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def map(self, function, items):
+        if self.executor is None:
+            return list(map(function, items))
+        return list(self.executor.map(function, items))
+
+    def get_accepted(self, frame):
+        # pixels that take part, with a measurement in front of the camera
+        # and bright enough to trust
+        accepted = frame.valid & (frame.z_raw > 0)
+        if self.min_intensity > 0:
+            accepted &= frame.intensity >= self.min_intensity
+        return accepted
+
+    def filter_median(self, z_raw, accepted):
+        kernel_size = self.kernel_size
+        window_size = kernel_size * kernel_size
+        # the pixels left out sort after every depth
+        z = np.where(accepted, z_raw, 65535).astype(np.uint16)
+        count = cv2.boxFilter(accepted.view(np.uint8), cv2.CV_8U,
+                              (kernel_size, kernel_size), normalize=False,
+                              borderType=cv2.BORDER_CONSTANT)
+        # half of the window or less taken part, the pixel is kept
+        filtered = accepted & (count > window_size // 2)
+        z_filtered = cv2.medianBlur(z, kernel_size).astype(np.float32)
+
+        rows, columns = np.nonzero(filtered & (count < window_size))
+        if len(rows):
+            margin = kernel_size // 2
+            windows = sliding_window_view(
+                np.pad(z, margin, constant_values=65535),
+                (kernel_size, kernel_size))[rows, columns]
+            windows = np.sort(windows.reshape(len(rows), window_size),
+                              axis=-1)
+            rank = (count[rows, columns].astype(np.intp) - 1) // 2
+            z_filtered[rows, columns] = windows[np.arange(len(rows)), rank]
+        return z_filtered, filtered
+
+    def filter_bilateral(self, z_raw, accepted, scale_z):
+        z_filtered = z_raw.astype(np.float32)
+        if not accepted.any():
+            return z_filtered, accepted
+        # 10 sigma in front of the closest pixel has no weight, and the
+        # depth range OpenCV divides into its weight table stays small
+        sigma_raw = self.sigma_depth / scale_z
+        z_filtered[~accepted] = z_filtered[accepted].min() - 10 * sigma_raw
+        z_filtered = cv2.bilateralFilter(z_filtered, self.kernel_size,
+                                         sigma_raw, self.sigma_space)
+        return z_filtered, accepted
+
+    def filter_tile(self, frame, accepted, array, row):
+        # filters rows row..row + tile_rows of frame into array
+        margin = self.kernel_size // 2
+        top = max(row - margin, 0)
+        bottom = min(row + self.tile_rows + margin, frame.height)
+        if self.method == 'median':
+            z_filtered, filtered = self.filter_median(
+                frame.z_raw[top:bottom], accepted[top:bottom])
+        else:
+            z_filtered, filtered = self.filter_bilateral(
+                frame.z_raw[top:bottom], accepted[top:bottom],
+                frame.scales[2])
+        rows = slice(row - top, min(row + self.tile_rows, frame.height) - top)
+        z_filtered = z_filtered[rows]
+        filtered = filtered[rows]
+        abcy = array[row:row + self.tile_rows]
+        z_raw = abcy[:, :, 2]
+
+        # x and y moved along the ray of the point: scaled by the ratio of
+        # the new to the old z in mm
+        scales = np.asarray(frame.scales, dtype=np.float32)
+        offsets = np.asarray(frame.offsets, dtype=np.float32)
+        z_mm = z_raw.astype(np.float32)
+        z_mm *= scales[2]
+        z_mm += offsets[2]
+        ratio = z_filtered * scales[2]
+        ratio += offsets[2]
+        np.divide(ratio, z_mm, out=ratio, where=filtered)
+        for axis in range(2):
+            coordinate = abcy[:, :, axis].astype(np.float32)
+            coordinate *= scales[axis]
+            coordinate += offsets[axis]
+            coordinate *= ratio
+            coordinate -= offsets[axis]
+            coordinate /= scales[axis]
+            np.rint(coordinate, out=coordinate)
+            np.copyto(abcy[:, :, axis], coordinate, casting='unsafe',
+                      where=filtered)
+        np.rint(z_filtered, out=z_filtered)
+        np.copyto(z_raw, z_filtered, casting='unsafe', where=filtered)
+
+    def filter(self, frame):
+        # TofFrame with the filtered z (x, y moved along the rays), pixels
+        # that did not take part have no measurement
+        accepted = self.get_accepted(frame)
+        array = frame.array.copy()
+        array[:, :, 2][~accepted] = (
+            TofFrame.INVALID_Z_SIGNED if frame.is_signed
+            else TofFrame.INVALID_Z_UNSIGNED)
+        self.map(lambda row: self.filter_tile(frame, accepted, array, row),
+                 range(0, frame.height, self.tile_rows))
+        return TofFrame(array, frame.pixel_format, frame.scales,
+                        frame.offsets, frame.color_borders,
+                        frame_id=frame.frame_id, timestamp=frame.timestamp)
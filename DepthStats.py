@@ -0,0 +1,151 @@
+import collections
+
+import numpy as np
+
+'''
+Depth statistics of ToF frames
+    get_depth_stats(frame) summarizes the measured depth of a
+    Camera.TofFrame, or of a region of interest (x, y, width, height) in
+    pixels:
+
+        count        pixels with a measurement (valid and z > 0)
+        pixels       pixels in the region
+        min, max     closest and furthest point: x, y, z in mm, intensity,
+                     row and column
+        mean         mean z in mm
+        percentiles  {percentile: z in mm}, linear interpolation like
+                     np.percentile
+        histogram    counts of z in the fixed bins histogram_edges (mm,
+                     each bin [low, high)), by default 64 bins over the
+                     color range of the operating mode
+
+    Raw z values are 16 bit integers, so everything except the min/max
+    positions comes from one bincount of the raw values of the region.
+
+    Depth_Monitor keeps the statistics of a few regions for every frame of
+    a stream.
+'''
+
+DEFAULT_PERCENTILES = (5, 50, 95)
+DEFAULT_HISTOGRAM_BINS = 64
+
+
+def get_roi(array, roi):
+    if roi is None:
+        return array
+    x, y, width, height = roi
+    return array[y:y + height, x:x + width]
+
+
+def get_point(frame, roi, row, column):
+    x, y = (roi[0], roi[1]) if roi is not None else (0, 0)
+    abcy = frame.array[y + row, x + column]
+    return {
+        'x': float(abcy[0] * frame.scales[0] + frame.offsets[0]),
+        'y': float(abcy[1] * frame.scales[1] + frame.offsets[1]),
+        'z': float(abcy[2] * frame.scales[2] + frame.offsets[2]),
+        'intensity': int(abcy[3]),
+        'row': y + row,
+        'column': x + column,
+    }
+
+
+def get_depth_stats(frame, roi=None, percentiles=DEFAULT_PERCENTILES,
+                    histogram_bins=DEFAULT_HISTOGRAM_BINS,
+                    histogram_range=None):
+    scale_z = frame.scales[2]
+    offset_z = frame.offsets[2]
+    z_raw = get_roi(frame.z_raw, roi)
+    measured = get_roi(frame.valid, roi) & (z_raw > 0)
+    if histogram_range is None:
+        histogram_range = (0.0, frame.color_borders[-1])
+    histogram_edges = np.linspace(histogram_range[0], histogram_range[1],
+                                  histogram_bins + 1)
+
+    # number of pixels with each raw z value up to the largest one, z > 0
+    # so signed data fits in the same 0..65535 range
+    counts = np.bincount(z_raw[measured].view(np.uint16))
+    cumulative = np.cumsum(counts)
+    count = int(cumulative[-1]) if len(cumulative) else 0
+    stats = {
+        'count': count,
+        'pixels': z_raw.size,
+        'min': None,
+        'max': None,
+        'mean': None,
+        'percentiles': {percentile: None for percentile in percentiles},
+        'histogram': np.zeros(histogram_bins, dtype=np.int64),
+        'histogram_edges': histogram_edges,
+    }
+    if count == 0:
+        return stats
+
+    raw_values = np.flatnonzero(counts)
+    min_raw = raw_values[0]
+    max_raw = raw_values[-1]
+    # first pixel with the min / max value, like a scan in row order
+    for name, raw in (('min', min_raw), ('max', max_raw)):
+        row, column = np.unravel_index(
+            np.argmax((z_raw == raw) & measured), z_raw.shape)
+        stats[name] = get_point(frame, roi, row, column)
+
+    mean_raw = np.dot(raw_values, counts[raw_values]) / count
+    stats['mean'] = float(mean_raw * scale_z + offset_z)
+
+    for percentile in percentiles:
+        rank = percentile / 100 * (count - 1)
+        low = np.searchsorted(cumulative, np.floor(rank), side='right')
+        high = np.searchsorted(cumulative, np.ceil(rank), side='right')
+        raw = low + (high - low) * (rank - np.floor(rank))
+        stats['percentiles'][percentile] = float(raw * scale_z + offset_z)
+
+    # raw values r in the bin of [low, high) mm: ceil(low) <= r < ceil(high)
+    edge_indexes = np.clip(np.ceil((histogram_edges - offset_z) / scale_z),
+                           0, len(counts)).astype(np.int64)
+    below = np.concatenate(([0], cumulative))
+    stats['histogram'] = np.diff(below[edge_indexes])
+    return stats
+
+
+def format_depth_stats(stats):
+    if stats['count'] == 0:
+        return f'no depth in {stats["pixels"]} pixels'
+    percentiles = ', '.join(f'p{percentile} {z:.0f}'
+                            for percentile, z in stats['percentiles'].items())
+    return (f'{stats["count"]}/{stats["pixels"]} px, '
+            f'min {stats["min"]["z"]:.0f} mm, mean {stats["mean"]:.0f} mm, '
+            f'max {stats["max"]["z"]:.0f} mm, {percentiles}')
+
+
+class Depth_Monitor():
+    '''
+    Depth statistics of named regions for every frame of a stream:
+
+        monitor = Depth_Monitor({'all': None, 'center': (280, 200, 80, 80)})
+        for frame in tof.stream():
+            with frame:
+                stats = monitor.update(frame)
+
+    The statistics of the last `history` frames of each region are kept.
+    '''
+
+    def __init__(self, rois=None, history=30, **stats_kwargs):
+        self.rois = dict(rois) if rois is not None else {'all': None}
+        self.stats_kwargs = stats_kwargs
+        self.histories = {name: collections.deque(maxlen=history)
+                          for name in self.rois}
+
+    def update(self, frame):
+        # region name -> stats of this frame
+        frame_stats = {}
+        for name, roi in self.rois.items():
+            stats = get_depth_stats(frame, roi, **self.stats_kwargs)
+            self.histories[name].append((frame.timestamp, stats))
+            frame_stats[name] = stats
+        return frame_stats
+
+    def mean_depth(self, name):
+        # mean z over the kept frames of the region, None without depth
+        means = [stats['mean'] for _, stats in self.histories[name]
+                 if stats['mean'] is not None]
+        return float(np.mean(means)) if means else None
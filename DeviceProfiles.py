@@ -0,0 +1,179 @@
+import copy
+import time
+
+'''
+Device configuration profiles
+    A profile lists the node values a camera is run with, per nodemap of
+    the arena_api device, in the order they are written:
+
+        {'tl_stream_nodemap': {node: value, ...},
+         'nodemap': {node: value, ...}}
+
+    A value can also be a function of the node, e.g. node_max for the
+    largest Width. Profile_Engine applies profiles to one device: it reads
+    the current values of all the nodes of a profile once, writes only the
+    ones that differ, times every write, and restore() writes the values
+    the device had before back.
+'''
+
+
+def node_max(node):
+    return node.max
+
+
+STREAM_SETTINGS = {
+    'StreamAutoNegotiatePacketSize': True,
+    'StreamPacketResendEnable': True,
+}
+
+PROFILES = {
+    # Helios2 as Tof_Camera uses it, get_buffer() returns the newest frame
+    # and not the oldest queued one
+    'tof': {
+        'tl_stream_nodemap': dict(STREAM_SETTINGS,
+                                  StreamBufferHandlingMode='NewestOnly'),
+        'nodemap': {
+            'PixelFormat': 'Coord3D_ABCY16',  # unsigned data
+            'Scan3dOperatingMode': 'Distance3000mmSingleFreq',
+        },
+    },
+    # set_nodes() of examples/py_helios_smooth_results.py
+    'tof_smooth': {
+        'tl_stream_nodemap': STREAM_SETTINGS,
+        'nodemap': {
+            'PixelFormat': 'Coord3D_ABCY16',
+            'Scan3dOperatingMode': 'Distance3000mmSingleFreq',
+            'ExposureTimeSelector': 'Exp1000Us',
+            'ConversionGain': 'Low',
+            'Scan3dImageAccumulation': 4,
+            'Scan3dSpatialFilterEnable': True,
+            'Scan3dConfidenceThresholdEnable': True,
+        },
+    },
+    # tof_smooth at the full frame rate of the sensor, the frames are
+    # averaged on the host by DepthFilters.Temporal_Filter
+    'tof_host_smooth': {
+        'tl_stream_nodemap': STREAM_SETTINGS,
+        'nodemap': {
+            'PixelFormat': 'Coord3D_ABCY16',
+            'Scan3dOperatingMode': 'Distance3000mmSingleFreq',
+            'ExposureTimeSelector': 'Exp1000Us',
+            'ConversionGain': 'Low',
+            'Scan3dImageAccumulation': 1,
+            'Scan3dSpatialFilterEnable': True,
+            'Scan3dConfidenceThresholdEnable': True,
+        },
+    },
+    # Triton as Vis_Camera uses it
+    'vis': {
+        'nodemap': {
+            'Width': node_max,
+            'Height': node_max,
+            'PixelFormat': 'BayerRG16',
+        },
+    },
+}
+
+
+def get_profile(profile):
+    # copy of a profile by name, or of a profile dict, safe to change
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise KeyError(f'Unknown profile {profile}, one of '
+                           f'{", ".join(PROFILES)}')
+        profile = PROFILES[profile]
+    return copy.deepcopy(profile)
+
+
+def same_value(a, b):
+    # enum values (PixelFormat.Coord3D_ABCY16) equal their names
+    return getattr(a, 'name', a) == getattr(b, 'name', b)
+
+
+class Profile_Engine():
+    def __init__(self, device, verbose=True):
+        self.device = device
+        self.verbose = verbose
+        # (nodemap name, node name) -> value last read or written
+        self.values = {}
+        # (nodemap name, node name) -> value before the first write, in
+        # the order of the writes
+        self.initial_values = {}
+        # (nodemap name, node name, value, seconds) of every write
+        self.writes = []
+        self.skipped = 0
+
+    def get_nodemap(self, nodemap_name):
+        return getattr(self.device, nodemap_name)
+
+    def read(self, names, nodemap_name='nodemap'):
+        # current values of the nodes, each read from the device only once
+        missing = [name for name in names
+                   if (nodemap_name, name) not in self.values]
+        if missing:
+            nodes = self.get_nodemap(nodemap_name).get_node(missing)
+            for name in missing:
+                self.values[(nodemap_name, name)] = nodes[name].value
+        return {name: self.values[(nodemap_name, name)] for name in names}
+
+    def set(self, name, value, nodemap_name='nodemap'):
+        # writes the node if it has another value, True if it was written
+        key = (nodemap_name, name)
+        current = self.read([name], nodemap_name)[name]
+        node = None
+        if callable(value):
+            node = self.get_nodemap(nodemap_name)[name]
+            value = value(node)
+        if same_value(current, value):
+            self.skipped += 1
+            return False
+
+        if node is None:
+            node = self.get_nodemap(nodemap_name)[name]
+        self.initial_values.setdefault(key, current)
+        start = time.perf_counter()
+        node.value = value
+        seconds = time.perf_counter() - start
+        self.values[key] = value
+        self.writes.append((nodemap_name, name, value, seconds))
+        if self.verbose:
+            print(f'\tSetting {name} to {getattr(value, "name", value)} '
+                  f'({seconds * 1000:.1f} ms)')
+        return True
+
+    def apply(self, profile):
+        # profile name or dict, returns the number of nodes written
+        profile = get_profile(profile)
+        written = 0
+        count = 0
+        for nodemap_name, nodes in profile.items():
+            self.read(list(nodes), nodemap_name)
+            for name, value in nodes.items():
+                written += self.set(name, value, nodemap_name)
+                count += 1
+        if self.verbose:
+            print(f'\t{written} node(s) written, {count - written} already '
+                  f'set')
+        return written
+
+    def restore(self):
+        # the values from before the first write of each node, written
+        # back in reverse order, the last change is undone first
+        for (nodemap_name, name), value in reversed(
+                list(self.initial_values.items())):
+            if not same_value(self.values.get((nodemap_name, name)), value):
+                self.get_nodemap(nodemap_name)[name].value = value
+                self.values[(nodemap_name, name)] = value
+        self.initial_values = {}
+
+    def write_seconds(self):
+        return sum(seconds for _, _, _, seconds in self.writes)
+
+    def format_stats(self):
+        slowest = max(self.writes, key=lambda write: write[3], default=None)
+        text = (f'{len(self.writes)} write(s) in '
+                f'{self.write_seconds() * 1000:.1f} ms, '
+                f'{self.skipped} skipped')
+        if slowest is not None:
+            text += f', slowest {slowest[1]} {slowest[3] * 1000:.1f} ms'
+        return text
@@ -0,0 +1,122 @@
+import threading
+import time
+
+'''
+Process-wide arena_api device registry
+    system.create_device() enumerates the bus and creates every device,
+    system.destroy_device() destroys all of them. The registry enumerates
+    once and hands the devices out to the cameras:
+
+        registry = get_device_registry(system)
+        device = registry.acquire(serial='223300123')
+        device = registry.acquire(model='HLT')  # first Helios2
+        ...
+        registry.release(device)
+
+    Every acquire() counts a reference, release() destroys the device
+    alone when its last user releases it. When no device is in use any
+    more the remaining ones are destroyed too, and the next acquire()
+    enumerates again.
+'''
+
+
+class Device_Registry():
+    def __init__(self, system):
+        self.system = system
+        self.lock = threading.Lock()
+        self.devices = []
+        # id(device) -> DeviceSerialNumber, DeviceModelName, references
+        self.serials = {}
+        self.models = {}
+        self.references = {}
+        self.enumerations = 0
+
+    def enumerate(self, tries_max=6, sleep_time_secs=10):
+        tries = 0
+        while tries < tries_max:
+            devices = self.system.create_device()
+            if devices:
+                break
+            print(f'Try {tries+1} of {tries_max}: waiting for '
+                  f'{sleep_time_secs} secs for a device to be connected!')
+            for sec_count in range(sleep_time_secs):
+                time.sleep(1)
+                print(f'{sec_count + 1 } seconds passed ',
+                      '.' * sec_count, end='\r')
+            tries += 1
+        else:
+            raise Exception('No device found! Please connect a device and '
+                            'run the example again.')
+        print(f'Created {len(devices)} device(s)')
+
+        self.enumerations += 1
+        self.devices = list(devices)
+        for device in self.devices:
+            nodes = device.nodemap.get_node(['DeviceSerialNumber',
+                                             'DeviceModelName'])
+            self.serials[id(device)] = str(nodes['DeviceSerialNumber'].value)
+            self.models[id(device)] = str(nodes['DeviceModelName'].value)
+            self.references[id(device)] = 0
+
+    def find(self, index=0, serial=None, model=None):
+        # index-th device with the serial number and a model name
+        # containing model
+        matches = [
+            device for device in self.devices
+            if (serial is None or self.serials[id(device)] == str(serial))
+            and (model is None or model in self.models[id(device)])]
+        if index >= len(matches):
+            raise LookupError(
+                f'No device {index + 1} with serial {serial} and model '
+                f'{model}, found: ' + ', '.join(
+                    f'{self.models[id(device)]} {self.serials[id(device)]}'
+                    for device in self.devices))
+        return matches[index]
+
+    def acquire(self, index=0, serial=None, model=None, tries_max=6,
+                sleep_time_secs=10):
+        with self.lock:
+            if not self.devices:
+                self.enumerate(tries_max, sleep_time_secs)
+            device = self.find(index, serial, model)
+            self.references[id(device)] += 1
+            return device
+
+    def release(self, device):
+        with self.lock:
+            if self.references.get(id(device), 0) == 0:
+                return
+            self.references[id(device)] -= 1
+            if self.references[id(device)] > 0:
+                return
+            self.system.destroy_device(device)
+            self.devices.remove(device)
+            self.forget(device)
+            if not any(self.references[id(device)]
+                       for device in self.devices):
+                # nobody uses the rest, enumerate again next time
+                for device in self.devices:
+                    self.system.destroy_device(device)
+                    self.forget(device)
+                self.devices = []
+
+    def forget(self, device):
+        del self.serials[id(device)]
+        del self.models[id(device)]
+        del self.references[id(device)]
+
+    def in_use(self):
+        return [device for device in self.devices
+                if self.references[id(device)]]
+
+
+registries = {}
+registries_lock = threading.Lock()
+
+
+def get_device_registry(system):
+    # the registry of an arena_api system (or a SimBackend.Sim_System)
+    with registries_lock:
+        if id(system) not in registries:
+            registries[id(system)] = Device_Registry(system)
+        return registries[id(system)]
@@ -0,0 +1,166 @@
+import concurrent.futures
+import lzma
+import struct
+import zlib
+
+import numpy as np
+
+'''
+Lossless codec for 16 bit frames
+    Coord3D_ABCY16(s) ToF frames (H, W, 4) and Y16 IR frames (H, W).
+
+    Every channel is coded as its own plane. Each row of a plane is
+    replaced by the differences to the previous pixel of the row (modulo
+    2**16, so signed data round-trips too), the high and low bytes of the
+    differences are split apart, and the result is compressed with zlib or
+    lzma in tiles of tile_rows rows. The tiles are independent, so they are
+    compressed and decompressed in a thread pool (zlib and lzma release the
+    GIL).
+
+    An encoded frame is self-contained: a header, the compressed size of
+    every tile, then the tiles. Any frame can be decoded on its own.
+
+        codec = Frame_Codec('zlib', level=1)
+        data = codec.encode(frame)
+        frame = codec.decode(data, dtype=np.uint16)
+'''
+
+COMPRESSIONS = {
+    # name: (id in the header, default level)
+    'none': (0, 0),
+    'zlib': (1, 1),
+    'lzma': (2, 0),
+}
+
+MAGIC = b'DFC1'
+# magic, compression id, planes, height, width, tile rows
+HEADER = struct.Struct('<4sBBIIH')
+
+
+def delta_rows(plane):
+    # per row differences, the first pixel of each row is kept
+    plane = plane.view(np.uint16)
+    delta = np.empty_like(plane)
+    delta[:, 0] = plane[:, 0]
+    np.subtract(plane[:, 1:], plane[:, :-1], out=delta[:, 1:])
+    return delta
+
+
+def undelta_rows(delta):
+    return np.cumsum(delta, axis=1, dtype=np.uint16)
+
+
+def split_bytes(delta):
+    # high bytes of the differences are mostly 0x00/0xff, they compress
+    # much better kept apart from the low bytes
+    split = np.empty((2,) + delta.shape, dtype=np.uint8)
+    np.bitwise_and(delta, 0xff, out=split[0], casting='unsafe')
+    np.right_shift(delta, 8, out=split[1], casting='unsafe')
+    return split.tobytes()
+
+
+def join_bytes(data, rows, width):
+    split = np.frombuffer(data, dtype=np.uint8).reshape(2, rows, width)
+    delta = split[1].astype(np.uint16)
+    delta <<= 8
+    delta |= split[0]
+    return delta
+
+
+class Frame_Codec():
+    def __init__(self, compression='zlib', level=None, tile_rows=64,
+                 workers=4):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'compression must be one of '
+                             f'{list(COMPRESSIONS)}, not {compression}')
+        self.compression = compression
+        self.compression_id, default_level = COMPRESSIONS[compression]
+        self.level = default_level if level is None else level
+        self.tile_rows = tile_rows
+        self.executor = None
+        if workers and workers > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def map(self, function, items):
+        if self.executor is None:
+            return list(map(function, items))
+        return list(self.executor.map(function, items))
+
+    def compress(self, data):
+        if self.compression == 'zlib':
+            return zlib.compress(data, self.level)
+        if self.compression == 'lzma':
+            return lzma.compress(data, preset=self.level)
+        return data
+
+    def encode(self, frame):
+        frame = np.asarray(frame)
+        if frame.dtype.itemsize != 2 or frame.ndim not in (2, 3):
+            raise ValueError(f'expected a (H, W) or (H, W, C) 16 bit frame, '
+                             f'not {frame.dtype} {frame.shape}')
+        planes = frame[:, :, None] if frame.ndim == 2 else frame
+        height, width, n_planes = planes.shape
+
+        def encode_tile(tile):
+            plane, row = tile
+            rows = planes[row:row + self.tile_rows, :, plane]
+            return self.compress(split_bytes(delta_rows(
+                np.ascontiguousarray(rows))))
+
+        tiles = [(plane, row) for plane in range(n_planes)
+                 for row in range(0, height, self.tile_rows)]
+        encoded = self.map(encode_tile, tiles)
+        sizes = np.array([len(tile) for tile in encoded], dtype='<u4')
+        return b''.join([HEADER.pack(MAGIC, self.compression_id, n_planes,
+                                     height, width, self.tile_rows),
+                         sizes.tobytes()] + encoded)
+
+    def decode(self, data, dtype=np.uint16, out=None):
+        # data is bytes or a uint8 array (e.g. a memmap view of an archive)
+        data = memoryview(np.ascontiguousarray(
+            np.frombuffer(data, dtype=np.uint8)))
+        magic, compression_id, n_planes, height, width, tile_rows = \
+            HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('not an encoded frame')
+        n_tiles = -(-height // tile_rows)
+        sizes = np.frombuffer(data, dtype='<u4', count=n_planes * n_tiles,
+                              offset=HEADER.size)
+        starts = HEADER.size + sizes.nbytes + np.concatenate(
+            ([0], np.cumsum(sizes[:-1], dtype=np.int64)))
+
+        shape = (height, width) if n_planes == 1 else (height, width,
+                                                       n_planes)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        # decoded plane by plane, interleaved into out in one pass at the end
+        planes = np.empty((n_planes, height, width), dtype=np.uint16)
+
+        def decode_tile(k):
+            plane, tile = divmod(k, n_tiles)
+            row = tile * tile_rows
+            rows = min(tile_rows, height - row)
+            tile_data = data[starts[k]:starts[k] + sizes[k]]
+            if compression_id == 1:
+                tile_data = zlib.decompress(tile_data)
+            elif compression_id == 2:
+                tile_data = lzma.decompress(tile_data)
+            planes[plane, row:row + rows] = undelta_rows(
+                join_bytes(tile_data, rows, width))
+
+        self.map(decode_tile, range(n_planes * n_tiles))
+        out.view(np.uint16).reshape(height, width, n_planes)[...] = \
+            planes.transpose(1, 2, 0)
+        return out
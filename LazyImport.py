@@ -0,0 +1,59 @@
+import importlib
+import os
+import sys
+import time
+
+'''
+Lazy module imports
+    cv2 = Lazy_Module('cv2') stands in for the module and imports it on
+    the first attribute access, so e.g. the arena_api SDK is only loaded
+    when a Lucid camera is made and not by offline tools that only import
+    Camera for its frame processing.
+
+    How long each import took is kept in import_timings. With the
+    environment variable IRTOF_IMPORT_TIMING=1 every lazy import is also
+    printed to stderr when it happens.
+'''
+
+IMPORT_TIMING = os.environ.get('IRTOF_IMPORT_TIMING', '') not in ('', '0')
+
+# module name -> seconds its (first) import took
+import_timings = {}
+
+
+def import_timed(name):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    seconds = time.perf_counter() - start
+    if name not in import_timings:
+        import_timings[name] = seconds
+        if IMPORT_TIMING:
+            print(f'import {name}: {seconds * 1000:.1f} ms', file=sys.stderr)
+    return module
+
+
+def format_import_timings():
+    return '\n'.join(f'{name:>24} {seconds * 1000:9.1f} ms'
+                     for name, seconds in import_timings.items())
+
+
+class Lazy_Module():
+    def __init__(self, name):
+        # set through __dict__, __getattr__ only sees missing attributes
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = import_timed(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r}, {state}>'
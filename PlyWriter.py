@@ -0,0 +1,160 @@
+import numpy as np
+
+'''
+Binary PLY writer for Helios point clouds
+    Vectorized replacement for arena_api Writer.save(buffer, 'x.ply', ...)
+    with the same arguments:
+        - filter_points default is True.
+            Leaves out points without a measurement (C = -32768 for
+            signed data, 65535 for unsigned data, the rule of
+            Camera.TofFrame.valid)
+        - is_signed default is False.
+        - scale default is 0.25.
+        - offset_a, offset_b and offset_c default to 0.0
+    Vertices are raw * scale + offset. Colors, if given, are RGB uint8.
+    save_points_ply() writes points that are already in mm, e.g. from
+    Camera.TofFrame.points().
+    vertex_type 'int16' stores the coordinates as whole mm in 16 bit
+    shorts, half the size of 'float32'. PLY has no 16 bit float type, so
+    there is no float16 option.
+'''
+
+VERTEX_TYPES = {
+    # name: (numpy dtype, PLY type)
+    'float32': ('<f4', 'float'),
+    'int16': ('<i2', 'short'),
+}
+
+INVALID_SIGNED = -32768
+INVALID_UNSIGNED = 65535
+
+
+def make_vertices(abcy, color=None, filter_points=True, is_signed=False,
+                  scale=0.25, offset_a=0.0, offset_b=0.0, offset_c=0.0,
+                  vertex_type='float32', intensity=False):
+    # Structured array with one PLY vertex per point, ready to be written.
+    # abcy is a (..., 4) array of raw [x][y][z][intensity] channels.
+    if vertex_type not in VERTEX_TYPES:
+        raise ValueError(f'vertex_type must be one of {list(VERTEX_TYPES)}, '
+                         f'not {vertex_type}')
+    abcy = np.asarray(abcy).reshape(-1, 4)
+    if is_signed:
+        abcy = abcy.view(np.int16)
+    else:
+        abcy = abcy.view(np.uint16)
+    if color is not None:
+        color = np.asarray(color, dtype=np.uint8).reshape(-1, 3)
+
+    if filter_points:
+        invalid_value = INVALID_SIGNED if is_signed else INVALID_UNSIGNED
+        # z alone tells, like TofFrame.valid
+        valid = abcy[:, 2] != invalid_value
+        abcy = abcy[valid]
+        if color is not None:
+            color = color[valid]
+
+    points = abcy[:, :3].astype(np.float32)
+    points *= np.float32(scale)
+    points += np.array([offset_a, offset_b, offset_c], dtype=np.float32)
+    return make_point_vertices(points, color,
+                               abcy[:, 3] if intensity else None,
+                               vertex_type)
+
+
+def make_point_vertices(points, color=None, intensity=None,
+                        vertex_type='float32'):
+    # Structured array of PLY vertices from (N, 3) points in mm, optional
+    # (N, 3) RGB uint8 colors and (N,) intensities
+    if vertex_type not in VERTEX_TYPES:
+        raise ValueError(f'vertex_type must be one of {list(VERTEX_TYPES)}, '
+                         f'not {vertex_type}')
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+    coordinate_dtype, _ = VERTEX_TYPES[vertex_type]
+    fields = [('x', coordinate_dtype), ('y', coordinate_dtype),
+              ('z', coordinate_dtype)]
+    if color is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    if intensity is not None:
+        fields += [('intensity', '<u2')]
+    vertices = np.empty(len(points), dtype=fields)
+
+    if vertex_type == 'int16':
+        points = np.rint(points)
+        np.clip(points, -32768, 32767, out=points)
+    vertices['x'] = points[:, 0]
+    vertices['y'] = points[:, 1]
+    vertices['z'] = points[:, 2]
+    if color is not None:
+        color = np.asarray(color, dtype=np.uint8).reshape(-1, 3)
+        vertices['red'] = color[:, 0]
+        vertices['green'] = color[:, 1]
+        vertices['blue'] = color[:, 2]
+    if intensity is not None:
+        vertices['intensity'] = np.asarray(intensity).reshape(-1).view(
+            np.uint16)
+    return vertices
+
+
+def make_header(vertices, vertex_type='float32'):
+    _, ply_coordinate_type = VERTEX_TYPES[vertex_type]
+    lines = ['ply',
+             'format binary_little_endian 1.0',
+             f'element vertex {len(vertices)}',
+             f'property {ply_coordinate_type} x',
+             f'property {ply_coordinate_type} y',
+             f'property {ply_coordinate_type} z']
+    if 'red' in vertices.dtype.names:
+        lines += ['property uchar red',
+                  'property uchar green',
+                  'property uchar blue']
+    if 'intensity' in vertices.dtype.names:
+        lines += ['property ushort intensity']
+    lines += ['end_header']
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+def write_vertices(filename, vertices, vertex_type='float32'):
+    with open(filename, 'wb') as ply_file:
+        # the vertices go out as one block straight from the array
+        ply_file.write(make_header(vertices, vertex_type))
+        ply_file.write(vertices.data)
+    return len(vertices)
+
+
+def save_ply(filename, abcy, color=None, filter_points=True, is_signed=False,
+             scale=0.25, offset_a=0.0, offset_b=0.0, offset_c=0.0,
+             vertex_type='float32', intensity=False):
+    vertices = make_vertices(abcy, color, filter_points, is_signed, scale,
+                             offset_a, offset_b, offset_c, vertex_type,
+                             intensity)
+    return write_vertices(filename, vertices, vertex_type)
+
+
+def save_points_ply(filename, points, color=None, intensity=None,
+                    vertex_type='float32'):
+    vertices = make_point_vertices(points, color, intensity, vertex_type)
+    return write_vertices(filename, vertices, vertex_type)
+
+
+def load_ply(filename):
+    # Reads a file written by save_ply() back into a structured array
+    with open(filename, 'rb') as ply_file:
+        header_lines = []
+        while True:
+            line = ply_file.readline().decode('ascii').strip()
+            header_lines.append(line)
+            if line == 'end_header':
+                break
+        data = ply_file.read()
+
+    ply_types = {'float': '<f4', 'short': '<i2', 'uchar': 'u1',
+                 'ushort': '<u2'}
+    fields = []
+    count = 0
+    for line in header_lines:
+        words = line.split()
+        if words[:2] == ['element', 'vertex']:
+            count = int(words[2])
+        elif words and words[0] == 'property':
+            fields.append((words[2], ply_types[words[1]]))
+    return np.frombuffer(data, dtype=fields, count=count)
@@ -0,0 +1,274 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from Camera import cv2
+
+'''
+ToF / IR registration
+    Maps depth onto an IR camera and the IR image onto the depth pixels,
+    from the calibration of a ToF / IR pair (e.g. cv2.stereoCalibrate on
+    the shoot4cal.py shots, with the ToF camera first and lengths in mm).
+    The calibration is a JSON file:
+
+        {"tof": {"camera_matrix": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],
+                 "dist_coeffs": [k1, k2, p1, p2, k3],
+                 "size": [width, height]},
+         "ir1": {"camera_matrix": ..., "dist_coeffs": ..., "size": ...,
+                 "rotation": [[...], [...], [...]],  # or a Rodrigues vector
+                 "translation": [tx, ty, tz]},       # ToF to ir1, mm
+         "ir2": {...}}
+
+    Everything that does not depend on the depth is computed once per
+    calibration: the ray of every ToF pixel turned into IR camera
+    coordinates, and a table from undistorted to distorted IR pixels
+    (cv2.initUndistortRectifyMap, with a margin around the image for the
+    points that distortion pulls into it). The tables are cached on disk as
+    .npz files named after a hash of the calibration.
+
+    Per frame the points are z * ray + translation, projected to the
+    undistorted IR image, and looked up in the table with cv2.remap:
+
+        registration = Registration(load_calibration('calibration.json'))
+        projection = registration.project(tof_frame)
+        ir_view = registration.ir_in_depth(ir_frame, projection)
+        depth = registration.depth_in_ir(projection)
+
+    depth_in_ir() scatters the depth to the nearest IR pixels, the
+    closest point wins where several land on one pixel.
+'''
+
+# changes when the tables are computed differently, old cache files are
+# not used any more
+TABLES_VERSION = 1
+DEFAULT_CACHE_DIR = 'registration_cache'
+# IR pixel coordinate of points that do not project into the IR image
+OUTSIDE = -16.0
+
+
+def load_calibration(path):
+    with open(path) as calibration_file:
+        return json.load(calibration_file)
+
+
+def get_rotation_matrix(rotation):
+    rotation = np.asarray(rotation, dtype=np.float64)
+    if rotation.shape == (3, 3):
+        return rotation
+    return cv2.Rodrigues(rotation.reshape(3))[0]
+
+
+def get_calibration_hash(tof, ir, margin):
+    # hash of everything the tables are computed from
+    key = json.dumps({'version': TABLES_VERSION, 'margin': margin,
+                      'tof': tof, 'ir': ir}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def make_tof_rays(tof, rotation):
+    # (3, height, width) float32 direction of the ray of every ToF pixel
+    # in IR camera coordinates, with a z of 1 in ToF coordinates
+    width, height = tof['size']
+    v, u = np.mgrid[0:height, 0:width].astype(np.float64)
+    pixels = np.stack([u.ravel(), v.ravel()], axis=-1)[:, np.newaxis]
+    normalized = cv2.undistortPoints(
+        pixels, np.asarray(tof['camera_matrix'], dtype=np.float64),
+        np.asarray(tof['dist_coeffs'], dtype=np.float64))
+    rays = np.empty((3, height * width))
+    rays[:2] = normalized.reshape(-1, 2).T
+    rays[2] = 1.0
+    return (rotation @ rays).reshape(3, height, width).astype(np.float32)
+
+
+def get_margin(ir):
+    # how far outside of the image the undistorted pixels of its border
+    # are, the table has to reach them
+    width, height = ir['size']
+    camera_matrix = np.asarray(ir['camera_matrix'], dtype=np.float64)
+    u = np.arange(width, dtype=np.float64)
+    v = np.arange(height, dtype=np.float64)
+    border = np.concatenate([
+        np.stack([u, np.zeros(width)], axis=-1),
+        np.stack([u, np.full(width, height - 1.0)], axis=-1),
+        np.stack([np.zeros(height), v], axis=-1),
+        np.stack([np.full(height, width - 1.0), v], axis=-1),
+    ])[:, np.newaxis]
+    undistorted = cv2.undistortPoints(
+        border, camera_matrix, np.asarray(ir['dist_coeffs'], dtype=np.float64),
+        P=camera_matrix).reshape(-1, 2)
+    overshoot = max(0.0, -undistorted.min(),
+                    (undistorted - [width - 1, height - 1]).max())
+    return int(np.ceil(overshoot)) + 2
+
+
+def make_distortion_map(ir, margin):
+    # (height + 2 * margin, width + 2 * margin, 2) float32 distorted IR
+    # pixel of every undistorted IR pixel, shifted by margin
+    width, height = ir['size']
+    camera_matrix = np.asarray(ir['camera_matrix'], dtype=np.float64)
+    table_matrix = camera_matrix.copy()
+    table_matrix[0, 2] += margin
+    table_matrix[1, 2] += margin
+    distortion_map, _ = cv2.initUndistortRectifyMap(
+        camera_matrix, np.asarray(ir['dist_coeffs'], dtype=np.float64),
+        None, table_matrix, (width + 2 * margin, height + 2 * margin),
+        cv2.CV_32FC2)
+    return distortion_map
+
+
+def save_tables(path, tables):
+    # written next to the final file and moved, a cache file is complete
+    # or missing
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    part_path = f'{path}.part'
+    with open(part_path, 'wb') as tables_file:
+        np.savez(tables_file, **tables)
+    os.replace(part_path, path)
+
+
+class Registration():
+    def __init__(self, calibration, ir='ir1', cache_dir=DEFAULT_CACHE_DIR,
+                 margin=None):
+        self.tof = calibration['tof']
+        self.ir = calibration[ir]
+        self.ir_name = ir
+        # pixels of undistorted IR image around the table, by default as
+        # many as the distortion of the calibration needs
+        if margin is None:
+            margin = get_margin(self.ir)
+        self.margin = margin
+        self.tof_width, self.tof_height = self.tof['size']
+        self.ir_width, self.ir_height = self.ir['size']
+        self.translation = np.asarray(self.ir['translation'],
+                                      dtype=np.float32)
+        camera_matrix = np.asarray(self.ir['camera_matrix'],
+                                   dtype=np.float64)
+        # of the undistorted IR image, in the coordinates of the table
+        self.focal = camera_matrix[0, 0], camera_matrix[1, 1]
+        self.center = (camera_matrix[0, 2] + margin,
+                       camera_matrix[1, 2] + margin)
+        self.calibration_hash = get_calibration_hash(self.tof, self.ir,
+                                                     margin)
+
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = os.path.join(
+                cache_dir, f'registration_{self.calibration_hash[:16]}.npz')
+        self.tables_loaded = False
+        self.tables_seconds = 0.0
+        self.load_tables()
+
+    def load_tables(self):
+        start = time.perf_counter()
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            with np.load(self.cache_path) as tables:
+                self.tof_rays = tables['tof_rays']
+                self.distortion_map = tables['distortion_map']
+            self.tables_loaded = True
+        else:
+            self.tof_rays = make_tof_rays(
+                self.tof, get_rotation_matrix(self.ir['rotation']))
+            self.distortion_map = make_distortion_map(self.ir, self.margin)
+            if self.cache_path is not None:
+                save_tables(self.cache_path,
+                            {'tof_rays': self.tof_rays,
+                             'distortion_map': self.distortion_map})
+        self.tables_seconds = time.perf_counter() - start
+
+    def project(self, frame):
+        # (tof height, tof width, 2) float32 distorted IR pixel of every
+        # ToF pixel (OUTSIDE without depth or outside of the IR image) and
+        # (tof height, tof width) float32 depth in IR camera coordinates
+        if (frame.width, frame.height) != (self.tof_width, self.tof_height):
+            raise ValueError(f'frame is {frame.width}x{frame.height}, the '
+                             f'calibration {self.tof_width}x'
+                             f'{self.tof_height}')
+        z_mm = frame.z_mm
+        has_depth = frame.valid & (z_mm > 0)
+        depth = z_mm * self.tof_rays[2]
+        depth += self.translation[2]
+        in_front = has_depth & (depth > 0)
+        outside = ~in_front
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse_depth = np.divide(1.0, depth, dtype=np.float32)
+
+        # undistorted IR pixel: focal * (z * ray + translation) / depth +
+        # center, in the coordinates of the distortion table. Points off
+        # the table would be interpolated with the border value, they are
+        # outside of the IR image.
+        undistorted = []
+        table_size = self.distortion_map.shape[1::-1]
+        for axis in range(2):
+            coordinate = z_mm * self.tof_rays[axis]
+            coordinate += self.translation[axis]
+            coordinate *= inverse_depth
+            coordinate *= np.float32(self.focal[axis])
+            coordinate += np.float32(self.center[axis])
+            outside |= coordinate < 0
+            outside |= coordinate > table_size[axis] - 1
+            undistorted.append(coordinate)
+        for coordinate in undistorted:
+            np.copyto(coordinate, OUTSIDE, where=outside)
+
+        ir_pixels = cv2.remap(self.distortion_map, undistorted[0],
+                              undistorted[1], cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_CONSTANT,
+                              borderValue=(OUTSIDE, OUTSIDE))
+        # the table has the distorted pixels of the whole margin, most of
+        # them are not in the image
+        ir_size = (self.ir_width, self.ir_height)
+        outside = np.zeros(ir_pixels.shape[:2], dtype=bool)
+        for axis in range(2):
+            outside |= ir_pixels[:, :, axis] < 0
+            outside |= ir_pixels[:, :, axis] > ir_size[axis] - 1
+        np.copyto(ir_pixels, OUTSIDE, where=outside[:, :, np.newaxis])
+        return ir_pixels, depth
+
+    def ir_in_depth(self, ir_image, projection):
+        # IR image sampled at every ToF pixel (0 where there is none)
+        ir_pixels, _ = projection
+        return cv2.remap(ir_image, ir_pixels, None, cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def depth_in_ir(self, projection):
+        # (ir height, ir width) float32 depth in mm in IR camera
+        # coordinates, 0 where no point landed
+        ir_pixels, depth = projection
+        column = np.rint(ir_pixels[:, :, 0]).astype(np.int32).ravel()
+        row = np.rint(ir_pixels[:, :, 1]).astype(np.int32).ravel()
+        inside = ((column >= 0) & (column < self.ir_width)
+                  & (row >= 0) & (row < self.ir_height))
+        index = row[inside] * self.ir_width + column[inside]
+        depth_ir = np.full(self.ir_width * self.ir_height, np.inf,
+                           dtype=np.float32)
+        np.minimum.at(depth_ir, index, depth.ravel()[inside])
+        depth_ir[np.isinf(depth_ir)] = 0.0
+        return depth_ir.reshape(self.ir_height, self.ir_width)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compute and cache the registration tables of every IR '
+                    'camera of a ToF / IR calibration')
+    parser.add_argument('calibration', help='calibration JSON file')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIR,
+                        help=f'cache directory, default {DEFAULT_CACHE_DIR}')
+    args = parser.parse_args(argv)
+
+    calibration = load_calibration(args.calibration)
+    for ir in calibration:
+        if ir == 'tof':
+            continue
+        registration = Registration(calibration, ir, args.cache)
+        state = 'loaded' if registration.tables_loaded else 'computed'
+        print(f'{ir}: tables {state} in '
+              f'{registration.tables_seconds * 1000:.0f} ms, '
+              f'{registration.cache_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,423 @@
+import argparse
+import bisect
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from FrameCodec import Frame_Codec
+
+'''
+Session archive
+    Stores the raw frames of a capture session in a few large files
+    instead of one file per frame. For every sensor (tof1, ir1, ...):
+
+        <sensor>.json      dtype and shape of the frames plus metadata
+                           (pixel format, coordinate scales and offsets,
+                           operating mode, ...) of the first frame
+        <sensor>.metadata.jsonl
+                           the metadata from the frame on where it
+                           changed (e.g. another operating mode), one
+                           JSON line per change
+        <sensor>.idx       index, one INDEX_DTYPE record per frame (frame
+                           number, capture time.perf_counter(), chunk,
+                           offset and size of the data)
+        <sensor>.000.bin   frame data, appended back to back. A new chunk
+        <sensor>.001.bin   file is started when one reaches chunk_size.
+
+    Session_Archive appends frames, Session_Archive_Reader reads them back
+    as numpy.memmap views, so any frame or range of frames is read straight
+    from the file without decoding.
+
+    With compression='zlib' or 'lzma' every frame is stored losslessly
+    compressed by FrameCodec.Frame_Codec instead (several times smaller for
+    ToF frames). Frames are still found through the index and decoded one
+    at a time, so reading stays random access.
+
+    Rendering raw sessions to JPG/PLY/TIFF files is done offline:
+
+        python SessionArchive.py cal_data/<session> [out_dir]
+'''
+
+INDEX_DTYPE = np.dtype([
+    ('frame_number', '<u8'),
+    ('timestamp', '<f8'),
+    ('chunk', '<u4'),
+    ('offset', '<u8'),
+    ('nbytes', '<u8'),
+])
+
+DEFAULT_CHUNK_SIZE = 1 << 30  # 1 GiB
+
+
+def chunk_path(path, sensor, chunk):
+    return os.path.join(path, f'{sensor}.{chunk:03d}.bin')
+
+
+def load_index(path, sensor):
+    # Index records of the frames that are completely written. A crash can
+    # leave a record cut off at the end of the index, or (with the data
+    # and the index flushed separately) a record of data that never made
+    # it to its chunk file; the records from there on are left out.
+    index_path = os.path.join(path, f'{sensor}.idx')
+    if not os.path.exists(index_path):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+    index = np.fromfile(index_path, dtype=INDEX_DTYPE, count=count)
+    chunk_sizes = {}
+    for chunk in np.unique(index['chunk']):
+        chunk_file = chunk_path(path, sensor, int(chunk))
+        chunk_sizes[chunk] = (os.path.getsize(chunk_file)
+                              if os.path.exists(chunk_file) else 0)
+    for i, record in enumerate(index):
+        if (record['offset'] + record['nbytes']
+                > chunk_sizes[record['chunk']]):
+            return index[:i]
+    return index
+
+
+def metadata_path(path, sensor):
+    return os.path.join(path, f'{sensor}.metadata.jsonl')
+
+
+def load_metadata_changes(path, sensor):
+    # [(first frame index, metadata), ...] of the changes after the first
+    # frame, a line cut off by a crash is skipped
+    changes = []
+    if not os.path.exists(metadata_path(path, sensor)):
+        return changes
+    with open(metadata_path(path, sensor)) as metadata_file:
+        for line in metadata_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            changes.append((entry['first_frame'], entry['metadata']))
+    return changes
+
+
+def normalize_metadata(metadata):
+    # as it reads back from JSON (lists for tuples, ...), to compare
+    return json.loads(json.dumps(metadata or {}))
+
+
+class Session_Archive():
+    '''
+    Append-only writer, safe to use from several threads
+    '''
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compression=None, level=None, codec_workers=4):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.codec = None
+        if compression is not None:
+            self.codec = Frame_Codec(compression, level=level,
+                                     workers=codec_workers)
+        self.sensors = {}
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_sensor(self, sensor, shape, dtype, metadata=None):
+        with self.lock:
+            self._add_sensor(sensor, shape, dtype, metadata)
+
+    def _add_sensor(self, sensor, shape, dtype, metadata):
+        header_path = os.path.join(self.path, f'{sensor}.json')
+        index_path = os.path.join(self.path, f'{sensor}.idx')
+        header = {
+            'sensor': sensor,
+            'dtype': np.dtype(dtype).str,
+            'shape': list(shape),
+            'compression': self.compression,
+            'metadata': normalize_metadata(metadata),
+        }
+        if os.path.exists(header_path):
+            # appending to an earlier recording of this session
+            with open(header_path) as header_file:
+                old_header = json.load(header_file)
+            if (old_header['dtype'] != header['dtype']
+                    or old_header['shape'] != header['shape']):
+                raise ValueError(f'{sensor} frames in {self.path} are '
+                                 f'{old_header["dtype"]} '
+                                 f'{old_header["shape"]}, not '
+                                 f'{header["dtype"]} {header["shape"]}')
+            if old_header.get('compression') != self.compression:
+                raise ValueError(f'{sensor} frames in {self.path} are '
+                                 f'stored with compression '
+                                 f'{old_header.get("compression")}, not '
+                                 f'{self.compression}')
+            # appended after the last complete record
+            index = load_index(self.path, sensor)
+            with open(index_path, 'ab') as index_file:
+                index_file.truncate(index.nbytes)
+            current_metadata = old_header['metadata']
+            changes = load_metadata_changes(self.path, sensor)
+            if any(start >= len(index) for start, _ in changes):
+                # changes of frames that were not written
+                changes = [(start, metadata) for start, metadata in changes
+                           if start < len(index)]
+                with open(metadata_path(self.path, sensor),
+                          'w') as metadata_file:
+                    for start, metadata in changes:
+                        metadata_file.write(json.dumps(
+                            {'first_frame': start,
+                             'metadata': metadata}) + '\n')
+            if changes:
+                current_metadata = changes[-1][1]
+        else:
+            with open(header_path, 'w') as header_file:
+                json.dump(header, header_file, indent=2)
+            index = np.zeros(0, dtype=INDEX_DTYPE)
+            current_metadata = header['metadata']
+
+        if len(index):
+            chunk = int(index['chunk'][-1])
+            offset = int(index['offset'][-1] + index['nbytes'][-1])
+        else:
+            chunk = 0
+            offset = 0
+        data_file = open(chunk_path(self.path, sensor, chunk), 'ab')
+        data_file.truncate(offset)
+        self.sensors[sensor] = {
+            'header': header,
+            'index_file': open(index_path, 'ab'),
+            'data_file': data_file,
+            'chunk': chunk,
+            'offset': offset,
+            'count': len(index),
+            'metadata': current_metadata,
+        }
+
+    def append(self, sensor, frame, frame_number=None, timestamp=None,
+               metadata=None):
+        # frame is a numpy array, its raw bytes are stored as they are
+        frame = np.ascontiguousarray(frame)
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        data = frame.data
+        if self.codec is not None:
+            # encoded outside the lock, other threads keep appending
+            data = self.codec.encode(frame)
+        with self.lock:
+            if sensor not in self.sensors:
+                self._add_sensor(sensor, frame.shape, frame.dtype, metadata)
+            state = self.sensors[sensor]
+            if metadata is not None:
+                self._update_metadata(state, sensor, metadata)
+            if frame_number is None:
+                frame_number = state['count']
+            self._write(state, sensor, frame_number, timestamp, data,
+                        data.nbytes if self.codec is None else len(data))
+        return frame_number
+
+    def _update_metadata(self, state, sensor, metadata):
+        # metadata other than the last frame's is recorded from this frame
+        # on, for the frames after a mode change or of a resumed session
+        metadata = normalize_metadata(metadata)
+        if metadata == state['metadata']:
+            return
+        with open(metadata_path(self.path, sensor), 'a') as metadata_file:
+            metadata_file.write(json.dumps({'first_frame': state['count'],
+                                            'metadata': metadata}) + '\n')
+        state['metadata'] = metadata
+
+    def _write(self, state, sensor, frame_number, timestamp, data, nbytes):
+        if state['offset'] and state['offset'] + nbytes > self.chunk_size:
+            state['data_file'].close()
+            state['chunk'] += 1
+            state['offset'] = 0
+            state['data_file'] = open(
+                chunk_path(self.path, sensor, state['chunk']), 'ab')
+            # data of frames left out of the index on resume
+            state['data_file'].truncate(0)
+
+        # data first, so an index record never points past the data
+        state['data_file'].write(data)
+        state['data_file'].flush()
+        record = np.array([(frame_number, timestamp, state['chunk'],
+                            state['offset'], nbytes)], dtype=INDEX_DTYPE)
+        state['index_file'].write(record.tobytes())
+        state['index_file'].flush()
+        state['offset'] += nbytes
+        state['count'] += 1
+
+    def close(self):
+        with self.lock:
+            for state in self.sensors.values():
+                state['data_file'].close()
+                state['index_file'].close()
+            self.sensors = {}
+        if self.codec is not None:
+            self.codec.close()
+
+
+class Session_Archive_Reader():
+    def __init__(self, path, codec_workers=4):
+        self.path = path
+        self.headers = {}
+        self.indexes = {}
+        # sensor -> first frame index of every metadata, and the metadata
+        self.metadata_starts = {}
+        self.metadata_values = {}
+        for name in sorted(os.listdir(path)):
+            # <sensor>.json with its <sensor>.idx, other JSON files in the
+            # session directory are not headers
+            if not name.endswith('.json') or not os.path.exists(
+                    os.path.join(path, f'{name[:-len(".json")]}.idx')):
+                continue
+            with open(os.path.join(path, name)) as header_file:
+                header = json.load(header_file)
+            sensor = header['sensor']
+            self.headers[sensor] = header
+            self.indexes[sensor] = load_index(path, sensor)
+            changes = [(0, header['metadata'])] + load_metadata_changes(
+                path, sensor)
+            self.metadata_starts[sensor] = [start for start, _ in changes]
+            self.metadata_values[sensor] = [value for _, value in changes]
+        self._chunks = {}
+        self.codec_workers = codec_workers
+        self._codec = None
+
+    def sensors(self):
+        return list(self.headers)
+
+    def __len__(self):
+        return max((len(index) for index in self.indexes.values()),
+                   default=0)
+
+    def count(self, sensor):
+        return len(self.indexes[sensor])
+
+    def metadata(self, sensor, i=0):
+        # metadata frame i was recorded with
+        i = bisect.bisect_right(self.metadata_starts[sensor], i) - 1
+        return self.metadata_values[sensor][max(i, 0)]
+
+    def frame_dtype(self, sensor):
+        return np.dtype(self.headers[sensor]['dtype'])
+
+    def frame_shape(self, sensor):
+        return tuple(self.headers[sensor]['shape'])
+
+    def compression(self, sensor):
+        return self.headers[sensor].get('compression')
+
+    def codec(self):
+        # the compression of a frame is in its own header, one codec
+        # decodes all sensors
+        if self._codec is None:
+            self._codec = Frame_Codec(workers=self.codec_workers)
+        return self._codec
+
+    def chunk(self, sensor, chunk):
+        # whole chunk file as bytes, mapped once
+        key = (sensor, chunk)
+        if key not in self._chunks:
+            self._chunks[key] = np.memmap(
+                chunk_path(self.path, sensor, chunk), dtype=np.uint8,
+                mode='r')
+        return self._chunks[key]
+
+    def frame(self, sensor, i):
+        # frame i of the sensor as a read only memmap view, or a decoded
+        # copy for compressed sessions
+        record = self.indexes[sensor][i]
+        data = self.chunk(sensor, int(record['chunk']))
+        start = int(record['offset'])
+        data = data[start:start + int(record['nbytes'])]
+        if self.compression(sensor) is not None:
+            return self.codec().decode(data, dtype=self.frame_dtype(sensor))
+        return data.view(self.frame_dtype(sensor)).reshape(
+            self.frame_shape(sensor))
+
+    def frames(self, sensor, start=0, stop=None):
+        # frames start..stop as one (n, *shape) array, a memmap view when
+        # they are stored back to back in one chunk
+        index = self.indexes[sensor][start:stop]
+        if len(index) == 0:
+            return np.zeros((0,) + self.frame_shape(sensor),
+                            dtype=self.frame_dtype(sensor))
+        contiguous = (self.compression(sensor) is None
+                      and np.all(index['chunk'] == index['chunk'][0])
+                      and np.all(index['offset'][1:] == index['offset'][:-1]
+                                 + index['nbytes'][:-1]))
+        if contiguous:
+            data = self.chunk(sensor, int(index['chunk'][0]))
+            first = int(index['offset'][0])
+            last = int(index['offset'][-1] + index['nbytes'][-1])
+            return data[first:last].view(self.frame_dtype(sensor)).reshape(
+                (len(index),) + self.frame_shape(sensor))
+        return np.stack([self.frame(sensor, i)
+                         for i in range(*slice(start, stop).indices(
+                             self.count(sensor)))])
+
+    def frame_number(self, sensor, i):
+        return int(self.indexes[sensor]['frame_number'][i])
+
+    def timestamp(self, sensor, i):
+        return float(self.indexes[sensor]['timestamp'][i])
+
+    def tof_frame(self, sensor, i):
+        # Camera.TofFrame of a ToF frame, with the scales and offsets it
+        # was recorded with
+        from Camera import TofFrame
+
+        metadata = self.metadata(sensor, i)
+        return TofFrame(self.frame(sensor, i),
+                        metadata.get('pixel_format', 'Coord3D_ABCY16'),
+                        scales=metadata.get('scales', (0.25, 0.25, 0.25)),
+                        offsets=metadata.get('offsets', (0.0, 0.0, 0.0)),
+                        color_borders=metadata.get('color_borders'),
+                        frame_id=self.frame_number(sensor, i),
+                        timestamp=self.timestamp(sensor, i))
+
+    def export(self, out_dir, sensors=None):
+        # Writes the frames back as the per frame files shoot4cal.py used
+        # to make: <sensor>_<frame>.jpg/.ply for ToF, .tif for IR
+        import cv2
+
+        os.makedirs(out_dir, exist_ok=True)
+        for sensor in sensors or self.sensors():
+            is_tof = self.metadata(sensor).get('kind') == 'tof'
+            for i in range(self.count(sensor)):
+                name = os.path.join(
+                    out_dir,
+                    f'{sensor}_{str(self.frame_number(sensor, i)).zfill(4)}')
+                if is_tof:
+                    frame = self.tof_frame(sensor, i)
+                    cv2.imwrite(name + '.jpg', frame.bgr_heatmap)
+                    frame.save_ply(name + '.ply')
+                else:
+                    cv2.imwrite(name + '.tif', self.frame(sensor, i))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render a raw session archive to JPG/PLY/TIFF files')
+    parser.add_argument('session', help='session archive directory')
+    parser.add_argument('out_dir', nargs='?',
+                        help='where to write the files, default the '
+                             'session directory')
+    parser.add_argument('--sensors', help='comma separated, default all')
+    args = parser.parse_args(argv)
+
+    reader = Session_Archive_Reader(args.session)
+    sensors = args.sensors.split(',') if args.sensors else None
+    start = time.perf_counter()
+    reader.export(args.out_dir or args.session, sensors)
+    print(f'Exported {len(reader)} frames of {", ".join(reader.sensors())} '
+          f'in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
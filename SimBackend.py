@@ -0,0 +1,367 @@
+import contextlib
+import ctypes
+import time
+
+import numpy as np
+
+'''
+Simulated camera backend
+    Stands in for arena_api and cv2.VideoCapture so Tof_Camera, Vis_Camera
+    and IR_Camera can run without hardware:
+
+        backend = Sim_Backend(num_tof=1, num_ir=2, fps=30)
+        camera_tof = Tof_Camera(id=1, backend=backend)
+        camera_ir = IR_Camera(id=1, backend=backend)
+
+    Frames are synthetic and deterministic for a given seed (a tilted
+    plane with a moving sphere for ToF, gradients for the others), or
+    replayed from recorded arrays when frames= is given. They are delivered
+    at fps frames per second (as fast as asked for when fps is None).
+'''
+
+CAP_DSHOW = 700  # cv2.CAP_DSHOW, the IR cameras open id + CAP_DSHOW
+
+
+class Sim_Node():
+    def __init__(self, value, min=None, max=None):
+        self.value = value
+        self.min = min
+        self.max = max
+
+
+class Sim_Selected_Node():
+    # Node whose value depends on a selector node, like
+    # Scan3dCoordinateScale depends on Scan3dCoordinateSelector
+
+    def __init__(self, selector_node, values):
+        self.selector_node = selector_node
+        self.values = values
+
+    @property
+    def value(self):
+        return self.values[self.selector_node.value]
+
+    @value.setter
+    def value(self, value):
+        self.values[self.selector_node.value] = value
+
+
+class Sim_Nodemap():
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def __getitem__(self, name):
+        # KeyError for unknown nodes, like arena_api
+        return self.nodes[name]
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def get_node(self, names):
+        if isinstance(names, (list, tuple)):
+            return {name: self.nodes[name] for name in names}
+        return self.nodes[names]
+
+
+class Sim_Buffer():
+    def __init__(self, data, pixel_format):
+        self.data = data
+        self.height, self.width = data.shape[:2]
+        self.pixel_format = pixel_format
+        self.bits_per_pixel = 8 * data.itemsize * (data.size // (
+            self.height * self.width))
+        self.pdata = data.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))
+        self.frame_id = 0
+        self.timestamp_ns = 0
+        self.is_incomplete = False
+
+
+class Sim_Frame_Clock():
+    # frame k is due at start + k / fps
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.start = None
+        self.count = 0
+
+    def wait_next(self):
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        if self.fps:
+            due = self.start + self.count / self.fps
+            if due > now:
+                time.sleep(due - now)
+            else:
+                # running late, restart the schedule instead of bursting
+                self.start = now - self.count / self.fps
+        self.count += 1
+        return self.count
+
+
+def make_tof_frame(width, height, frame_number, scale=0.25, offset_xy=-8192.0,
+                   signed=False):
+    # Coord3D_ABCY16(s) frame of a plane tilted away from the camera with a
+    # sphere moving in front of it. Points outside of the scene (top left
+    # corner) have no measurement.
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    focal = 0.9 * width
+    z_mm = 1000.0 + 1500.0 * v / height
+
+    center_u = width * (0.5 + 0.25 * np.sin(frame_number * 0.1))
+    center_v = height * 0.5
+    radius = 0.2 * height
+    distance2 = (u - center_u) ** 2 + (v - center_v) ** 2
+    in_sphere = distance2 < radius ** 2
+    z_mm[in_sphere] = (700.0 - 300.0 * np.sqrt(
+        1.0 - distance2[in_sphere] / radius ** 2))
+
+    x_mm = (u - width / 2) / focal * z_mm
+    y_mm = (v - height / 2) / focal * z_mm
+    intensity = 4000.0 * (1.0 - z_mm / 4000.0) + 100.0 * ((u // 16 + v // 16)
+                                                         % 2)
+
+    frame = np.empty((height, width, 4), dtype=np.int32)
+    if signed:
+        frame[:, :, 0] = x_mm / scale
+        frame[:, :, 1] = y_mm / scale
+    else:
+        frame[:, :, 0] = (x_mm - offset_xy) / scale
+        frame[:, :, 1] = (y_mm - offset_xy) / scale
+    frame[:, :, 2] = z_mm / scale
+    frame[:, :, 3] = intensity
+
+    invalid = (u < width // 8) & (v < height // 8)
+    if signed:
+        frame[invalid, :3] = -32768
+        return np.clip(frame, -32768, 32767).astype(np.int16)
+    frame[invalid, :3] = 65535
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+def make_bayer_rg_frame(width, height, frame_number):
+    # BayerRG16, R G / G B, of a moving color gradient
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    phase = frame_number * 0.05
+    red = 0.5 + 0.5 * np.sin(u / width * 6.0 + phase)
+    green = v / height
+    blue = 0.5 + 0.5 * np.cos(v / height * 6.0 - phase)
+    frame = np.where((v % 2 == 0) & (u % 2 == 0), red,
+                     np.where((v % 2 == 1) & (u % 2 == 1), blue, green))
+    return (frame * 65535).astype(np.uint16)
+
+
+def make_y16_frame(width, height, frame_number, seed=0):
+    # Y16 IR frame, a warm spot drifting over a gradient with sensor noise
+    rng = np.random.default_rng(seed + frame_number)
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    center_u = width * (0.5 + 0.3 * np.cos(frame_number * 0.07))
+    spot = np.exp(-((u - center_u) ** 2 + (v - height / 2) ** 2)
+                  / (0.02 * width * width))
+    frame = 20000 + 8000 * v / height + 20000 * spot
+    frame += rng.normal(0, 200, size=frame.shape)
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+class Sim_Device():
+    '''
+    arena_api Device stand-in, kind is 'tof' (Helios2) or 'vis' (Triton)
+    '''
+
+    def __init__(self, kind='tof', width=640, height=480, fps=30, seed=0,
+                 serial_number=None, frames=None):
+        self.kind = kind
+        self.seed = seed
+        self.clock = Sim_Frame_Clock(fps)
+        self.frames = frames
+        self.frame_id = 0
+        self.free_buffers = []
+        self.streaming = False
+
+        if kind == 'tof':
+            model_name = 'HLT003S-001'
+            pixel_format = 'Coord3D_ABCY16'
+        else:
+            model_name = 'TRI054S-C'
+            pixel_format = 'BayerRG16'
+        if serial_number is None:
+            serial_number = f'{kind.upper()}{seed:06d}'
+
+        coordinate_selector = Sim_Node('CoordinateA')
+        self.nodemap = Sim_Nodemap({
+            'DeviceModelName': Sim_Node(model_name),
+            'DeviceSerialNumber': Sim_Node(serial_number),
+            'Width': Sim_Node(width, min=1, max=width),
+            'Height': Sim_Node(height, min=1, max=height),
+            'PixelFormat': Sim_Node(pixel_format),
+            'AcquisitionFrameRate': Sim_Node(float(fps or 0)),
+            'ExposureTimeSelector': Sim_Node('Exp1000Us'),
+            'ConversionGain': Sim_Node('Low'),
+            'Scan3dOperatingMode': Sim_Node('Distance3000mmSingleFreq'),
+            'Scan3dImageAccumulation': Sim_Node(1, min=1, max=32),
+            'Scan3dSpatialFilterEnable': Sim_Node(False),
+            'Scan3dConfidenceThresholdEnable': Sim_Node(False),
+            'Scan3dCoordinateSelector': coordinate_selector,
+            'Scan3dCoordinateScale': Sim_Selected_Node(
+                coordinate_selector, {'CoordinateA': 0.25,
+                                      'CoordinateB': 0.25,
+                                      'CoordinateC': 0.25}),
+            'Scan3dCoordinateOffset': Sim_Selected_Node(
+                coordinate_selector, {'CoordinateA': -8192.0,
+                                      'CoordinateB': -8192.0,
+                                      'CoordinateC': 0.0}),
+        })
+        self.tl_stream_nodemap = Sim_Nodemap({
+            'StreamAutoNegotiatePacketSize': Sim_Node(False),
+            'StreamPacketResendEnable': Sim_Node(False),
+            'StreamBufferHandlingMode': Sim_Node('OldestFirst'),
+        })
+
+    def __str__(self):
+        return (f'{self.nodemap["DeviceModelName"].value}, '
+                f'{self.nodemap["DeviceSerialNumber"].value}, simulated')
+
+    @contextlib.contextmanager
+    def start_stream(self, number_of_buffers=1):
+        self.free_buffers = [None] * number_of_buffers
+        self.streaming = True
+        try:
+            yield
+        finally:
+            self.streaming = False
+            self.free_buffers = []
+
+    def get_buffer(self, timeout=None):
+        if not self.streaming:
+            raise RuntimeError('stream is not started')
+        if not self.free_buffers:
+            raise TimeoutError('all stream buffers are in use')
+        self.free_buffers.pop()
+        self.clock.wait_next()
+        self.frame_id += 1
+        pixel_format = self.nodemap['PixelFormat'].value
+        buffer = Sim_Buffer(self.make_frame(self.frame_id, pixel_format),
+                            pixel_format)
+        buffer.frame_id = self.frame_id
+        buffer.timestamp_ns = time.perf_counter_ns()
+        return buffer
+
+    def requeue_buffer(self, buffer):
+        self.free_buffers.append(None)
+
+    def make_frame(self, frame_number, pixel_format):
+        if self.frames is not None:
+            return np.array(self.frames[(frame_number - 1) % len(self.frames)])
+        width = self.nodemap['Width'].value
+        height = self.nodemap['Height'].value
+        if self.kind == 'tof':
+            signed = getattr(pixel_format, 'name',
+                             str(pixel_format)).endswith('s')
+            return make_tof_frame(width, height, frame_number + self.seed,
+                                  signed=signed)
+        return make_bayer_rg_frame(width, height, frame_number + self.seed)
+
+
+class Sim_System():
+    # arena_api.system.system stand-in
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self.created_devices = []
+
+    def create_device(self, device_infos=None):
+        self.created_devices = list(self.devices)
+        return list(self.created_devices)
+
+    def destroy_device(self, device=None):
+        if device is None:
+            self.created_devices = []
+        elif device in self.created_devices:
+            self.created_devices.remove(device)
+
+
+class Sim_VideoCapture():
+    '''
+    cv2.VideoCapture stand-in for the Y16 IR cameras
+    '''
+
+    def __init__(self, width=640, height=512, fps=30, seed=0, frames=None):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.clock = Sim_Frame_Clock(fps)
+        self.frames = frames
+        self.frame_number = 0
+        self.properties = {}
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop_id, value):
+        self.properties[prop_id] = value
+        return True
+
+    def get(self, prop_id):
+        return self.properties.get(prop_id, 0)
+
+    def read(self, image=None):
+        if not self.opened:
+            return False, None
+        self.clock.wait_next()
+        self.frame_number += 1
+        if self.frames is not None:
+            frame = np.array(
+                self.frames[(self.frame_number - 1) % len(self.frames)])
+        else:
+            frame = make_y16_frame(self.width, self.height, self.frame_number,
+                                   self.seed)
+        # like OpenCV, reuse the given array when it fits
+        if (image is not None and image.shape == frame.shape
+                and image.dtype == frame.dtype):
+            image[...] = frame
+            frame = image
+        return True, frame
+
+    def release(self):
+        self.opened = False
+
+
+class Sim_Backend():
+    '''
+    Backend for the camera classes (see Camera.Hardware_Backend) with
+    num_tof Helios2 and num_vis Triton devices on the simulated bus and
+    num_ir IR capture devices. tof_frames, vis_frames and ir_frames replay
+    recorded arrays instead of synthetic frames.
+    '''
+
+    def __init__(self, num_tof=1, num_vis=0, num_ir=2,
+                 width=640, height=480, ir_width=640, ir_height=512,
+                 fps=30, seed=0, tof_frames=None, vis_frames=None,
+                 ir_frames=None):
+        devices = []
+        for i in range(num_tof):
+            devices.append(Sim_Device('tof', width, height, fps, seed + i,
+                                      frames=tof_frames))
+        for i in range(num_vis):
+            devices.append(Sim_Device('vis', width, height, fps, seed + i,
+                                      frames=vis_frames))
+        self.system = Sim_System(devices)
+        self.captures = {}
+        self.num_ir = num_ir
+        self.ir_width = ir_width
+        self.ir_height = ir_height
+        self.fps = fps
+        self.seed = seed
+        self.ir_frames = ir_frames
+
+    def VideoCapture(self, index):
+        # IR cameras open id + cv2.CAP_DSHOW
+        camera_index = index % CAP_DSHOW if index >= CAP_DSHOW else index
+        capture = Sim_VideoCapture(self.ir_width, self.ir_height, self.fps,
+                                   self.seed + camera_index,
+                                   frames=self.ir_frames)
+        if camera_index > self.num_ir:
+            capture.opened = False
+        self.captures[camera_index] = capture
+        return capture
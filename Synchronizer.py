@@ -0,0 +1,86 @@
+import collections
+import time
+
+
+class Frame_Synchronizer():
+    '''
+    Pairs frames from several sensors by timestamp.
+
+    Every frame is added with a time.perf_counter() timestamp: ToF frames
+    with the time they were taken, stamped on the device clock and mapped
+    to the host clock (TofFrame.timestamp), IR frames with the time they
+    arrived. The last `history` frames of each sensor are kept, and match()
+    returns the newest set with one frame per sensor whose timestamps are
+    all within `tolerance` seconds of each other.
+    '''
+
+    def __init__(self, sensors, tolerance=0.02, history=8):
+        self.sensors = list(sensors)
+        self.tolerance = tolerance
+        self.histories = {sensor: collections.deque(maxlen=history)
+                          for sensor in self.sensors}
+        self.matched = 0
+        self.discarded = 0
+
+    def add(self, sensor, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        history = self.histories[sensor]
+        if len(history) == history.maxlen:
+            self.discarded += 1
+        history.append((timestamp, frame))
+        return timestamp
+
+    def newest_timestamps(self):
+        # sensor -> timestamp of its newest frame, None if it has none
+        return {sensor: history[-1][0] if history else None
+                for sensor, history in self.histories.items()}
+
+    def oldest_sensor(self):
+        # the sensor to read next: no frame yet or the stalest newest frame
+        newest = self.newest_timestamps()
+        for sensor in self.sensors:
+            if newest[sensor] is None:
+                return sensor
+        return min(self.sensors, key=lambda sensor: newest[sensor])
+
+    def match(self):
+        # Returns {sensor: (timestamp, frame)} or None. The frames of the
+        # set and everything older are dropped from the histories.
+        if any(not history for history in self.histories.values()):
+            return None
+
+        best_set = None
+        best_time = None
+        for anchor_sensor in self.sensors:
+            for anchor_time, _ in self.histories[anchor_sensor]:
+                # closest frame of every sensor to the anchor
+                candidate = {}
+                for sensor, history in self.histories.items():
+                    candidate[sensor] = min(
+                        history, key=lambda entry: abs(entry[0] - anchor_time))
+                times = [entry[0] for entry in candidate.values()]
+                if max(times) - min(times) > self.tolerance:
+                    continue
+                if best_time is None or min(times) > best_time:
+                    best_set = candidate
+                    best_time = min(times)
+
+        if best_set is None:
+            return None
+
+        for sensor, history in self.histories.items():
+            used_time = best_set[sensor][0]
+            while history and history[0][0] <= used_time:
+                if history.popleft()[0] != used_time:
+                    self.discarded += 1
+        self.matched += 1
+        return best_set
+
+    def spread(self, frame_set):
+        times = [timestamp for timestamp, _ in frame_set.values()]
+        return max(times) - min(times)
+
+    def clear(self):
+        for history in self.histories.values():
+            history.clear()
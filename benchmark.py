@@ -0,0 +1,421 @@
+import argparse
+import copy
+import functools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from Camera import *
+from DepthFilters import (SPATIAL_FILTER_METHODS, Spatial_Filter,
+                          Temporal_Filter)
+from DepthStats import Depth_Monitor
+from FrameCodec import Frame_Codec
+from Registration import Registration
+from SimBackend import (Sim_Backend, make_bayer_rg_frame, make_tof_frame,
+                        make_y16_frame)
+
+'''
+Frame processing benchmark
+    Times each processing stage of Camera.py on synthetic frames from the
+    simulated backend, for several frame sizes, and prints latency
+    percentiles and frames per second:
+
+        python benchmark.py --sizes 320x240,640x480 --repeat 50
+        python benchmark.py --save baseline.json
+        python benchmark.py --compare baseline.json
+
+    --compare exits with status 1 if a stage got slower than the baseline
+    by more than --tolerance.
+'''
+
+DEFAULT_SIZES = '320x240,640x480,1280x960'
+
+# name -> setup(width, height, workdir) returning the function to time.
+# The function may carry an `info` dict of extra results, e.g. the
+# compression ratio, and `nbytes`, the raw bytes it processes per call.
+STAGES = {}
+
+
+def stage(name):
+    def register(setup):
+        STAGES[name] = setup
+        return setup
+    return register
+
+
+@functools.lru_cache(maxsize=None)
+def make_cameras(width, height):
+    backend = Sim_Backend(num_tof=1, num_vis=1, num_ir=1, width=width,
+                          height=height, ir_width=width, ir_height=height,
+                          fps=None)
+    tof = Tof_Camera(id=1, backend=backend)
+    vis = Vis_Camera(id=2, backend=backend)
+    ir = IR_Camera(id=1, backend=backend)
+    return tof, vis, ir
+
+
+def make_tof_test_frame(tof, width, height):
+    array = make_tof_frame(width, height, frame_number=1)
+    return TofFrame(array, 'Coord3D_ABCY16', scales=tof.scales,
+                    offsets=tof.offsets, color_borders=tof.color_borders)
+
+
+@stage('heatmap')
+def bench_heatmap(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+
+    def run():
+        # a new frame every time, the products are cached per frame
+        frame.copy().bgr_heatmap
+    return run
+
+
+@stage('ply_colors')
+def bench_ply_colors(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+
+    def run():
+        frame.copy().rgb_colors
+    return run
+
+
+@stage('points')
+def bench_points(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+
+    def run():
+        frame.copy().points()
+    return run
+
+
+@stage('depth_stats')
+def bench_depth_stats(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+
+    def run():
+        frame.copy().depth_stats()
+    return run
+
+
+@stage('depth_stats_rois')
+def bench_depth_stats_rois(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+    # a 3x3 grid of regions, as a monitor of a scene would use
+    rois = {(row, column): (column * width // 3, row * height // 3,
+                            width // 3, height // 3)
+            for row in range(3) for column in range(3)}
+    monitor = Depth_Monitor(rois)
+
+    def run():
+        monitor.update(frame.copy())
+    return run
+
+
+@stage('temporal_filter')
+def bench_temporal_filter(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frames = [TofFrame(make_tof_frame(width, height, frame_number),
+                       'Coord3D_ABCY16', scales=tof.scales,
+                       offsets=tof.offsets, color_borders=tof.color_borders)
+              for frame_number in range(8)]
+    temporal_filter = Temporal_Filter(window=4, min_intensity=20)
+    frame_numbers = iter(range(10 ** 9))
+
+    def run():
+        # the ring is full after the warmup, every run adds and removes
+        temporal_filter.update(frames[next(frame_numbers) % len(frames)])
+    return run
+
+
+def make_spatial_filter_stage(method):
+    @stage(f'spatial_{method}')
+    def bench_spatial_filter(width, height, workdir):
+        tof, _, _ = make_cameras(width, height)
+        frame = make_tof_test_frame(tof, width, height)
+        spatial_filter = Spatial_Filter(method, min_intensity=20)
+
+        def run():
+            spatial_filter.filter(frame)
+        return run
+    return bench_spatial_filter
+
+
+for method in SPATIAL_FILTER_METHODS:
+    make_spatial_filter_stage(method)
+
+
+@stage('registration')
+def bench_registration(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+    ir_frame = make_y16_frame(width, height, frame_number=1)
+    # ToF and IR side by side, 60 mm apart, with some lens distortion
+    focal = 0.9 * width
+    camera_matrix = [[focal, 0.0, width / 2], [0.0, focal, height / 2],
+                     [0.0, 0.0, 1.0]]
+    calibration = {
+        'tof': {'camera_matrix': camera_matrix,
+                'dist_coeffs': [-0.1, 0.02, 0.0, 0.0, 0.0],
+                'size': [width, height]},
+        'ir1': {'camera_matrix': camera_matrix,
+                'dist_coeffs': [-0.2, 0.05, 0.0, 0.0, 0.0],
+                'size': [width, height],
+                'rotation': [0.0, 0.02, 0.0], 'translation': [60.0, 0.0, 0.0]},
+    }
+    registration = Registration(calibration, 'ir1', cache_dir=workdir)
+
+    def run():
+        projection = registration.project(frame.copy())
+        registration.ir_in_depth(ir_frame, projection)
+        registration.depth_in_ir(projection)
+    return run
+
+
+@stage('ir_view_image')
+def bench_ir_view_image(width, height, workdir):
+    _, _, ir = make_cameras(width, height)
+    ir_frame = make_y16_frame(width, height, frame_number=1)
+
+    def run():
+        ir.make_view_image(ir_frame)
+    return run
+
+
+@stage('ir_view_image_u8')
+def bench_ir_view_image_u8(width, height, workdir):
+    ir_frame = make_y16_frame(width, height, frame_number=1)
+    view_engine = IR_View_Engine()
+
+    def run():
+        view_engine.make_view_image_u8(ir_frame)
+    return run
+
+
+def make_demosaic_stage(demosaic_mode):
+    @stage('demosaic' if demosaic_mode == 'full'
+           else f'demosaic_{demosaic_mode}')
+    def bench_demosaic(width, height, workdir):
+        _, vis, _ = make_cameras(width, height)
+        vis = copy.copy(vis)
+        vis.demosaic_mode = demosaic_mode
+        bayer_frame = make_bayer_rg_frame(width, height, frame_number=1)
+        # into a reused image, like Vis_Camera.shoot_vis()
+        image = np.empty(vis.output_shape(bayer_frame.shape),
+                         dtype=np.uint16)
+
+        def run():
+            vis.demosaic(bayer_frame, dst=image)
+        return run
+
+
+for demosaic_mode in VIS_DEMOSAIC_MODES:
+    make_demosaic_stage(demosaic_mode)
+
+
+@stage('write_jpg')
+def bench_write_jpg(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    heatmap = make_tof_test_frame(tof, width, height).bgr_heatmap
+    path = os.path.join(workdir, 'heatmap.jpg')
+
+    def run():
+        cv2.imwrite(path, heatmap)
+    return run
+
+
+@stage('write_tif')
+def bench_write_tif(width, height, workdir):
+    ir_frame = make_y16_frame(width, height, frame_number=1)
+    path = os.path.join(workdir, 'ir.tif')
+
+    def run():
+        cv2.imwrite(path, ir_frame)
+    return run
+
+
+@stage('write_ply')
+def bench_write_ply(width, height, workdir):
+    tof, _, _ = make_cameras(width, height)
+    frame = make_tof_test_frame(tof, width, height)
+    path = os.path.join(workdir, 'cloud.ply')
+
+    def run():
+        tof.save_ply(frame.copy(), path)
+    return run
+
+
+def make_codec_stages(compression):
+    def make_frame(width, height, sensor):
+        if sensor == 'ir':
+            return make_y16_frame(width, height, frame_number=1)
+        return make_tof_frame(width, height, frame_number=1)
+
+    def make_codec(frame):
+        codec = Frame_Codec(compression)
+        run_info = {'ratio': frame.nbytes / len(codec.encode(frame))}
+        return codec, run_info
+
+    for sensor in ('tof', 'ir'):
+        @stage(f'encode_{sensor}_{compression}')
+        def bench_encode(width, height, workdir, sensor=sensor):
+            frame = make_frame(width, height, sensor)
+            codec, run_info = make_codec(frame)
+
+            def run():
+                codec.encode(frame)
+            run.info = run_info
+            run.nbytes = frame.nbytes
+            return run
+
+        @stage(f'decode_{sensor}_{compression}')
+        def bench_decode(width, height, workdir, sensor=sensor):
+            frame = make_frame(width, height, sensor)
+            codec, run_info = make_codec(frame)
+            data = codec.encode(frame)
+            out = np.empty_like(frame)
+
+            def run():
+                codec.decode(data, dtype=frame.dtype, out=out)
+            run.info = run_info
+            run.nbytes = frame.nbytes
+            return run
+
+
+for compression in ('zlib', 'lzma'):
+    make_codec_stages(compression)
+
+
+def time_stage(run, repeat, warmup):
+    for _ in range(warmup):
+        run()
+    latencies = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        latencies[i] = time.perf_counter() - start
+    latencies_ms = latencies * 1000
+    mean_ms = float(latencies_ms.mean())
+    result = {
+        'repeat': repeat,
+        'mean_ms': mean_ms,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p90_ms': float(np.percentile(latencies_ms, 90)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'min_ms': float(latencies_ms.min()),
+        'max_ms': float(latencies_ms.max()),
+        'fps': 1000.0 / mean_ms if mean_ms else float('inf'),
+    }
+    if hasattr(run, 'nbytes'):
+        result['mb_per_s'] = run.nbytes * result['fps'] / 1e6
+    result.update(getattr(run, 'info', {}))
+    return result
+
+
+def run_benchmarks(stage_names, sizes, repeat, warmup):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for width, height in sizes:
+            size_name = f'{width}x{height}'
+            for name in stage_names:
+                try:
+                    run = STAGES[name](width, height, workdir)
+                    result = time_stage(run, repeat, warmup)
+                except Exception as error:
+                    # e.g. a writer the installed SDK does not have
+                    print(f'{name:>16} {size_name:>10}  skipped: {error!r}')
+                    continue
+                results.setdefault(name, {})[size_name] = result
+                print(f'{name:>16} {size_name:>10}  '
+                      f'p50 {result["p50_ms"]:9.3f} ms  '
+                      f'p90 {result["p90_ms"]:9.3f} ms  '
+                      f'p99 {result["p99_ms"]:9.3f} ms  '
+                      f'{result["fps"]:9.1f} fps'
+                      + (f'  {result["mb_per_s"]:8.1f} MB/s'
+                         if 'mb_per_s' in result else '')
+                      + (f'  ratio {result["ratio"]:6.2f}'
+                         if 'ratio' in result else ''))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # True if no stage is more than tolerance slower (p50) than baseline
+    ok = True
+    print('\nCompared with baseline (p50):')
+    for name, sizes in results.items():
+        for size_name, result in sizes.items():
+            base = baseline.get('results', {}).get(name, {}).get(size_name)
+            if base is None:
+                continue
+            ratio = result['p50_ms'] / base['p50_ms']
+            regression = ratio > 1.0 + tolerance
+            ok = ok and not regression
+            print(f'{name:>16} {size_name:>10}  {base["p50_ms"]:9.3f} -> '
+                  f'{result["p50_ms"]:9.3f} ms  x{ratio:5.2f}'
+                  f'{"  REGRESSION" if regression else ""}')
+    return ok
+
+
+def parse_sizes(text):
+    sizes = []
+    for size in text.split(','):
+        width, height = size.lower().split('x')
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the frame processing stages of Camera.py')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f'frame sizes, default {DEFAULT_SIZES}')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='stages to run, default all')
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--save', help='write the results to a JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    stage_names = args.stages.split(',')
+    for name in stage_names:
+        if name not in STAGES:
+            parser.error(f'unknown stage {name}, one of {", ".join(STAGES)}')
+
+    results = run_benchmarks(stage_names, parse_sizes(args.sizes),
+                             args.repeat, args.warmup)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+                'machine': platform.platform(),
+                'results': results,
+            }, baseline_file, indent=2)
+        print(f'\nSaved {args.save}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
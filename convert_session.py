@@ -0,0 +1,176 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from Camera import IR_View_Engine
+from SessionArchive import Session_Archive_Reader
+
+'''
+Offline session converter
+    Renders a raw session archive (shoot4cal.py with save_format "archive")
+    on all cores:
+        - ToF frames : <sensor>_<frame>.jpg heatmap and .ply point cloud
+        - IR frames  : <sensor>_<frame>_view.png normalized preview
+                       (and <sensor>_<frame>.tif with --tif)
+
+        python convert_session.py cal_data/<session> --out out_dir -j 8
+
+    Frames are handed to the worker processes in chunks of --chunk frames.
+    Files are written under a temporary name and renamed when complete, so
+    running the same command again after an interruption only renders the
+    frames that are missing.
+'''
+
+
+def output_paths(out_dir, sensor, frame_number, kind, tif=False):
+    name = os.path.join(out_dir, f'{sensor}_{str(frame_number).zfill(4)}')
+    if kind == 'tof':
+        return [name + '.jpg', name + '.ply']
+    paths = [name + '_view.png']
+    if tif:
+        paths.append(name + '.tif')
+    return paths
+
+
+def temporary_path(path):
+    # keeps the extension, cv2.imwrite picks the format from it
+    root, extension = os.path.splitext(path)
+    return f'{root}.part{extension}'
+
+
+def write_atomic(path, write):
+    part_path = temporary_path(path)
+    write(part_path)
+    os.replace(part_path, path)
+
+
+# worker process state -------------------------------------------------------
+
+worker_reader = None
+worker_options = None
+worker_view_engine = None
+
+
+def init_worker(session, options):
+    global worker_reader, worker_options, worker_view_engine
+    worker_reader = Session_Archive_Reader(session, codec_workers=1)
+    worker_options = options
+    # frames are not converted in order, so no smoothing between them
+    worker_view_engine = IR_View_Engine(smoothing=0.0)
+    # one thread per process, the processes already use every core
+    cv2.setNumThreads(1)
+
+
+def convert_chunk(chunk):
+    sensor, indexes = chunk
+    reader = worker_reader
+    out_dir = worker_options['out_dir']
+    kind = reader.metadata(sensor).get('kind')
+    for i in indexes:
+        frame_number = reader.frame_number(sensor, i)
+        paths = output_paths(out_dir, sensor, frame_number, kind,
+                             worker_options['tif'])
+        if kind == 'tof':
+            # same colors as Tof_Camera, from the recorded scales and
+            # operating mode
+            frame = reader.tof_frame(sensor, i)
+            write_atomic(paths[0], lambda path: cv2.imwrite(
+                path, frame.bgr_heatmap))
+            write_atomic(paths[1], frame.save_ply)
+        else:
+            ir_frame = np.asarray(reader.frame(sensor, i))
+            view = worker_view_engine.make_view_image_u8(ir_frame)
+            write_atomic(paths[0], lambda path: cv2.imwrite(path, view))
+            if worker_options['tif']:
+                write_atomic(paths[1], lambda path: cv2.imwrite(
+                    path, ir_frame))
+    return len(indexes)
+
+
+# main process ---------------------------------------------------------------
+
+def find_work(reader, out_dir, sensors, tif):
+    # (sensor, frame index) of every frame with a missing output file
+    work = []
+    done = 0
+    for sensor in sensors:
+        kind = reader.metadata(sensor).get('kind')
+        for i in range(reader.count(sensor)):
+            paths = output_paths(out_dir, sensor,
+                                 reader.frame_number(sensor, i), kind, tif)
+            if all(os.path.exists(path) for path in paths):
+                done += 1
+            else:
+                work.append((sensor, i))
+    return work, done
+
+
+def make_chunks(work, chunk_size):
+    # consecutive frames of one sensor per chunk, they are next to each
+    # other in the archive
+    chunks = []
+    for sensor, i in work:
+        if (chunks and chunks[-1][0] == sensor
+                and len(chunks[-1][1]) < chunk_size
+                and chunks[-1][1][-1] == i - 1):
+            chunks[-1][1].append(i)
+        else:
+            chunks.append((sensor, [i]))
+    return chunks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render a raw session archive to JPG/PLY/PNG files on '
+                    'all cores')
+    parser.add_argument('session', help='session archive directory')
+    parser.add_argument('--out', help='output directory, default '
+                                      '<session>/converted')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=os.cpu_count(),
+                        help='worker processes, default one per core')
+    parser.add_argument('--chunk', type=int, default=16,
+                        help='frames per work item, default 16')
+    parser.add_argument('--sensors', help='comma separated, default all')
+    parser.add_argument('--tif', action='store_true',
+                        help='also write the raw IR frames as TIFF')
+    args = parser.parse_args(argv)
+
+    out_dir = args.out or os.path.join(args.session, 'converted')
+    os.makedirs(out_dir, exist_ok=True)
+    reader = Session_Archive_Reader(args.session)
+    sensors = args.sensors.split(',') if args.sensors else reader.sensors()
+
+    work, done = find_work(reader, out_dir, sensors, args.tif)
+    total = len(work) + done
+    if done:
+        print(f'Resuming: {done} of {total} frames already converted')
+    if not work:
+        print('Nothing to do')
+        return 0
+
+    chunks = make_chunks(work, args.chunk)
+    options = {'out_dir': out_dir, 'tif': args.tif}
+    start = time.perf_counter()
+    converted = 0
+    with multiprocessing.Pool(args.workers, initializer=init_worker,
+                              initargs=(args.session, options)) as pool:
+        for count in pool.imap_unordered(convert_chunk, chunks):
+            converted += count
+            elapsed = time.perf_counter() - start
+            rate = converted / elapsed
+            remaining = (len(work) - converted) / rate if rate else 0
+            print(f'{done + converted}/{total} frames, {rate:.1f} frames/s, '
+                  f'{remaining:.0f} s left', end='\r')
+    print(f'\nConverted {converted} frames in '
+          f'{time.perf_counter() - start:.1f} s with {args.workers} workers')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
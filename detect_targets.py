@@ -0,0 +1,276 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from Camera import IR_View_Engine
+from SessionArchive import Session_Archive_Reader
+
+'''
+Calibration target detection
+    Finds the checkerboard in every frame of a shoot4cal.py session, the
+    IR frames and the ToF intensity images, and writes the frame sets
+    where it was found on every sensor:
+
+        python detect_targets.py cal_data/<session> --pattern 9x6 -j 8
+
+    A session is a directory of files (ir1_0000.tif,
+    tof1_0000_intensity.tif, ...) or a raw session archive. The frames are
+    detected in a process pool: findChessboardCorners on the image scaled
+    by --scale, then cornerSubPix on the full resolution image.
+
+    Every result is appended to <session>_targets_cache.jsonl next to the
+    session directory, under the SHA-1 of the frame data and the detection
+    settings, so running again (after an interruption, or with more
+    frames) only detects new frames. The complete sets are written to
+    <session>_targets.json:
+
+        {"pattern": [9, 6], "sensors": ["ir1", "ir2", "tof1"],
+         "sets": [{"frame": 0, "corners": {"ir1": [[x, y], ...], ...}}]}
+'''
+
+# <sensor>.json headers of a raw session archive
+ARCHIVE_HEADER = re.compile(r'^(ir|tof)\d+\.json$')
+FILE_PATTERNS = {
+    # file name -> sensor, frame number
+    'ir': re.compile(r'^(ir\d+)_(\d+)\.tif$'),
+    'tof': re.compile(r'^(tof\d+)_(\d+)_intensity\.tif$'),
+}
+# next to the session directory, not in it: the files of an archive
+# session are its sensors
+OUT_SUFFIX = '_targets.json'
+CACHE_SUFFIX = '_targets_cache.jsonl'
+DETECT_FLAGS = (cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE
+                | cv2.CALIB_CB_FAST_CHECK)
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30,
+                   0.01)
+
+
+def parse_pattern(text):
+    columns, rows = (int(n) for n in text.lower().split('x'))
+    return columns, rows
+
+
+def find_frames(session, sensors=None):
+    # {frame number: {sensor: source}}, a source is ('file', path) or
+    # ('archive', sensor, index)
+    frames = {}
+    names = sorted(os.listdir(session))
+    if any(ARCHIVE_HEADER.match(name) for name in names):
+        # the archive has the ToF intensity, files exported from it don't
+        reader = Session_Archive_Reader(session)
+        for sensor in reader.sensors():
+            if sensors is not None and sensor not in sensors:
+                continue
+            for i in range(reader.count(sensor)):
+                frames.setdefault(reader.frame_number(sensor, i), {})[
+                    sensor] = ('archive', sensor, i)
+        return frames
+    for name in names:
+        for pattern in FILE_PATTERNS.values():
+            match = pattern.match(name)
+            if match is None:
+                continue
+            sensor, frame_number = match.group(1), int(match.group(2))
+            if sensors is None or sensor in sensors:
+                frames.setdefault(frame_number, {})[sensor] = (
+                    'file', os.path.join(session, name))
+    return frames
+
+
+def load_cache(path):
+    # {key: corners or None}, a line cut off by an interruption is skipped
+    cache = {}
+    if not os.path.exists(path):
+        return cache
+    with open(path) as cache_file:
+        for line in cache_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            cache[entry['key']] = entry['corners']
+    return cache
+
+
+def detect_corners(image, pattern, scale, fallback, view_engine):
+    # (N, 2) float32 checkerboard corners in image pixels, or None
+    if image.dtype != np.uint8:
+        image = view_engine.make_view_image_u8(image)
+    found = False
+    if scale < 1.0:
+        small = cv2.resize(image, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA)
+        found, corners = cv2.findChessboardCorners(small, pattern,
+                                                   flags=DETECT_FLAGS)
+        if found:
+            # corner positions of the small image in full resolution
+            # pixels, pixel centers are at +0.5
+            corners = (corners + 0.5) / scale - 0.5
+    if not found and (scale >= 1.0 or fallback):
+        found, corners = cv2.findChessboardCorners(image, pattern,
+                                                   flags=DETECT_FLAGS)
+    if not found:
+        return None
+    # window of about a pixel of the small image around every corner
+    window = max(int(round(1.0 / min(scale, 1.0))) + 2, 3)
+    corners = cv2.cornerSubPix(image, corners.astype(np.float32),
+                               (window, window), (-1, -1), SUBPIX_CRITERIA)
+    return corners.reshape(-1, 2)
+
+
+# worker process state -------------------------------------------------------
+
+worker_reader = None
+worker_options = None
+worker_cache = None
+worker_view_engine = None
+
+
+def init_worker(session, options, cache):
+    global worker_reader, worker_options, worker_cache, worker_view_engine
+    worker_reader = None
+    if options['archive']:
+        worker_reader = Session_Archive_Reader(session, codec_workers=1)
+    worker_options = options
+    worker_cache = cache
+    # frames are not in order, so no smoothing between them
+    worker_view_engine = IR_View_Engine(smoothing=0.0)
+    # one thread per process, the processes already use every core
+    cv2.setNumThreads(1)
+
+
+def read_source(source):
+    # (data bytes to hash, function making the image from them)
+    if source[0] == 'file':
+        with open(source[1], 'rb') as image_file:
+            data = image_file.read()
+        return data, lambda: cv2.imdecode(np.frombuffer(data, np.uint8),
+                                          cv2.IMREAD_UNCHANGED)
+    _, sensor, i = source
+    frame = worker_reader.frame(sensor, i)
+    if worker_reader.metadata(sensor).get('kind') == 'tof':
+        image = np.ascontiguousarray(np.asarray(frame)[:, :, 3])
+    else:
+        image = np.asarray(frame)
+    return image.tobytes(), lambda: image
+
+
+def detect_source(item):
+    frame_number, sensor, source = item
+    options = worker_options
+    data, make_image = read_source(source)
+    key = hashlib.sha1(data).hexdigest() + options['settings']
+    if key in worker_cache:
+        return frame_number, sensor, key, worker_cache[key], True
+    corners = detect_corners(make_image(), options['pattern'],
+                             options['scale'], options['fallback'],
+                             worker_view_engine)
+    if corners is not None:
+        corners = np.round(corners, 3).tolist()
+    return frame_number, sensor, key, corners, False
+
+
+# main process ---------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find the checkerboard in every frame of a calibration '
+                    'session on all cores')
+    parser.add_argument('session', help='session directory (files or raw '
+                                        'archive)')
+    parser.add_argument('--pattern', default='9x6',
+                        help='inner corners per row x per column, default '
+                             '9x6')
+    parser.add_argument('--scale', type=float, default=0.5,
+                        help='scale of the images the target is searched '
+                             'in, default 0.5')
+    parser.add_argument('--fallback', action='store_true',
+                        help='search the full resolution image when the '
+                             'scaled one has no target')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=os.cpu_count(),
+                        help='worker processes, default one per core')
+    parser.add_argument('--sensors', help='comma separated, default all')
+    parser.add_argument('--out', help='output file, default '
+                                      '<session>_targets.json')
+    args = parser.parse_args(argv)
+
+    pattern = parse_pattern(args.pattern)
+    sensors = args.sensors.split(',') if args.sensors else None
+    frames = find_frames(args.session, sensors)
+    if not frames:
+        print('No frames found')
+        return 1
+    all_sensors = sorted({sensor for frame_sensors in frames.values()
+                          for sensor in frame_sensors})
+    items = [(frame_number, sensor, source)
+             for frame_number, frame_sensors in sorted(frames.items())
+             for sensor, source in sorted(frame_sensors.items())]
+
+    session = os.path.normpath(args.session)
+    cache_path = session + CACHE_SUFFIX
+    cache = load_cache(cache_path)
+    options = {
+        'pattern': pattern,
+        'scale': args.scale,
+        'fallback': args.fallback,
+        'settings': f'-{pattern[0]}x{pattern[1]}-{args.scale}-'
+                    f'{int(args.fallback)}',
+        'archive': any(source[0] == 'archive' for _, _, source in items),
+    }
+
+    # frame sets are complete when every sensor of the session has its
+    # target, a set missing a sensor or a target is left out
+    results = {frame_number: {} for frame_number in frames}
+    complete = []
+    start = time.perf_counter()
+    done = cached = 0
+    with open(cache_path, 'a') as cache_file, multiprocessing.Pool(
+            args.workers, initializer=init_worker,
+            initargs=(args.session, options, cache)) as pool:
+        for frame_number, sensor, key, corners, from_cache in \
+                pool.imap_unordered(detect_source, items, chunksize=4):
+            done += 1
+            if from_cache:
+                cached += 1
+            else:
+                cache_file.write(json.dumps({'key': key,
+                                             'corners': corners}) + '\n')
+                cache_file.flush()
+            results[frame_number][sensor] = corners
+            frame_results = results[frame_number]
+            if (len(frame_results) == len(all_sensors)
+                    and all(corners is not None
+                            for corners in frame_results.values())):
+                complete.append(frame_number)
+                print(f'frame {frame_number}: target on every sensor')
+            elapsed = time.perf_counter() - start
+            rate = done / elapsed
+            print(f'{done}/{len(items)} images ({cached} cached), '
+                  f'{rate:.1f} images/s, '
+                  f'{(len(items) - done) / rate:.0f} s left', end='\r')
+
+    out_path = args.out or session + OUT_SUFFIX
+    sets = [{'frame': frame_number, 'corners': results[frame_number]}
+            for frame_number in sorted(complete)]
+    with open(out_path + '.part', 'w') as out_file:
+        json.dump({'pattern': list(pattern), 'sensors': all_sensors,
+                   'sets': sets}, out_file)
+    os.replace(out_path + '.part', out_path)
+    print(f'\n{len(sets)} of {len(frames)} frame sets with the target on '
+          f'every sensor, {done} images in '
+          f'{time.perf_counter() - start:.1f} s with {args.workers} '
+          f'workers: {out_path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,8 @@
 import ctypes
 import sys
 
+import numpy as np
+
 from arena_api.enums import PixelFormat
 from arena_api.system import system
 
@@ -102,95 +104,85 @@ class PointData:
 		self.intensity = intensity
 
 
-def find_min_and_max_z_for_signed(pdata_16bit, total_number_of_channels,
-								channels_per_pixel, scale_x, scale_y, scale_z):
+def get_min_and_max_points(abcy, valid, scales, offsets):
 
+	# abcy is a (number of pixels, 4) array of [x][y][z][intensity], the
+	# points are converted to mm and truncated like the values printed.
 	# min_depth z value is set to SIGNED_16BIT_MAX to guarantee closer points
 	# exist as this is the largest value possible
 	min_depth = PointData(x=0, y=0, z=SIGNED_16BIT_MAX, intensity=0)
 	max_depth = PointData(x=0, y=0, z=0, intensity=0)
 
-	for i in range(0, total_number_of_channels, channels_per_pixel):
-
-		# Extract channels from point/pixel
-		#   The first channel is the x coordinate,
-		#   the second channel is the y coordinate,
-		#   the third channel is the z coordinate, and
-		#   the fourth channel is intensity.
-		# We offset by 1 for each channel because pdata_16bit is 16 bit
-		#  integer
-		x = pdata_16bit[i]
-		y = pdata_16bit[i + 1]
-		z = pdata_16bit[i + 2]
-		intensity = pdata_16bit[i + 3]
-
-		x = int(x * scale_x)
-		y = int(y * scale_y)
-		z = int(z * scale_z)
-
-		if 0 < z < min_depth.z:
-			min_depth.x = x
-			min_depth.y = y
-			min_depth.z = z
-			min_depth.intensity = intensity
-
-		elif z > max_depth.z:
-			max_depth.x = x
-			max_depth.y = y
-			max_depth.z = z
-			max_depth.intensity = intensity
+	z = (abcy[:, 2] * scales[2]).astype(np.int64)
+
+	# closest point with a depth, np.argmin/argmax return the first pixel of
+	# the extreme value, the one a loop over the pixels would keep
+	near = valid & (z > 0)
+	if near.any():
+		i = np.flatnonzero(near)[np.argmin(z[near])]
+		min_depth = make_point_data(abcy[i], scales, offsets)
+
+	if valid.any():
+		i = np.flatnonzero(valid)[np.argmax(z[valid])]
+		if z[i] > max_depth.z:
+			max_depth = make_point_data(abcy[i], scales, offsets)
 
 	return min_depth, max_depth
 
 
+def make_point_data(point, scales, offsets):
+
+	# x, y and z in mm using each coordinates' appropriate scale and offset
+	return PointData(x=int(point[0] * scales[0] + offsets[0]),
+					 y=int(point[1] * scales[1] + offsets[1]),
+					 z=int(point[2] * scales[2]),
+					 intensity=int(point[3]))
+
+
+def find_min_and_max_z_for_signed(pdata_16bit, total_number_of_channels,
+								channels_per_pixel, scale_x, scale_y, scale_z):
+
+	# Extract channels from points/pixels
+	#   The first channel is the x coordinate,
+	#   the second channel is the y coordinate,
+	#   the third channel is the z coordinate, and
+	#   the fourth channel is intensity.
+	# The whole buffer is viewed as one numpy array without copying, every
+	# row is a pixel and the four columns its channels.
+	abcy = np.ctypeslib.as_array(
+		pdata_16bit, (total_number_of_channels,)).reshape(
+		-1, channels_per_pixel)
+
+	# every pixel with a z value counts, only a positive one can be the
+	# minimum depth
+	valid = np.ones(len(abcy), dtype=bool)
+	return get_min_and_max_points(abcy, valid, (scale_x, scale_y, scale_z),
+								  (0, 0, 0))
+
+
 def find_min_and_max_z_for_unsigned(pdata_16bit, total_number_of_channels,
 									channels_per_pixel, scale_x, scale_y, scale_z,
 									offset_x, offset_y):
-	# min_depth z value is set to SIGNED_16BIT_MAX to guarantee closer points
-	# exist as this is the largest value possible
-	min_depth = PointData(x=0, y=0, z=SIGNED_16BIT_MAX, intensity=0)
-	max_depth = PointData(x=0, y=0, z=0, intensity=0)
 
-	for i in range(0, total_number_of_channels, channels_per_pixel):
-
-		# Extract channels from point/pixel
-		#   The first channel is the x coordinate,
-		#   the second channel is the y coordinate,
-		#   the third channel is the z coordinate, and
-		#   the fourth channel is intensity.
-		# We offset by 1 for each channel because pdata_16bit is 16 bit
-		#  integer
-		x = pdata_16bit[i]
-		y = pdata_16bit[i + 1]
-		z = pdata_16bit[i + 2]
-		intensity = pdata_16bit[i + 3]
-
-		# if z is less than max value, as invalid values get
-		# filtered to UNSIGNED_16BIT_MAX
-		if z < UNSIGNED_16BIT_MAX:
-			# Convert x, y and z to millimeters
-			#   Using each coordinates' appropriate scales,
-			#   convert x, y and z values to mm. For the x and y
-			#   coordinates in an unsigned pixel format, we must then
-			#   add the offset to our converted values in order to
-			#   get the correct position in millimeters.
-			x = int((x * scale_x) + offset_x)
-			y = int((y * scale_y) + offset_y)
-			z = int(z * scale_y)
-
-			if 0 < z < min_depth.z:
-				min_depth.x = x
-				min_depth.y = y
-				min_depth.z = z
-				min_depth.intensity = intensity
-
-			elif z > max_depth.z:
-				max_depth.x = x
-				max_depth.y = y
-				max_depth.z = z
-				max_depth.intensity = intensity
-
-	return min_depth, max_depth
+	# Extract channels from points/pixels, see
+	# find_min_and_max_z_for_signed()
+	abcy = np.ctypeslib.as_array(
+		pdata_16bit, (total_number_of_channels,)).reshape(
+		-1, channels_per_pixel)
+
+	# if z is less than max value, as invalid values get
+	# filtered to UNSIGNED_16BIT_MAX
+	valid = abcy[:, 2] < UNSIGNED_16BIT_MAX
+
+	# Convert x, y and z to millimeters
+	#   Using each coordinates' appropriate scales,
+	#   convert x, y and z values to mm. For the x and y
+	#   coordinates in an unsigned pixel format, we must then
+	#   add the offset to our converted values in order to
+	#   get the correct position in millimeters. z is scaled with
+	#   scale_z (the loop this replaces used scale_y by mistake).
+	return get_min_and_max_points(abcy, valid, (scale_x, scale_y, scale_z),
+								  (offset_x, offset_y, 0))
 
 
 def example_entry_point():
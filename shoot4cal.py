@@ -1,9 +1,13 @@
 import cv2
 import os
+import re
 import time
 import winsound as ws
 
+from AsyncWriter import Async_Writer
 from Camera import *
+from SessionArchive import Session_Archive
+from Synchronizer import Frame_Synchronizer
 from WDT import *
 
 ### Settings ###
@@ -13,6 +17,17 @@ num_cameras_tof = 1
 num_cameras_ir = 2
 mode = 1  # 0: continuous, 1: with sound
 wait_sec = 0.5
+# "files": jpg/ply/tif per shot, rendered while capturing
+# "archive": raw frames only, rendered offline (python SessionArchive.py)
+save_format = "files"
+archive_compression = None  # None, "zlib" or "lzma" (lossless)
+writer_workers = 2
+writer_queue_size = 16
+writer_backpressure = "block"  # "block", "drop_oldest" or "spill"
+sync_tolerance_sec = 0.02  # max time between the frames of one shot
+sync_max_reads = 10  # extra reads to get the frames within the tolerance
+tof_stream_buffers = 3  # the newest is returned, at least 2
+ir_background = True  # keep the newest IR frame ready in a grab thread
 
 ################
 
@@ -33,11 +48,40 @@ def main():
         cameras_tof.append(camera_tof)
 
     for c in range(num_cameras_ir):
-        camera_ir = IR_Camera(id=c+1)
+        camera_ir = IR_Camera(id=c+1, background=ir_background)
         cameras_ir.append(camera_ir)
+    # ToF frames are timestamped when they are taken (device clock), IR
+    # frames when they arrive, and the frames of a shot are picked so
+    # they were taken at the same time
+    sensors = ([f"tof{c+1}" for c in range(num_cameras_tof)]
+               + [f"ir{c+1}" for c in range(num_cameras_ir)])
+    synchronizer = Frame_Synchronizer(sensors, tolerance=sync_tolerance_sec)
+
+    def capture(sensor, newer=False):
+        # "tof12" -> cameras_tof[11]. A ToF shot always waits for a new
+        # frame, an IR one only with newer (the grab thread keeps the
+        # newest frame ready).
+        c = int(re.fullmatch(r"[a-z]+(\d+)", sensor).group(1)) - 1
+        if sensor.startswith("tof"):
+            tof_frame = cameras_tof[c].shoot()
+            synchronizer.add(sensor, tof_frame, tof_frame.timestamp)
+        else:
+            ir_frame, timestamp = cameras_ir[c].shoot_ir_with_timestamp(
+                newer=newer)
+            synchronizer.add(sensor, ir_frame, timestamp)
+
+    # raw frames of all shots go into one archive per sensor
+    archive = None
+    if save_format == "archive":
+        archive = Session_Archive(save_dir, compression=archive_compression)
+
+    # files are encoded and written in the background
+    writer = Async_Writer(num_workers=writer_workers,
+                          max_queue=writer_queue_size,
+                          backpressure=writer_backpressure)
     print("hey1")
     try:
-        with cameras_tof[0].tof_device.start_stream(1):
+        with cameras_tof[0].tof_device.start_stream(tof_stream_buffers):
             # cameras_tof[0].prepare_tof()
             sfp = SleepForPeriodic(0.1)
             count = 0
@@ -68,26 +112,61 @@ def main():
                 if key == ord("q"):
                     break
 
+                # Capture a set of frames taken at the same time. Every
+                # sensor is read once, then the sensor with the oldest frame
+                # is read again, waiting for a frame newer than the one it
+                # had, until all frames are within the tolerance.
+                synchronizer.clear()
+                for sensor in sensors:
+                    capture(sensor)
+                frame_set = synchronizer.match()
+                reads = 0
+                while frame_set is None and reads < sync_max_reads:
+                    capture(synchronizer.oldest_sensor(), newer=True)
+                    frame_set = synchronizer.match()
+                    reads += 1
+                if frame_set is None:
+                    print(f"No frames within {sync_tolerance_sec} s, retrying")
+                    continue
+                print(f"frames within "
+                      f"{synchronizer.spread(frame_set) * 1000:.1f} ms")
+
                 # Save images to files
                 for c in range(num_cameras_tof):
                     path = os.path.join(
                         save_dir, f"tof{c+1}_{str(count).zfill(4)}")
-                    cameras_tof[c].shoot_save(path)
+                    timestamp, tof_frame = frame_set[f"tof{c+1}"]
+                    if archive is not None:
+                        # raw frame only, render it later with
+                        # python SessionArchive.py <save_dir>
+                        writer.submit(archive.append, f"tof{c+1}",
+                                      tof_frame.array, count, timestamp,
+                                      cameras_tof[c].get_metadata(tof_frame))
+                    else:
+                        writer.submit(cameras_tof[c].save_frame, tof_frame,
+                                      path)
+                        # intensity for the calibration target detection
+                        # (python detect_targets.py <save_dir>)
+                        writer.write_image(path + "_intensity.tif",
+                                           tof_frame.intensity.copy())
                     print("hey51")
                     # cameras_tof[c].save_image(
                     #     buffer_3d, f"tof{c+1}_{str(count).zfill(4)}.jpg")
                     print("hey52")
 
                 for c in range(num_cameras_ir):
-                    ir_frame = cameras_ir[c].shoot_ir()
-                    # Capture twice to avoid problems (I don't know why, but it's related to synchronization)
-                    ir_frame = cameras_ir[c].shoot_ir()
+                    timestamp, ir_frame = frame_set[f"ir{c+1}"]
                     path = os.path.join(
                         save_dir, f"ir{c+1}_{str(count).zfill(4)}.tif")
-                    cv2.imwrite(path, ir_frame)
+                    if archive is not None:
+                        writer.submit(archive.append, f"ir{c+1}", ir_frame,
+                                      count, timestamp, {"kind": "ir"})
+                    else:
+                        writer.write_image(path, ir_frame)
 
                 count += 1
                 print(count)
+                print(writer.format_stats())
                 if mode == 1:
                     ws.Beep(880, 500)
 
@@ -95,6 +174,12 @@ def main():
 
     finally:
         print("hey6")
+        # write everything still queued before the cameras go away
+        writer.close()
+        print(writer.format_stats())
+        if archive is not None:
+            archive.close()
+
         for c in range(num_cameras_tof):
             cameras_tof[c].dispose()
 
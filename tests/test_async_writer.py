@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from AsyncWriter import Async_Writer
+
+'''
+Async_Writer queueing, backpressure and ordering
+'''
+
+
+class Slow_Pickle():
+    # signals when its pickling starts, and takes a while
+    def __init__(self, started):
+        self.started = started
+
+    def __reduce__(self):
+        self.started.set()
+        time.sleep(0.2)
+        return (int, ())
+
+
+@pytest.mark.parametrize('backpressure', Async_Writer.BACKPRESSURE_MODES)
+@pytest.mark.parametrize('max_queue', [0, -1])
+def test_max_queue_below_one_is_rejected(backpressure, max_queue):
+    with pytest.raises(ValueError):
+        Async_Writer(max_queue=max_queue, backpressure=backpressure)
+
+
+def test_spilled_jobs_run_in_submission_order(tmp_path):
+    done = []
+    with Async_Writer(num_workers=1, max_queue=2, backpressure='spill',
+                      spill_dir=tmp_path) as writer:
+        for i in range(100):
+            writer.submit(lambda i: (time.sleep(0.001), done.append(i)), i)
+            if i % 10 == 0:
+                time.sleep(0.005)
+        spilled = writer.stats()['spilled']
+    assert spilled > 0
+    assert done == list(range(100))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_job_queued_while_spilling_waits(tmp_path):
+    done = []
+    run_first = threading.Event()
+    spill_started = threading.Event()
+
+    def record(i, *args):
+        done.append(i)
+
+    with Async_Writer(num_workers=1, max_queue=1, backpressure='spill',
+                      spill_dir=tmp_path) as writer:
+        # job 0 keeps the worker busy, job 1 fills the queue
+        writer.submit(lambda: (run_first.wait(), done.append(0)))
+        while writer.queue_depth():
+            time.sleep(0.001)
+        writer.submit(record, 1)
+        spiller = threading.Thread(target=writer.submit, args=(
+            record, 2, Slow_Pickle(spill_started)))
+        spiller.start()
+        spill_started.wait()
+        # the worker takes job 1, job 3 finds room in the queue while
+        # job 2 is still being spilled
+        run_first.set()
+        while writer.queue_depth() > 1:
+            time.sleep(0.001)
+        writer.submit(record, 3)
+        spiller.join()
+    assert done == [0, 1, 2, 3]
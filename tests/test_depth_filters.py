@@ -0,0 +1,69 @@
+import numpy as np
+
+from Camera import TofFrame
+from DepthFilters import Spatial_Filter
+
+'''
+Spatial_Filter on synthetic z planes
+'''
+
+
+def get_masked_median(z_raw, accepted, kernel_size):
+    # lower median of the accepted pixels of every window, brute force
+    margin = kernel_size // 2
+    padded = np.pad(np.where(accepted, z_raw, 0).astype(np.int64), margin)
+    medians = np.zeros(z_raw.shape)
+    counts = np.zeros(z_raw.shape, dtype=np.int64)
+    for row in range(z_raw.shape[0]):
+        for column in range(z_raw.shape[1]):
+            window = padded[row:row + kernel_size,
+                            column:column + kernel_size].ravel()
+            window = np.sort(window[window > 0])
+            counts[row, column] = len(window)
+            if len(window):
+                medians[row, column] = window[(len(window) - 1) // 2]
+    return medians, counts
+
+
+def test_median_is_a_measured_depth():
+    # 13 of 25 pixels take part: 10 at 4000 and 3 at 8000, the mean of
+    # the medians with 0 and 65535 for the others was 6000
+    z_raw = np.full((5, 5), 4000, dtype=np.uint16)
+    accepted = np.zeros((5, 5), dtype=bool)
+    positions = np.random.default_rng(0).permutation(25)
+    positions = positions[positions != 12][:12]
+    accepted.flat[positions] = True
+    accepted[2, 2] = True
+    z_raw.flat[positions[:3]] = 8000
+
+    with Spatial_Filter('median', kernel_size=5, workers=1) as spatial:
+        z_filtered, filtered = spatial.filter_median(z_raw, accepted)
+    assert filtered[2, 2]
+    assert z_filtered[2, 2] == 4000
+
+
+def test_median_matches_brute_force():
+    rng = np.random.default_rng(1)
+    z_raw = rng.integers(1, 9000, size=(40, 50)).astype(np.uint16)
+    accepted = rng.random((40, 50)) > 0.3
+    for kernel_size in (3, 5):
+        with Spatial_Filter('median', kernel_size=kernel_size,
+                            workers=1) as spatial:
+            z_filtered, filtered = spatial.filter_median(z_raw, accepted)
+        medians, counts = get_masked_median(z_raw, accepted, kernel_size)
+        expected = accepted & (counts > kernel_size * kernel_size // 2)
+        assert np.array_equal(filtered, expected)
+        assert np.array_equal(z_filtered[expected], medians[expected])
+
+
+def test_filter_keeps_tiles_seamless():
+    rng = np.random.default_rng(2)
+    array = np.zeros((48, 40, 4), dtype=np.uint16)
+    array[:, :, 2] = rng.integers(3000, 5000, size=(48, 40))
+    array[:, :, 3] = 100
+    array[rng.random((48, 40)) > 0.9, 2] = TofFrame.INVALID_Z_UNSIGNED
+    frame = TofFrame(array, 'Coord3D_ABCY16', (0.25, 0.25, 0.25))
+    with Spatial_Filter('median', tile_rows=48, workers=1) as whole, \
+            Spatial_Filter('median', tile_rows=7, workers=3) as tiled:
+        assert np.array_equal(whole.filter(frame).array,
+                              tiled.filter(frame).array)
@@ -0,0 +1,107 @@
+import ctypes
+
+import numpy as np
+import pytest
+
+from Camera import (TofFrame, Tof_Camera, get_color_borders,
+                    get_rgb_colors_of_distances)
+
+'''
+The vectorized heatmap against the per-pixel loop it replaced
+    Synthetic Coord3D_ABCY16s buffers, no camera needed.
+'''
+
+SCALES = (1.0, 0.25, 0.1, 0.0625, 0.3)
+MAX_DISTANCES = (1500, 3000, 8300, 1250)
+
+
+class Fake_Buffer():
+    # what the heatmap reads of an arena_api buffer
+    def __init__(self, abcy):
+        self.abcy = np.ascontiguousarray(abcy, dtype=np.int16)
+        self.height, self.width = self.abcy.shape[:2]
+        self.pdata = self.abcy.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))
+
+
+def make_camera(color_borders):
+    camera = Tof_Camera.__new__(Tof_Camera)
+    camera.color_borders = color_borders
+    return camera
+
+
+def get_loop_heatmap(camera, buffer_3d, scale_z):
+    # BGR bytes of the per-pixel loop of the original implementation
+    pdata_16bit = ctypes.cast(buffer_3d.pdata,
+                              ctypes.POINTER(ctypes.c_int16))
+    heatmap = bytearray()
+    for i in range(buffer_3d.width * buffer_3d.height):
+        z = int(pdata_16bit[i * 4 + 2] * scale_z)
+        red, green, blue = camera.get_rgb_colors_of_point_at_distance(z)
+        heatmap += bytes((blue, green, red))
+    return bytes(heatmap)
+
+
+def make_z_values(color_borders, scale_z):
+    # raw values around every band edge for this scale, plus negative,
+    # invalid and extreme values
+    z = set()
+    for border in color_borders:
+        raw = int(border / scale_z)
+        z.update(range(raw - 3, raw + 4))
+    z.update((-32768, -32767, -1000, -2, -1, 0, 1, 2, 32766, 32767))
+    z.update(np.linspace(-200, color_borders[-1] / scale_z + 200,
+                         1000).astype(int).tolist())
+    z = sorted(value for value in z if -32768 <= value <= 32767)
+    # pad to whole rows of 16 pixels with the invalid value
+    z += [-32768] * (-len(z) % 16)
+    return np.array(z, dtype=np.int16).reshape(-1, 16)
+
+
+@pytest.mark.parametrize('max_distance', MAX_DISTANCES)
+@pytest.mark.parametrize('scale_z', SCALES)
+def test_heatmap_matches_loop(max_distance, scale_z):
+    camera = make_camera(get_color_borders(max_distance))
+    z = make_z_values(camera.color_borders, scale_z)
+    rng = np.random.default_rng(max_distance)
+    abcy = rng.integers(-32768, 32768, size=z.shape + (4,), dtype=np.int16)
+    abcy[:, :, 2] = z
+    buffer_3d = Fake_Buffer(abcy)
+
+    heatmap = camera.get_a_BGR8_distance_heatmap_ctype_array(buffer_3d,
+                                                              scale_z)
+    assert bytes(heatmap) == get_loop_heatmap(camera, buffer_3d, scale_z)
+
+
+def test_heatmap_all_raw_values():
+    # every 16 bit value once, with the default borders and scale
+    camera = make_camera(get_color_borders())
+    z = np.arange(-32768, 32768, dtype=np.int64).astype(np.int16)
+    abcy = np.zeros((256, 256, 4), dtype=np.int16)
+    abcy[:, :, 2] = z.reshape(256, 256)
+    buffer_3d = Fake_Buffer(abcy)
+
+    heatmap = camera.get_a_BGR8_distance_heatmap_ctype_array(buffer_3d, 0.25)
+    assert bytes(heatmap) == get_loop_heatmap(camera, buffer_3d, 0.25)
+
+
+def test_rgb_array_is_heatmap_reversed():
+    camera = make_camera(get_color_borders(3000))
+    buffer_3d = Fake_Buffer(np.zeros((4, 16, 4), dtype=np.int16))
+    buffer_3d.abcy[:, :, 2] = make_z_values(camera.color_borders,
+                                            0.25)[:4]
+    bgr = camera.get_a_BGR8_distance_heatmap_array(buffer_3d, 0.25)
+    rgb = camera.get_a_RGB_colring_array(buffer_3d, 0.25)
+    assert np.array_equal(bgr, rgb[:, :, ::-1])
+
+
+@pytest.mark.parametrize('offset_z', [0.0, -100.0, 250.0])
+def test_frame_colors_follow_offset(offset_z):
+    # the colors are those of z in mm, offset included
+    abcy = np.zeros((256, 256, 4), dtype=np.uint16)
+    abcy[:, :, 2] = np.arange(65536, dtype=np.uint32).reshape(256, 256)
+    frame = TofFrame(abcy, 'Coord3D_ABCY16', (0.25, 0.25, 0.25),
+                     (0.0, 0.0, offset_z), get_color_borders(3000))
+    z_mm = (abcy[:, :, 2] * 0.25 + offset_z).astype(np.int64)
+    rgb = get_rgb_colors_of_distances(z_mm, frame.color_borders)
+    assert np.array_equal(frame.rgb_colors, rgb)
+    assert np.array_equal(frame.bgr_heatmap, rgb[:, :, ::-1])
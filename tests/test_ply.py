@@ -0,0 +1,36 @@
+import numpy as np
+
+import PlyWriter
+from Camera import TofFrame
+
+'''
+PLY export of the raw and the TofFrame paths
+'''
+
+
+def make_frame(is_signed):
+    rng = np.random.default_rng(3)
+    if is_signed:
+        invalid = TofFrame.INVALID_Z_SIGNED
+        array = rng.integers(-2000, 2000, size=(12, 16, 4)).astype(np.int16)
+        pixel_format = 'Coord3D_ABCY16s'
+    else:
+        invalid = TofFrame.INVALID_Z_UNSIGNED
+        array = rng.integers(0, 9000, size=(12, 16, 4)).astype(np.uint16)
+        pixel_format = 'Coord3D_ABCY16'
+    # no measurement: only z invalid, or every coordinate
+    array[2, :5, 2] = invalid
+    array[5, 3:9, :3] = invalid
+    return TofFrame(array, pixel_format, (0.25, 0.25, 0.25))
+
+
+def test_both_paths_write_the_same_points(tmp_path):
+    for is_signed in (False, True):
+        frame = make_frame(is_signed)
+        PlyWriter.save_ply(tmp_path / 'raw.ply', frame.array,
+                           color=frame.rgb_colors, is_signed=is_signed)
+        frame.save_ply(tmp_path / 'frame.ply')
+        raw = PlyWriter.load_ply(tmp_path / 'raw.ply')
+        points = PlyWriter.load_ply(tmp_path / 'frame.ply')
+        assert len(raw) == len(points) == frame.valid.sum()
+        assert np.array_equal(raw, points)
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from Camera import TofFrame, cv2
+from Registration import OUTSIDE, Registration
+
+'''
+Registration.project() against cv2.projectPoints
+'''
+
+TOF_MATRIX = [[520.0, 0.0, 318.0], [0.0, 521.0, 242.0], [0.0, 0.0, 1.0]]
+TOF_DISTORTION = [-0.1, 0.02, 0.0005, -0.0003, 0.0]
+IR_MATRIX = [[600.0, 0.0, 325.0], [0.0, 602.0, 250.0], [0.0, 0.0, 1.0]]
+IR_DISTORTION = [-0.25, 0.08, 0.001, 0.0007, -0.01]
+# pixels closer to the image edge than this may land on either side
+EDGE = 0.05
+
+
+def make_calibration(rotation, translation):
+    return {
+        'tof': {'camera_matrix': TOF_MATRIX, 'dist_coeffs': TOF_DISTORTION,
+                'size': [640, 480]},
+        'ir1': {'camera_matrix': IR_MATRIX, 'dist_coeffs': IR_DISTORTION,
+                'size': [640, 512], 'rotation': rotation,
+                'translation': translation},
+    }
+
+
+def make_frame():
+    # tilted plane 600..1320 mm, a corner without measurement
+    array = np.zeros((480, 640, 4), dtype=np.uint16)
+    rows = np.arange(480, dtype=np.float64)[:, np.newaxis]
+    array[:, :, 2] = np.round((600 + 1.5 * rows) / 0.25)
+    array[:20, :20, 2] = TofFrame.INVALID_Z_UNSIGNED
+    return TofFrame(array, 'Coord3D_ABCY16', (0.25, 0.25, 0.25))
+
+
+def project_points(frame, rotation, translation, camera_matrix,
+                   distortion):
+    # (480, 640, 2) pixel of every ToF point in the other camera
+    v, u = np.mgrid[0:480, 0:640].astype(np.float64)
+    normalized = cv2.undistortPoints(
+        np.stack([u.ravel(), v.ravel()], axis=-1)[:, np.newaxis],
+        np.array(TOF_MATRIX), np.array(TOF_DISTORTION)).reshape(-1, 2)
+    z = frame.z_raw.astype(np.float64).ravel() * 0.25
+    points = np.stack([normalized[:, 0] * z, normalized[:, 1] * z, z],
+                      axis=-1)
+    pixels, _ = cv2.projectPoints(points, np.array(rotation),
+                                  np.array(translation),
+                                  np.array(camera_matrix),
+                                  np.array(distortion))
+    return pixels.reshape(480, 640, 2)
+
+
+@pytest.mark.parametrize('rotation, translation', [
+    ([0.01, -0.03, 0.005], [60.0, -5.0, 3.0]),
+    ([0.05, -0.2, 0.02], [150.0, 40.0, 3.0]),
+])
+def test_project_matches_project_points(rotation, translation):
+    registration = Registration(make_calibration(rotation, translation),
+                                cache_dir=None)
+    frame = make_frame()
+    ir_pixels, _ = registration.project(frame)
+    expected = project_points(frame, rotation, translation, IR_MATRIX,
+                              IR_DISTORTION)
+    # undistorted pixels, in the coordinates of the distortion table
+    table_matrix = np.array(IR_MATRIX)
+    table_matrix[:2, 2] += registration.margin
+    undistorted = project_points(frame, rotation, translation, table_matrix,
+                                 np.zeros(5))
+    table_height, table_width = registration.distortion_map.shape[:2]
+    on_table = ((undistorted[:, :, 0] >= 0)
+                & (undistorted[:, :, 0] <= table_width - 1)
+                & (undistorted[:, :, 1] >= 0)
+                & (undistorted[:, :, 1] <= table_height - 1))
+
+    def in_image(margin):
+        return ((expected[:, :, 0] >= margin)
+                & (expected[:, :, 0] <= 639 - margin)
+                & (expected[:, :, 1] >= margin)
+                & (expected[:, :, 1] <= 511 - margin))
+
+    outside = (ir_pixels == OUTSIDE).all(axis=-1)
+    inside = frame.valid & on_table & in_image(EDGE)
+    assert inside.sum() > 200000
+    assert not outside[inside].any()
+    assert np.abs(ir_pixels[inside] - expected[inside]).max() < 0.05
+
+    # off the image, on the table or off it, or without depth
+    off_table = frame.valid & ~on_table
+    off_image = frame.valid & on_table & ~in_image(-EDGE)
+    assert off_table.any() and off_image.any()
+    assert outside[off_table].all()
+    assert outside[off_image].all()
+    assert outside[~frame.valid].all()
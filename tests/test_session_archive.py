@@ -0,0 +1,105 @@
+import numpy as np
+
+from SessionArchive import Session_Archive, Session_Archive_Reader
+
+'''
+Session archives written and read back in a temporary directory
+'''
+
+
+def make_metadata(operating_mode, scale_z):
+    return {'kind': 'tof', 'pixel_format': 'Coord3D_ABCY16',
+            'scales': (0.25, 0.25, scale_z), 'offsets': (0.0, 0.0, 0.0),
+            'operating_mode': operating_mode}
+
+
+def make_frame(value):
+    return np.full((4, 6, 4), value, dtype=np.uint16)
+
+
+def test_metadata_of_every_frame(tmp_path):
+    first = make_metadata('Distance3000mmSingleFreq', 0.25)
+    second = make_metadata('Distance6000mmSingleFreq', 0.5)
+    third = make_metadata('Distance1250mmSingleFreq', 0.125)
+    with Session_Archive(tmp_path) as archive:
+        for i in range(3):
+            archive.append('tof1', make_frame(i), metadata=first)
+        for i in range(3, 5):
+            archive.append('tof1', make_frame(i), metadata=second)
+    # a resumed session with other settings
+    with Session_Archive(tmp_path) as archive:
+        archive.append('tof1', make_frame(5), metadata=third)
+        archive.append('tof1', make_frame(6))
+
+    reader = Session_Archive_Reader(tmp_path)
+    modes = [reader.metadata('tof1', i)['operating_mode']
+             for i in range(reader.count('tof1'))]
+    assert modes == ['Distance3000mmSingleFreq'] * 3 + [
+        'Distance6000mmSingleFreq'] * 2 + ['Distance1250mmSingleFreq'] * 2
+    assert reader.metadata('tof1') == reader.metadata('tof1', 0)
+    assert reader.tof_frame('tof1', 4).scales[2] == 0.5
+    assert reader.tof_frame('tof1', 5).scales[2] == 0.125
+
+
+def test_resume_after_a_torn_index_record(tmp_path):
+    with Session_Archive(tmp_path) as archive:
+        for i in range(4):
+            archive.append('tof1', make_frame(i), frame_number=i)
+    # a crash while writing the last record
+    index_path = tmp_path / 'tof1.idx'
+    index_path.write_bytes(index_path.read_bytes()[:-7])
+
+    reader = Session_Archive_Reader(tmp_path)
+    assert reader.count('tof1') == 3
+    with Session_Archive(tmp_path) as archive:
+        for i in range(3, 6):
+            archive.append('tof1', make_frame(i), frame_number=i)
+
+    reader = Session_Archive_Reader(tmp_path)
+    assert reader.count('tof1') == 6
+    for i in range(6):
+        assert reader.frame_number('tof1', i) == i
+        assert np.array_equal(reader.frame('tof1', i), make_frame(i))
+
+
+def test_resume_after_a_record_without_data(tmp_path):
+    with Session_Archive(tmp_path, chunk_size=2 * make_frame(0).nbytes) \
+            as archive:
+        for i in range(5):
+            archive.append('tof1', make_frame(i), frame_number=i)
+    # the data of the last frame never reached its chunk file
+    chunk_path = tmp_path / 'tof1.002.bin'
+    chunk_path.write_bytes(chunk_path.read_bytes()[:10])
+
+    assert Session_Archive_Reader(tmp_path).count('tof1') == 4
+    with Session_Archive(tmp_path, chunk_size=2 * make_frame(0).nbytes) \
+            as archive:
+        for i in range(4, 7):
+            archive.append('tof1', make_frame(i), frame_number=i)
+
+    reader = Session_Archive_Reader(tmp_path)
+    assert reader.count('tof1') == 7
+    assert np.array_equal(reader.frames('tof1'),
+                          np.stack([make_frame(i) for i in range(7)]))
+
+
+def test_other_json_files_are_not_sensors(tmp_path):
+    import detect_targets
+
+    with Session_Archive(tmp_path) as archive:
+        for i in range(3):
+            archive.append('tof1', make_frame(i), frame_number=i,
+                           metadata=make_metadata('Distance3000mm', 0.25))
+            archive.append('ir1', np.full((4, 6), i, dtype=np.uint16),
+                           frame_number=i, metadata={'kind': 'ir'})
+    # written by earlier versions of detect_targets.py
+    (tmp_path / 'targets.json').write_text(
+        '{"pattern": [9, 6], "sensors": ["ir1", "tof1"], "sets": []}')
+
+    reader = Session_Archive_Reader(tmp_path)
+    assert sorted(reader.sensors()) == ['ir1', 'tof1']
+    assert [reader.frame_number('ir1', i) for i in range(3)] == [0, 1, 2]
+    frames = detect_targets.find_frames(str(tmp_path))
+    assert sorted(frames) == [0, 1, 2]
+    assert all(sorted(sensors) == ['ir1', 'tof1']
+               for sensors in frames.values())
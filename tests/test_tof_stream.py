@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from Camera import Tof_Camera
+from SimBackend import Sim_Backend
+
+'''
+Tof_Camera.stream() on the simulated bus
+'''
+
+
+@pytest.fixture
+def camera():
+    camera = Tof_Camera(backend=Sim_Backend(num_ir=0))
+    yield camera
+    camera.dispose()
+
+
+def test_stream_needs_two_buffers(camera):
+    with pytest.raises(ValueError):
+        next(camera.stream(1))
+
+
+def test_held_frames_are_copied_not_requeued(camera):
+    stream = camera.stream(3)
+    held = []
+    for _ in range(6):
+        frame = next(stream)
+        held.append((frame, frame.array.copy()))
+    # the stream goes on, the oldest held frames own their data
+    assert camera.stream_stats['frames'] == 6
+    assert camera.stream_stats['held'] == 2
+    assert all(frame.buffer_3d is None for frame, _ in held[:4])
+    stream.close()
+    assert camera.stream_stats['held'] == 0
+    for frame, array in held:
+        assert frame.buffer_3d is None
+        assert np.array_equal(frame.array, array)
+
+
+def test_released_frames_go_back(camera):
+    stream = camera.stream(2)
+    for _ in range(5):
+        with next(stream):
+            pass
+    stream.close()
+    assert camera.stream_stats['frames'] == 5
+    assert camera.stream_stats['detached'] == 0